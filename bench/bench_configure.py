@@ -0,0 +1,169 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2020, kobbled
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+#
+# benchmark for the stages of the rossum configure pipeline on a synthetic
+# workspace (see make_workspace.py)
+#
+# The stages are the functions rossum's main() runs, called with stand-in
+# tool paths, so this runs on any OS without Roboguide or WinOLPC installed.
+# The first run starts without a cache, the others reuse the cache of the
+# previous run (like reconfiguring an unchanged workspace).
+#
+# usage: python bench_configure.py [-n PACKAGES] [-f FANOUT] [-d DEPTH]
+#                                  [-m SOURCES] [--runs RUNS] [--empy] [-w DIR]
+#
+
+import os
+import sys
+import shutil
+import logging
+import argparse
+import tempfile
+
+BIN_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'bin')
+sys.path.insert(0, BIN_DIR)
+import rossum
+
+from make_workspace import make_workspace
+
+TEMPLATE_PATH = os.path.join(BIN_DIR, 'templates', 'build.ninja.em')
+PACKAGE_TEMPLATE_PATH = os.path.join(BIN_DIR, 'templates', 'package.ninja.em')
+
+# what find_tools(..) would return
+STAND_IN_TOOLS = [
+  'C:\\tools\\ktrans.exe',
+  'C:\\tools\\ktransw.cmd',
+  'C:\\tools\\maketp.exe',
+  'C:\\tools\\tpp.bat',
+  'C:\\tools\\yamljson2xml.cmd',
+  'C:\\tools\\kcdictw.cmd',
+]
+
+
+def rossum_args(renderer):
+  """Command line arguments of 'rossum -s -b -i --renderer RENDERER'.
+  """
+  return argparse.Namespace(buildsource=True, buildall=True, build_interface=True,
+    inc_tests=False, build_forms=False, build_ls=False, compiletp=False,
+    translate_only=False, ktransw=None, user_macros=[], hastpp=False,
+    keepgpp=False, kcache=False, renderer=renderer)
+
+
+def configure(src_dir, lib_dir, build_dir, renderer='native'):
+  """Run the configure stages once. Returns the rossum.Profiler with the
+  timings.
+  """
+  args = rossum_args(renderer)
+  profiler = rossum.Profiler()
+  cache = rossum.RossumCache(os.path.join(build_dir, rossum.FILE_CACHE))
+  cache.load()
+  profiler.cache = cache
+
+  registry, src_space_pkgs, _ = rossum.discover_pkgs([src_dir], [lib_dir], args, cache, profiler)
+  graph, all_pkgs = rossum.resolve_pkgs(src_space_pkgs, registry, args, profiler)
+  build_pkgs = list(all_pkgs)
+  rossum.update_interfaces(build_pkgs, cache, profiler)
+
+  profiler.stage('gen_obj_mappings')
+  tool_paths = rossum.tool_mappings(STAND_IN_TOOLS, args)
+  rossum.gen_obj_mappings(build_pkgs, tool_paths, args, graph)
+  profiler.count('objects', sum(len(pkg.objects) for pkg in build_pkgs))
+
+  profiler.stage('render')
+  ws = rossum.RossumWorkspace(
+    build=rossum.RossumSpaceInfo(path=build_dir),
+    sources=[rossum.RossumSpaceInfo(path=src_dir)],
+    robot_ini=rossum.KtransRobotIniInfo(path=os.path.join(src_dir, 'robot.ini'),
+      ftp='127.0.0.1', env=''),
+    pkgs=build_pkgs)
+  support = rossum.KtransSupportDirInfo(path='C:\\support', version_string='V9.10-1')
+  regen = rossum.RossumRegenInfo(command='rossum --regenerate',
+    inputs=' '.join(rossum.ninja_escape_path(p.manifest_path) for p in build_pkgs))
+  globls = rossum.template_globals(ws, tool_paths, support, regen, None, None, {},
+    PACKAGE_TEMPLATE_PATH, args)
+  build_file_path = os.path.join(build_dir, rossum.BUILD_FILE_NAME)
+  rossum.write_build_file(build_file_path, globls, args.renderer, TEMPLATE_PATH)
+  profiler.count('bytes', os.path.getsize(build_file_path))
+  profiler.end()
+
+  cache.save()
+  return profiler
+
+
+def report(runs):
+  names = [stage['name'] for stage in runs[0].stages]
+  header = '  {0:<26}'.format('stage') + ''.join('{0:>12}'.format('run {0}'.format(i+1))
+    for i in range(len(runs)))
+  print(header)
+  for i, name in enumerate(names):
+    times = ''.join('{0:>9.1f} ms'.format(run.stages[i]['duration'] * 1000.0) for run in runs)
+    print('  {0:<26}{1}'.format(name, times))
+  print('  {0:<26}{1}'.format('total', ''.join('{0:>9.1f} ms'.format(
+    sum(s['duration'] for s in run.stages) * 1000.0) for run in runs)))
+
+  print('')
+  print('  counts (run 1):')
+  for stage in runs[0].stages:
+    if stage['counts']:
+      print('    {0:<24} {1}'.format(stage['name'],
+        ', '.join('{0}={1}'.format(k, v) for k, v in stage['counts'].items())))
+  if len(runs) > 1:
+    print('  cache hit rates (run 2):')
+    for stage in runs[1].stages:
+      if stage['cache']:
+        print('    {0:<24} {1}'.format(stage['name'],
+          ', '.join('{0}={1:.0%}'.format(k, v['hit_rate']) for k, v in stage['cache'].items())))
+
+
+def main():
+  parser = argparse.ArgumentParser(prog='bench_configure',
+    description='Time the stages of the rossum configure pipeline on a synthetic workspace.')
+  parser.add_argument('-n', '--packages', type=int, default=200, dest='n_pkgs')
+  parser.add_argument('-f', '--fanout', type=int, default=3, dest='fanout')
+  parser.add_argument('-d', '--depth', type=int, default=6, dest='depth')
+  parser.add_argument('-m', '--sources', type=int, default=20, dest='n_sources')
+  parser.add_argument('-r', '--routines', type=int, default=20, dest='n_routines')
+  parser.add_argument('-i', '--interfaces', type=int, default=5, dest='n_interfaces')
+  parser.add_argument('--runs', type=int, default=2, dest='runs',
+    help='number of configure runs, the first one without cache (default: %(default)s)')
+  parser.add_argument('--empy', action='store_true', dest='empy',
+    help='render the build file with the EmPy template instead of the native renderer')
+  parser.add_argument('-w', '--workspace', type=str, dest='workspace',
+    help='generate the workspace in (and keep) this directory')
+  args = parser.parse_args()
+
+  logging.basicConfig(format='%(levelname)-8s | %(message)s', level=logging.WARNING)
+  rossum.logger = logging.getLogger('rossum')
+
+  out_dir = args.workspace or os.path.join(tempfile.mkdtemp(prefix='bench_configure'), 'ws')
+  print('generating workspace: {0} packages (fan-out {1}, depth {2}), {3} sources each'.format(
+    args.n_pkgs, args.fanout, args.depth, args.n_sources))
+  src_dir, lib_dir = make_workspace(out_dir, args.n_pkgs, args.fanout, args.depth,
+    args.n_sources, args.n_routines, args.n_interfaces)
+  build_dir = os.path.join(out_dir, 'build')
+
+  renderer = 'empy' if args.empy else 'native'
+  runs = [configure(src_dir, lib_dir, build_dir, renderer) for _ in range(args.runs)]
+  report(runs)
+
+  if not args.workspace:
+    shutil.rmtree(os.path.dirname(out_dir))
+
+
+if __name__ == '__main__':
+  main()
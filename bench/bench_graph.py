@@ -0,0 +1,96 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2020, kobbled
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+#
+# benchmark for the rossum dependency graph on synthetic package graphs
+#
+# usage: python bench_graph.py [-n PACKAGES] [-f FANOUT] [-r ROOTS]
+#
+
+import os
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'bin'))
+import rossum
+
+
+def make_graph(n_pkgs, fanout, n_roots, seed=0):
+  """Layered random dependency graph: package i only depends on packages
+  with a higher index, so the graph is acyclic. The first 'n_roots'
+  packages are the roots.
+  """
+  rnd = random.Random(seed)
+  g = rossum.Graph()
+  names = ['pkg{0:05d}'.format(i) for i in range(n_pkgs)]
+  for name in names[:n_roots]:
+    g.setRoot(name, '0.0.1')
+  for i, name in enumerate(names):
+    later = names[i+1:]
+    for dep in rnd.sample(later, min(fanout, len(later))):
+      g.addEdge(name, dep, '0.0.1', False)
+  return g
+
+
+def make_chain(n_pkgs):
+  """Single chain of dependencies: pkg0 -> pkg1 -> .. -> pkgN, closed into
+  a cycle at the end.
+  """
+  g = rossum.Graph()
+  g.setRoot('pkg0', '0.0.1')
+  for i in range(n_pkgs - 1):
+    g.addEdge('pkg{0}'.format(i), 'pkg{0}'.format(i+1), '0.0.1', False)
+  g.addEdge('pkg{0}'.format(n_pkgs - 1), 'pkg0', '0.0.1', False)
+  return g
+
+
+def timed(label, fn):
+  start = time.perf_counter()
+  result = fn()
+  print('  {0:<28} {1:8.2f} ms'.format(label, (time.perf_counter() - start) * 1000.0))
+  return result
+
+
+def main():
+  import argparse
+
+  parser = argparse.ArgumentParser(prog='bench_graph',
+    description='Time the rossum dependency graph on synthetic graphs.')
+  parser.add_argument('-n', '--packages', type=int, default=2000, dest='n_pkgs')
+  parser.add_argument('-f', '--fanout', type=int, default=5, dest='fanout')
+  parser.add_argument('-r', '--roots', type=int, default=50, dest='n_roots')
+  args = parser.parse_args()
+
+  print('layered graph: {0} packages, fan-out {1}, {2} roots'.format(
+    args.n_pkgs, args.fanout, args.n_roots))
+  g = timed('build', lambda: make_graph(args.n_pkgs, args.fanout, args.n_roots))
+  roots = [p.name for p in g.root]
+  timed('reachable (all roots)', lambda: g.reachable(roots))
+  timed('closure (all packages)', lambda: [g.closure(n) for n in g.nodes])
+  timed('topological order', g.topologicalOrder)
+  timed('print_dependencies (roots)', lambda: [g.print_dependencies(n) for n in roots])
+
+  print('chain with cycle: {0} packages'.format(args.n_pkgs * 10))
+  g = timed('build', lambda: make_chain(args.n_pkgs * 10))
+  timed('reachable', lambda: g.reachable(['pkg0']))
+  cycles = timed('cycles', g.cycles)
+  print('  found {0} cycle(s) of length {1}'.format(len(cycles), len(cycles[0]) - 1))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,93 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2020, kobbled
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+#
+# benchmark for the generation of tp-interface programs
+#
+# usage: python bench_interfaces.py [-n INTERFACES] [-o OUTPUT_DIR]
+#
+
+import os
+import sys
+import time
+import random
+import shutil
+import logging
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'bin'))
+import rossum
+
+TYPES = ['INTEGER', 'REAL', 'BOOLEAN', 'STRING', 'XYZWPR', 'JOINTPOS', 'POSITION', 'VECTOR']
+RETURN_TYPES = [''] + TYPES
+
+
+def make_interfaces(n_interfaces, out_dir, seed=0):
+  """Random interfaces with up to 6 arguments each, a third of them with a
+  default value.
+  """
+  rnd = random.Random(seed)
+  interfaces = []
+  for i in range(n_interfaces):
+    arguments = []
+    for j in range(rnd.randint(0, 6)):
+      default = rnd.choice([None, None, 1]) if j else None
+      arguments.append(['arg{0}'.format(j), rnd.choice(TYPES), default])
+    interfaces.append(rossum.TPInterfaces(
+      name='lib__routine{0}'.format(i),
+      alias='rtn{0:05d}'.format(i),
+      include_file='lib.klh',
+      depends=[],
+      path=os.path.join(out_dir, 'tp', 'rtn{0:05d}.kl'.format(i)),
+      arguments=arguments,
+      return_type=rnd.choice(RETURN_TYPES)))
+  return interfaces
+
+
+def timed(label, fn):
+  start = time.perf_counter()
+  result = fn()
+  print('  {0:<28} {1:8.2f} ms'.format(label, (time.perf_counter() - start) * 1000.0))
+  return result
+
+
+def main():
+  import argparse
+
+  parser = argparse.ArgumentParser(prog='bench_interfaces',
+    description='Time the generation of tp-interface programs.')
+  parser.add_argument('-n', '--interfaces', type=int, default=5000, dest='n_interfaces')
+  parser.add_argument('-o', '--output', type=str, dest='out_dir',
+    help='directory to write the programs to (default: a temporary directory)')
+  args = parser.parse_args()
+
+  rossum.logger = logging.getLogger('bench')
+  out_dir = args.out_dir or tempfile.mkdtemp(prefix='bench_interfaces')
+
+  print('{0} interfaces'.format(args.n_interfaces))
+  interfaces = make_interfaces(args.n_interfaces, out_dir)
+  programs = timed('compile', lambda: [rossum.compile_interface(i) for i in interfaces])
+  timed('render', lambda: [rossum.render_interface(p) for p in programs])
+  timed('create (all new)', lambda: rossum.create_interfaces(interfaces))
+  timed('create (all up-to-date)', lambda: rossum.create_interfaces(interfaces))
+
+  if not args.out_dir:
+    shutil.rmtree(out_dir)
+
+
+if __name__ == '__main__':
+  main()
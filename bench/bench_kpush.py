@@ -0,0 +1,105 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2020, kobbled
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+#
+# benchmark for kpush --native: a full push of a synthetic build dir to a
+# stand-in controller (see fake_controller.py, requires pyftpdlib), over 1 up
+# to N parallel sessions
+#
+# usage: python bench_kpush.py [-n FILES] [-s KB] [--latency MS] [-j JOBS]
+#
+
+import os
+import sys
+import time
+import shutil
+import logging
+import tempfile
+import contextlib
+
+BENCH_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..', 'bin'))
+import kpush
+
+import fake_controller
+
+
+def make_build_dir(build_dir, n_files, size):
+  """A build dir with 'n_files' programs, a tenth of them tp files, and the
+  sorted manifest kpush would make of it.
+  """
+  manifest = kpush.new_manifest()
+  for i in range(n_files):
+    fl = 'prog{0:04d}.{1}'.format(i, 'tp' if i % 10 == 9 else 'pc')
+    with open(os.path.join(build_dir, fl), 'wb') as f:
+      f.write(os.urandom(size))
+    if fl.endswith('.pc'):
+      manifest['karel'].add(fl)
+    else:
+      manifest['tp'].add(fl)
+  return manifest
+
+
+def push(manifest, port, jobs):
+  uploads, deletes, pushed = kpush.plan_push(manifest, {}, full=True)
+  sessions = [kpush.ControllerSession('127.0.0.1', port) for _ in range(jobs)]
+  start = time.time()
+  with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+    failed = kpush.push_native(sessions, kpush.transfer_plan(uploads, deletes), pushed, {})
+  elapsed = time.time() - start
+  for session in sessions:
+    session.close()
+  return elapsed, failed
+
+
+def main():
+  import argparse
+
+  parser = argparse.ArgumentParser(prog='bench_kpush',
+    description='Time a full kpush --native over 1 up to JOBS parallel sessions.')
+  parser.add_argument('-n', '--files', type=int, default=200, dest='n_files')
+  parser.add_argument('-s', '--size', type=int, default=20, dest='size',
+    help='size of every file in KB (default: %(default)s)')
+  parser.add_argument('--latency', type=float, default=5.0, dest='latency',
+    help='delay of every FTP command in ms (default: %(default)s)')
+  parser.add_argument('-j', '--jobs', type=int, default=kpush.DEFAULT_MAX_SESSIONS, dest='jobs')
+  args = parser.parse_args()
+
+  logging.basicConfig(level=logging.WARNING)
+  root = tempfile.mkdtemp(prefix='bench_kpush')
+  build_dir = os.path.join(root, 'build')
+  os.makedirs(build_dir)
+  manifest = make_build_dir(build_dir, args.n_files, args.size * 1024)
+  server = fake_controller.start(os.path.join(root, 'controller'), latency=args.latency / 1000.0)
+  port = server.address[1]
+
+  print('{0} files of {1} KB, {2} ms latency per command'.format(args.n_files, args.size, args.latency))
+  cwd = os.getcwd()
+  os.chdir(build_dir)
+  try:
+    for jobs in range(1, args.jobs + 1):
+      elapsed, failed = push(manifest, port, jobs)
+      print('  {0} session(s) {1:8.2f} s{2}'.format(jobs, elapsed,
+        '  ({0} failed)'.format(failed) if failed else ''))
+  finally:
+    os.chdir(cwd)
+    server.close_all()
+    shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,147 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2020, kobbled
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+#
+# benchmark comparing the EmPy template and the native renderer for build.ninja
+#
+# usage: python bench_render.py [-n OBJECTS] [-p PACKAGES]
+#
+
+import os
+import sys
+import time
+import random
+import tempfile
+import collections
+
+import em
+
+BIN_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'bin')
+sys.path.insert(0, BIN_DIR)
+import rossum
+
+TEMPLATE_PATH = os.path.join(BIN_DIR, 'templates', 'build.ninja.em')
+
+EXTENSIONS = ['kl', 'kl', 'kl', 'kl', 'ls', 'tpp', 'yml', 'xml', 'csv', 'utx', 'ftx']
+
+Manifest = collections.namedtuple('Manifest', 'name')
+Package = collections.namedtuple('Package',
+  'manifest location dependencies include_dirs macros objects')
+
+
+def make_globals(n_objects, n_pkgs, seed=0):
+  """Template globals for 'n_pkgs' packages with 'n_objects' objects in
+  total, spread evenly over the packages.
+  """
+  rnd = random.Random(seed)
+  pkgs = []
+  for i in range(n_pkgs):
+    location = 'C:\\ws\\src\\pkg{0:04d}'.format(i)
+    objects = []
+    for j in range(n_objects // n_pkgs):
+      src = 'src\\file{0:05d}.{1}'.format(j, rnd.choice(EXTENSIONS))
+      objects.append((src, 'file{0:05d}.pc'.format(j), 'file{0:05d}.pc'.format(j), 'karel'))
+    pkgs.append(Package(
+      manifest=Manifest(name='pkg{0:04d}'.format(i)),
+      location=location,
+      dependencies=pkgs[-3:],
+      include_dirs=[location + '\\include'] + [d.location + '\\include' for d in pkgs[-3:]],
+      macros=['DEBUG=1'],
+      objects=objects))
+
+  tools = dict((t, {'path': 'C:\\tools\\{0}.exe'.format(t)})
+    for t in ['maketp', 'yaml', 'xml', 'csv', 'kcdict', 'kcform', 'tpp'])
+  tools['tpp']['compile'] = 'C:\\tools\\maketp.exe'
+  ws = rossum.RossumWorkspace(
+    build=rossum.RossumSpaceInfo(path='C:\\ws\\build'),
+    sources=[rossum.RossumSpaceInfo(path='C:\\ws\\src')],
+    robot_ini=rossum.KtransRobotIniInfo(path='C:\\ws\\robot.ini', ftp='127.0.0.1', env=''),
+    pkgs=pkgs)
+  return {
+    'ws'             : ws,
+    'ktrans'         : rossum.KtransInfo(path='C:\\tools\\ktrans.exe',
+                         support=rossum.KtransSupportDirInfo(path='C:\\support', version_string='V9.10-1')),
+    'ktransw'        : rossum.KtransWInfo(path='C:\\tools\\ktransw.cmd'),
+    'rossum_version' : rossum.ROSSUM_VERSION,
+    'tstamp'         : 'bench',
+    'tools'          : tools,
+    'keepgpp'        : '',
+    'preprocess_karel' : '',
+    'kcache'         : '',
+    'compiletp'      : True,
+    'hastpp'         : True,
+    'makeenv'        : None,
+    'regen'          : rossum.RossumRegenInfo(command='rossum --regenerate C:\\ws\\build',
+                         inputs='C:\\ws\\robot.ini'),
+    'build_file_name': rossum.BUILD_FILE_NAME,
+  }
+
+
+def render_empy(path, globls):
+  with open(path, 'w') as fl:
+    interp = em.Interpreter(output=fl, globals=dict(globls),
+      options={em.RAW_OPT : True, em.BUFFERED_OPT : True})
+    with open(TEMPLATE_PATH) as tpl:
+      interp.file(tpl)
+    interp.shutdown()
+
+
+def render_native(path, globls):
+  with open(path, 'w') as fl:
+    rossum.render_build_file(fl, globls)
+
+
+def timed(label, fn):
+  start = time.perf_counter()
+  result = fn()
+  elapsed = time.perf_counter() - start
+  print('  {0:<28} {1:8.2f} ms'.format(label, elapsed * 1000.0))
+  return elapsed
+
+
+def main():
+  import argparse
+
+  parser = argparse.ArgumentParser(prog='bench_render',
+    description='Time rendering build.ninja with EmPy and with the native renderer.')
+  parser.add_argument('-n', '--objects', type=int, default=10000, dest='n_objects')
+  parser.add_argument('-p', '--packages', type=int, default=100, dest='n_pkgs')
+  args = parser.parse_args()
+
+  globls = make_globals(args.n_objects, args.n_pkgs)
+  out_dir = tempfile.mkdtemp(prefix='bench_render')
+  empy_path = os.path.join(out_dir, 'empy.ninja')
+  native_path = os.path.join(out_dir, 'native.ninja')
+
+  print('{0} objects in {1} packages'.format(args.n_objects, args.n_pkgs))
+  t_empy = timed('empy', lambda: render_empy(empy_path, globls))
+  t_native = timed('native', lambda: render_native(native_path, globls))
+  print('  speed-up: {0:.1f}x'.format(t_empy / t_native))
+
+  with open(empy_path) as a, open(native_path) as b:
+    identical = a.read() == b.read()
+  print('  output identical: {0}'.format(identical))
+
+  for path in (empy_path, native_path):
+    os.remove(path)
+  os.rmdir(out_dir)
+  if not identical:
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,109 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2020, kobbled
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+#
+# stand-in for the FTP server of a controller, to try kpush --native without
+# a robot (requires pyftpdlib)
+#
+# The server allows anonymous logins with write access, and has a directory
+# per device (md:, mf2:, fr:) that can be changed to like on a controller
+# ('cd md:\'). --latency adds a delay to every command, to mimic the
+# round-trip time of a controller.
+#
+# usage: python fake_controller.py [-p PORT] [--latency MS] [DIR]
+#
+
+import os
+import time
+import errno
+import logging
+import argparse
+import tempfile
+import threading
+
+from pyftpdlib.authorizers import DummyAuthorizer
+from pyftpdlib.filesystems import AbstractedFS
+from pyftpdlib.handlers import FTPHandler
+from pyftpdlib.servers import ThreadedFTPServer
+
+DEVICES = ['md:', 'mf2:', 'fr:']
+
+
+class ControllerFS(AbstractedFS):
+  # pyftpdlib changes the working directory of the process to check a CWD,
+  # which breaks the relative paths of a kpush in the same process
+  def chdir(self, path):
+    if not os.path.isdir(path):
+      raise OSError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+    self.cwd = self.fs2ftp(path)
+
+
+def make_handler(root, latency):
+  authorizer = DummyAuthorizer()
+  authorizer.add_anonymous(root, perm='elradfmwMT')
+
+  class ControllerHandler(FTPHandler):
+    def pre_process_command(self, line, cmd, arg):
+      if latency:
+        time.sleep(latency)
+      # 'cd md:\' changes to a device, wherever the session is
+      if cmd == 'CWD' and arg and arg.rstrip('\\/') in DEVICES:
+        arg = '/' + arg.rstrip('\\/')
+      return FTPHandler.pre_process_command(self, line, cmd, arg)
+
+  ControllerHandler.authorizer = authorizer
+  ControllerHandler.abstracted_fs = ControllerFS
+  return ControllerHandler
+
+
+def start(root, port=0, latency=0.0):
+  """Serve 'root' in a background thread. Returns the server, its port is
+  server.address[1].
+  """
+  for device in DEVICES:
+    if not os.path.isdir(os.path.join(root, device)):
+      os.makedirs(os.path.join(root, device))
+  server = ThreadedFTPServer(('127.0.0.1', port), make_handler(root, latency))
+  thread = threading.Thread(target=server.serve_forever, kwargs={'handle_exit': False})
+  thread.daemon = True
+  thread.start()
+  return server
+
+
+def main():
+  parser = argparse.ArgumentParser(prog='fake_controller',
+    description='Serve a directory as the FTP server of a controller.')
+  parser.add_argument('root', type=str, nargs='?', metavar='DIR',
+    help='directory with the devices (default: a temporary directory)')
+  parser.add_argument('-p', '--port', type=int, default=2121, dest='port')
+  parser.add_argument('--latency', type=float, default=0.0, dest='latency',
+    help='delay of every command, in ms (default: %(default)s)')
+  args = parser.parse_args()
+
+  logging.basicConfig(level=logging.WARNING)
+  root = args.root or tempfile.mkdtemp(prefix='controller')
+  server = start(root, args.port, args.latency / 1000.0)
+  print('serving {0} on 127.0.0.1:{1}, ctrl-c to stop'.format(root, server.address[1]))
+  try:
+    while True:
+      time.sleep(1)
+  except KeyboardInterrupt:
+    server.close_all()
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,173 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2020, kobbled
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+#
+# generator for synthetic rossum workspaces
+#
+# Packages are laid out in layers: the packages of the first layer are put in
+# the source space ('src'), all others in a library dir ('lib') that is meant
+# to be put on the ROSSUM_PKG_PATH. Packages only depend on packages in the
+# next layer. Every package has karel sources, a header declaring routines
+# (some of them formatted over multiple lines) and tp-interfaces to some of
+# those routines.
+#
+# usage: python make_workspace.py [-n PACKAGES] [-f FANOUT] [-d DEPTH]
+#                                 [-m SOURCES] [-r ROUTINES] [-i INTERFACES] DIR
+#
+
+import os
+import sys
+import json
+import random
+
+TYPES = ['INTEGER', 'REAL', 'BOOLEAN', 'STRING', 'XYZWPR', 'JOINTPOS']
+
+
+def layers(n_pkgs, depth):
+  """Split package indices 0..n_pkgs-1 into 'depth' layers of (about) the same
+  size.
+  """
+  depth = max(1, min(depth, n_pkgs))
+  size = n_pkgs // depth
+  bounds = [i * size for i in range(depth)] + [n_pkgs]
+  return [list(range(bounds[i], bounds[i+1])) for i in range(depth)]
+
+
+def routine_decl(rnd, pkg, idx):
+  """A routine declaration, with grouped parameters, multiple lines and
+  comments every now and then.
+  """
+  n_args = rnd.randint(0, 4)
+  params = []
+  for j in range(n_args):
+    params.append(('a{0}'.format(j), rnd.choice(TYPES)))
+  ret = rnd.choice(['', ' : INTEGER', ' : REAL', ' : XYZWPR'])
+  name = '{0}__routine{1}'.format(pkg, idx)
+
+  if n_args > 1 and idx % 3 == 0:
+    # group all parameters of the same type
+    groups = {}
+    for p, t in params:
+      groups.setdefault(t, []).append(p)
+    text = '; '.join('{0} : {1}'.format(', '.join(ps), t) for t, ps in groups.items())
+    params = [(p, t) for t, ps in groups.items() for p in ps]
+    decl = 'ROUTINE {0}({1}){2} FROM {3}'.format(name, text, ret, pkg)
+  elif n_args > 1 and idx % 3 == 1:
+    # one parameter per line
+    lines = ['{0} : {1}'.format(p, t) for p, t in params]
+    decl = 'ROUTINE {0}({1};  -- first argument\n    {2}){3} FROM {4}'.format(name, lines[0],
+      ';\n    '.join(lines[1:]), ret, pkg)
+  else:
+    text = '; '.join('{0} : {1}'.format(p, t) for p, t in params)
+    decl = 'ROUTINE {0}{1}{2} FROM {3}'.format(name, '({0})'.format(text) if params else '', ret, pkg)
+  return name, params, decl
+
+
+def make_package(rnd, root, name, deps, n_sources, n_routines, n_interfaces):
+  os.makedirs(os.path.join(root, 'src'))
+  os.makedirs(os.path.join(root, 'include'))
+
+  sources = []
+  for j in range(n_sources):
+    src = 'src/{0}_{1}.kl'.format(name, j)
+    with open(os.path.join(root, src), 'w') as f:
+      f.write('PROGRAM {0}_{1}\n%NOLOCKGROUP\n%include {0}.klh\nBEGIN\nEND {0}_{1}\n'.format(name, j))
+    sources.append(src)
+
+  decls = [routine_decl(rnd, name, k) for k in range(n_routines)]
+  with open(os.path.join(root, 'include', '{0}.klh'.format(name)), 'w') as f:
+    f.write('-- routines of {0}\n'.format(name))
+    for _, _, decl in decls:
+      f.write(decl + '\n')
+
+  interfaces = []
+  for k, (routine, params, _) in enumerate(rnd.sample(decls, min(n_interfaces, len(decls)))):
+    itf = {'routine': routine, 'program_name': '{0}_i{1}'.format(name[:6], k)}
+    if params and rnd.random() < 0.3:
+      itf['default_params'] = {str(len(params)): 1}
+    interfaces.append(itf)
+
+  manifest = {
+    'manver': '1',
+    'project': name,
+    'description': 'synthetic package',
+    'version': '0.0.1',
+    'source': sources,
+    'includes': ['include'],
+    'depends': deps,
+    'tp-interfaces': interfaces,
+  }
+  with open(os.path.join(root, 'package.json'), 'w') as f:
+    json.dump(manifest, f, indent=2)
+
+
+def make_workspace(out_dir, n_pkgs=100, fanout=3, depth=5, n_sources=10,
+                   n_routines=20, n_interfaces=5, seed=0):
+  """Generate a workspace in 'out_dir' (which must not exist yet). Returns
+  the paths of the source space and of the library dir.
+  """
+  rnd = random.Random(seed)
+  src_dir = os.path.join(out_dir, 'src')
+  lib_dir = os.path.join(out_dir, 'lib')
+  names = ['pkg{0:05d}'.format(i) for i in range(n_pkgs)]
+
+  tiers = layers(n_pkgs, depth)
+  for level, tier in enumerate(tiers):
+    below = tiers[level + 1] if level + 1 < len(tiers) else []
+    for i in tier:
+      deps = [names[d] for d in rnd.sample(below, min(fanout, len(below)))]
+      root = os.path.join(src_dir if level == 0 else lib_dir, names[i])
+      make_package(rnd, root, names[i], deps, n_sources, n_routines, n_interfaces)
+
+  # the build dir and a robot.ini, for configuring the workspace with rossum
+  os.makedirs(os.path.join(out_dir, 'build'))
+  with open(os.path.join(src_dir, 'robot.ini'), 'w') as f:
+    f.write('[WinOLPC_Util]\n'
+            'Robot=\\C\\robot\n'
+            'Version=V9.10-1\n'
+            'Path=C:\\tools\n'
+            'Support=C:\\support\n'
+            'Output=C:\\output\n'
+            'Ftp=127.0.0.1\n')
+  return src_dir, lib_dir
+
+
+def main():
+  import argparse
+
+  parser = argparse.ArgumentParser(prog='make_workspace',
+    description='Generate a synthetic rossum workspace.')
+  parser.add_argument('out_dir', type=str, metavar='DIR')
+  parser.add_argument('-n', '--packages', type=int, default=100, dest='n_pkgs')
+  parser.add_argument('-f', '--fanout', type=int, default=3, dest='fanout')
+  parser.add_argument('-d', '--depth', type=int, default=5, dest='depth')
+  parser.add_argument('-m', '--sources', type=int, default=10, dest='n_sources')
+  parser.add_argument('-r', '--routines', type=int, default=20, dest='n_routines')
+  parser.add_argument('-i', '--interfaces', type=int, default=5, dest='n_interfaces')
+  parser.add_argument('-s', '--seed', type=int, default=0, dest='seed')
+  args = parser.parse_args()
+
+  if os.path.exists(args.out_dir):
+    sys.exit("{0} already exists".format(args.out_dir))
+  src_dir, lib_dir = make_workspace(args.out_dir, args.n_pkgs, args.fanout, args.depth,
+    args.n_sources, args.n_routines, args.n_interfaces, args.seed)
+  print('source space: {0}'.format(src_dir))
+  print('ROSSUM_PKG_PATH: {0}'.format(lib_dir))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,2 @@
+@echo off
+python "%~dp0\kcache.py" %*
\ No newline at end of file
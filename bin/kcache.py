@@ -0,0 +1,436 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2020, kobbled
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+#
+# kcache - a compilation cache for ktransw (like ccache)
+#
+# usage: kcache KTRANSW [ktransw arguments]
+#        kcache (-s | -C)
+#
+# The cache key is a hash of the preprocessed source (ktransw -E), the core
+# version (/ver), the Karel support directory, the macros, ktrans and the
+# contents of robot.ini. On a hit the .pc (and .vr) files are copied (or
+# hardlinked) from the cache instead of running ktrans.
+#
+# Entries are spread over 256 directories of the cache. When a directory
+# gets larger than its share of the maximum size the least recently used
+# entries in it are removed.
+#
+
+import os
+import sys
+import json
+import time
+import uuid
+import shutil
+import hashlib
+import tempfile
+import subprocess
+
+
+KCACHE_VERSION = '1'
+
+ENV_CACHE_DIR = 'ROSSUM_KCACHE_DIR'
+ENV_MAX_SIZE = 'ROSSUM_KCACHE_MAXSIZE'
+ENV_HARDLINK = 'ROSSUM_KCACHE_HARDLINK'
+ENV_DISABLE = 'ROSSUM_KCACHE_DISABLE'
+
+DEFAULT_MAX_SIZE = '2G'
+SIZE_UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+# files in a cache entry, by the extension of the output
+ENTRY_FILES = ('pc', 'vr', 'd')
+# hit and miss counters, rewritten under the lock
+FILE_STATS = 'stats.json'
+FILE_STATS_LOCK = 'stats.lock'
+# seconds to wait for the lock before a hit or miss is not counted, and after
+# which a lock is considered left behind by a killed process
+LOCK_TIMEOUT = 1.0
+STALE_LOCK = 10.0
+TMP_DIR = 'tmp'
+SHARDS = 256
+# when a shard is full, evict until it is at this fraction of its limit
+EVICT_TO = 0.9
+
+
+def cache_dir():
+  if os.environ.get(ENV_CACHE_DIR):
+    return os.environ[ENV_CACHE_DIR]
+  base = os.environ.get('LOCALAPPDATA') or os.path.join(os.path.expanduser('~'), '.cache')
+  return os.path.join(base, 'rossum', 'kcache')
+
+
+def parse_size(text):
+  """'500M', '2G', or a number of bytes.
+  """
+  text = text.strip().upper().rstrip('B')
+  if text and text[-1] in SIZE_UNITS:
+    return int(float(text[:-1]) * SIZE_UNITS[text[-1]])
+  return int(text)
+
+
+def max_size():
+  return parse_size(os.environ.get(ENV_MAX_SIZE) or DEFAULT_MAX_SIZE)
+
+
+def format_size(size):
+  for unit in ('G', 'M', 'K'):
+    if size >= SIZE_UNITS[unit]:
+      return '{0:.1f} {1}B'.format(size / float(SIZE_UNITS[unit]), unit)
+  return '{0} B'.format(size)
+
+
+def parse_ktransw_args(args):
+  """Pick the arguments that matter to the cache out of the ktransw
+  command line. Returns a dict, or None if the invocation cannot be cached.
+
+  rossum always passes the Karel support directory as the last /I.
+  """
+  info = {'out': None, 'depfile': None, 'src': None, 'ver': None,
+          'config': None, 'ktrans': None, 'includes': [], 'macros': []}
+  i = 0
+  while i < len(args):
+    arg = args[i]
+    if arg == '-E':
+      # preprocessing is cheap, nothing to cache
+      return None
+    elif arg in ('-MT', '-MF', '/ver', '/config') and i + 1 < len(args):
+      key = {'-MT': 'out', '-MF': 'depfile', '/ver': 'ver', '/config': 'config'}[arg]
+      info[key] = args[i + 1]
+      i += 1
+    elif arg.startswith('--ktrans='):
+      info['ktrans'] = arg[len('--ktrans='):]
+    elif arg.startswith('/I') or arg.startswith('-I'):
+      info['includes'].append(arg[2:])
+    elif arg.startswith('/D') or arg.startswith('-D'):
+      info['macros'].append(arg[2:])
+    elif not arg.startswith('-') and arg.lower().endswith('.kl'):
+      info['src'] = arg
+    i += 1
+  if not info['src']:
+    return None
+  if not info['out']:
+    # ktrans writes the .pc to the working dir
+    info['out'] = os.path.splitext(os.path.basename(info['src']))[0] + '.pc'
+  return info
+
+
+def preprocess_args(args, info, depfile):
+  """The ktransw command line for only preprocessing the source. The
+  dependency file is written to 'depfile' instead of next to the output.
+  """
+  pp_args = []
+  i = 0
+  while i < len(args):
+    arg = args[i]
+    if arg in ('-MT', '-MF'):
+      i += 2
+      continue
+    if arg == info['src']:
+      arg = os.path.abspath(arg)
+    elif arg == info['config']:
+      arg = os.path.abspath(arg)
+    pp_args.append(arg)
+    i += 1
+  return ['-E', '-MT', info['out'], '-MF', depfile] + pp_args
+
+
+def hash_key(ktransw, args, info):
+  """Run the preprocessor and hash its output with everything else that
+  affects the translation. Returns (key, path of the dependency file
+  written by the preprocessor (or None)), or (None, None) if preprocessing
+  failed.
+
+  The preprocessor runs in a scratch directory, so whatever it writes there
+  is part of the preprocessed source.
+  """
+  h = hashlib.sha256()
+  h.update('kcache {0}\n'.format(KCACHE_VERSION).encode('utf-8'))
+  h.update('ver {0}\n'.format(info['ver']).encode('utf-8'))
+  h.update('support {0}\n'.format(info['includes'][-1] if info['includes'] else '').encode('utf-8'))
+  h.update('ktrans {0}\n'.format(info['ktrans']).encode('utf-8'))
+  for macro in info['macros']:
+    h.update('macro {0}\n'.format(macro).encode('utf-8'))
+  if info['config'] and os.path.isfile(info['config']):
+    with open(info['config'], 'rb') as f:
+      h.update(b'robot.ini\n' + f.read())
+
+  # the dependency file has to outlive the scratch dir
+  fd, depfile = tempfile.mkstemp(prefix='kcache', suffix='.d')
+  os.close(fd)
+  os.remove(depfile)
+  scratch = tempfile.mkdtemp(prefix='kcache')
+  try:
+    proc = subprocess.Popen([ktransw] + preprocess_args(args, info, depfile),
+      cwd=scratch, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, _ = proc.communicate()
+    if proc.returncode != 0:
+      return None, None
+    h.update(b'stdout\n' + out)
+    for name in sorted(os.listdir(scratch)):
+      path = os.path.join(scratch, name)
+      if os.path.isfile(path):
+        with open(path, 'rb') as f:
+          h.update(name.encode('utf-8') + b'\n' + f.read())
+    return h.hexdigest(), (depfile if os.path.isfile(depfile) else None)
+  finally:
+    shutil.rmtree(scratch, ignore_errors=True)
+
+
+def output_files(info):
+  """Output path per entry file.
+  """
+  base = os.path.splitext(info['out'])[0]
+  return {
+    'pc': info['out'],
+    'vr': base + '.vr',
+    'd': info['depfile'],
+  }
+
+
+def entry_path(root, key):
+  return os.path.join(root, key[:2], key)
+
+
+def lock(path):
+  """Take the lock file at 'path'. It is created exclusively, which works on
+  any (network) file system. Returns False if it cannot be taken within
+  LOCK_TIMEOUT seconds.
+  """
+  deadline = time.time() + LOCK_TIMEOUT
+  while True:
+    try:
+      os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+      return True
+    except (IOError, OSError):
+      pass
+    try:
+      if time.time() - os.path.getmtime(path) > STALE_LOCK:
+        os.remove(path)
+        continue
+    except (IOError, OSError):
+      pass
+    if time.time() > deadline:
+      return False
+    time.sleep(0.01)
+
+
+def read_stats(root):
+  try:
+    with open(os.path.join(root, FILE_STATS)) as f:
+      return json.load(f)
+  except (IOError, OSError, ValueError):
+    return {}
+
+
+def record(root, event):
+  """Count a hit ('hits') or miss ('misses') in the statistics. They are
+  best effort: if the lock cannot be taken the event is not counted.
+  """
+  lock_path = os.path.join(root, FILE_STATS_LOCK)
+  if not lock(lock_path):
+    return
+  try:
+    stats = read_stats(root)
+    stats[event] = stats.get(event, 0) + 1
+    stats_path = os.path.join(root, FILE_STATS)
+    with open(stats_path + '.tmp', 'w') as f:
+      json.dump(stats, f)
+    os.replace(stats_path + '.tmp', stats_path)
+  except (IOError, OSError):
+    pass
+  finally:
+    try:
+      os.remove(lock_path)
+    except (IOError, OSError):
+      pass
+
+
+def restore(entry, outputs, hardlink):
+  """Copy the files of a cache entry to the outputs. Returns False if the
+  entry is incomplete (ie: being evicted).
+
+  All outputs are removed first: an output the entry has no file for (ie: a
+  .vr) must not be left behind from an earlier translation.
+  """
+  if not os.path.isfile(os.path.join(entry, 'pc')):
+    return False
+  try:
+    for path in outputs.values():
+      if path and os.path.lexists(path):
+        os.remove(path)
+    for name in ENTRY_FILES:
+      src = os.path.join(entry, name)
+      dst = outputs[name]
+      if not dst or not os.path.isfile(src):
+        continue
+      # the dependency file is rewritten below, so it is always copied
+      if hardlink and name != 'd':
+        try:
+          os.link(src, dst)
+        except OSError:
+          shutil.copyfile(src, dst)
+      else:
+        shutil.copyfile(src, dst)
+      # ninja compares the outputs against the time of the inputs
+      os.utime(dst, None)
+    # mark as recently used
+    os.utime(entry, None)
+  except (IOError, OSError):
+    return False
+  return True
+
+
+def store(root, key, outputs):
+  """Add the outputs of a translation to the cache.
+  """
+  tmp = os.path.join(root, TMP_DIR, uuid.uuid4().hex)
+  os.makedirs(tmp)
+  try:
+    for name in ENTRY_FILES:
+      path = outputs[name]
+      if path and os.path.isfile(path):
+        shutil.copyfile(path, os.path.join(tmp, name))
+    entry = entry_path(root, key)
+    if not os.path.isdir(os.path.dirname(entry)):
+      os.makedirs(os.path.dirname(entry))
+    os.rename(tmp, entry)
+  except (IOError, OSError):
+    # another build stored the same entry first
+    shutil.rmtree(tmp, ignore_errors=True)
+    return
+  evict(os.path.dirname(entry), max_size() // SHARDS)
+
+
+def entry_size(entry):
+  return sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+
+
+def evict(shard, limit):
+  """Remove the least recently used entries of 'shard' if it is larger than
+  'limit'.
+  """
+  entries = []
+  for name in os.listdir(shard):
+    path = os.path.join(shard, name)
+    try:
+      entries.append((os.path.getmtime(path), entry_size(path), path))
+    except OSError:
+      continue
+  total = sum(size for _, size, _ in entries)
+  if total <= limit:
+    return
+  for _, size, path in sorted(entries):
+    shutil.rmtree(path, ignore_errors=True)
+    total -= size
+    if total <= limit * EVICT_TO:
+      break
+
+
+def translate(ktransw, args, outputs):
+  # whatever exists afterwards was written by this translation (and a
+  # hardlinked output would otherwise be changed in the cache as well)
+  for path in outputs.values():
+    if path and os.path.isfile(path):
+      os.remove(path)
+  return subprocess.call([ktransw] + args)
+
+
+def run(ktransw, args):
+  info = parse_ktransw_args(args)
+  if os.environ.get(ENV_DISABLE) or info is None:
+    return subprocess.call([ktransw] + args)
+
+  root = cache_dir()
+  if not os.path.isdir(root):
+    os.makedirs(root)
+  outputs = output_files(info)
+  key, deps = hash_key(ktransw, args, info)
+  if key is None:
+    # let ktransw report the errors
+    return translate(ktransw, args, outputs)
+
+  try:
+    if restore(entry_path(root, key), outputs, bool(os.environ.get(ENV_HARDLINK))):
+      # the dependencies of this source, not of the one that filled the entry
+      if deps and outputs['d']:
+        shutil.copyfile(deps, outputs['d'])
+      record(root, 'hits')
+      return 0
+
+    ret = translate(ktransw, args, outputs)
+    if ret == 0:
+      store(root, key, outputs)
+    record(root, 'misses')
+    return ret
+  finally:
+    if deps:
+      os.remove(deps)
+
+
+def show_stats(root):
+  stats = read_stats(root)
+  hits, misses = stats.get('hits', 0), stats.get('misses', 0)
+  entries = size = 0
+  if os.path.isdir(root):
+    for shard in os.listdir(root):
+      shard_path = os.path.join(root, shard)
+      if shard == TMP_DIR or not os.path.isdir(shard_path):
+        continue
+      for name in os.listdir(shard_path):
+        entries += 1
+        size += entry_size(os.path.join(shard_path, name))
+  total = hits + misses
+  print('cache directory      {0}'.format(root))
+  print('cache hits           {0}'.format(hits))
+  print('cache misses         {0}'.format(misses))
+  print('hit rate             {0:.1f} %'.format(100.0 * hits / total if total else 0.0))
+  print('entries              {0}'.format(entries))
+  print('cache size           {0} (max {1})'.format(format_size(size), format_size(max_size())))
+
+
+def main():
+  args = sys.argv[1:]
+  if args and args[0] in ('-s', '--show-stats', '-C', '--clear', '-h', '--help'):
+    import argparse
+
+    description=("A compilation cache for ktransw. Use as: kcache KTRANSW "
+      "[ktransw arguments]. The cache is stored in %{0}% (default: {1}), and "
+      "limited to %{2}% (default: {3}).".format(ENV_CACHE_DIR, cache_dir(),
+        ENV_MAX_SIZE, DEFAULT_MAX_SIZE))
+    parser = argparse.ArgumentParser(prog='kcache', description=description)
+    parser.add_argument('-s', '--show-stats', action='store_true', dest='show_stats',
+      help='show the hit rate and size of the cache')
+    parser.add_argument('-C', '--clear', action='store_true', dest='clear',
+      help='remove all entries and statistics from the cache')
+    opts = parser.parse_args(args)
+
+    root = cache_dir()
+    if opts.clear and os.path.isdir(root):
+      shutil.rmtree(root)
+    if opts.show_stats:
+      show_stats(root)
+    return 0
+
+  if not args:
+    sys.stderr.write('usage: kcache KTRANSW [ktransw arguments]\n')
+    return 2
+  return run(args[0], args[1:])
+
+
+if __name__ == '__main__':
+  sys.exit(main())
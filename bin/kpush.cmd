@@ -1,3 +1,3 @@
 @echo off
 python "%~dp0\kpush.py" %*
-ftp -s:ftp.txt
\ No newline at end of file
+if exist ftp.txt ftp -s:ftp.txt
\ No newline at end of file
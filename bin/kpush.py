@@ -17,12 +17,26 @@
 
 import os
 import em
+import sys
+import json
+import time
 import yaml
+import queue
+import socket
+import ftplib
+import hashlib
+import threading
 import collections
 import fileinput
 from ordered_set import OrderedSet
 
 FILE_MANIFEST = '.man_log'
+# what was last pushed to each controller: {ip: {file: [category, sha1]}}
+FILE_LEDGER = '.kpush_ledger'
+# what the last ftp.txt for each controller pushes, until the next kpush finds
+# it on the controller: {ip: {'ledger': {...}, 'put': {file: category},
+# 'deleted': {file: category}}}
+FILE_LEDGER_PENDING = '.kpush_ledger.pending'
 
 FTP_FILE_NAME='ftp.txt'
 FTP_FILE_TEMPLATE_NAME='templates\\ftp.txt.em'
@@ -35,6 +49,19 @@ tpext = ['.ls', '.tp']
 formsext = ['.tx']
 dataext = ['.xml', '.csv']
 
+# categories of the sorted manifest that are put on the controller
+# ('karelvr' files are only deleted)
+PUT_CATEGORIES = ('karel', 'tp', 'interface', 'forms', 'data')
+# controller device every category is stored on
+DEVICES = {
+  'karel' : 'md:\\',
+  'karelvr' : 'md:\\',
+  'tp' : 'md:\\',
+  'interface' : 'md:\\',
+  'forms' : 'mf2:\\',
+  'data' : 'fr:\\',
+}
+
 def main():
   import argparse
 
@@ -47,33 +74,53 @@ def main():
         help='Be verbose')
   parser.add_argument('-d', '--delete', action='store_true', dest='only_delete',
         help='delete batch off of controller', default=False)
+  parser.add_argument('--full', action='store_true', dest='full',
+        help='push all files, not only the ones that changed since the last push')
+  parser.add_argument('-n', '--native', action='store_true', dest='native',
+        help='transfer the files with the built-in FTP client (one session, '
+        'with retries), instead of writing {0} for the Windows ftp client'.format(FTP_FILE_NAME))
+  parser.add_argument('--no-list', action='store_true', dest='no_list',
+        help='do not list the files on the controller first, delete every '
+        'file that is put or removed whether it is there or not')
+  parser.add_argument('--port', type=int, dest='port', default=21,
+        help='FTP port of the controller (default: %(default)s)')
+  parser.add_argument('--retries', type=int, dest='retries', default=2,
+        help='number of times a failed transfer is retried (default: %(default)s)')
+  parser.add_argument('--timeout', type=float, dest='timeout', default=30.0,
+        help='FTP timeout in seconds (default: %(default)s)')
+  parser.add_argument('-j', '--jobs', type=int, dest='jobs', default=1,
+        help='number of FTP sessions to transfer files over in parallel '
+        '(--native only, default: %(default)s)')
+  parser.add_argument('--max-sessions', type=int, dest='max_sessions',
+        default=DEFAULT_MAX_SESSIONS,
+        help='number of FTP sessions the controller allows, --jobs is '
+        'limited to this (default: %(default)s)')
   args = parser.parse_args()
 
   #initialize sorted manifest
-  ftpManifest = {
-    'karel' : OrderedSet(),
-    'karelvr' : OrderedSet(),
-    'tp' : OrderedSet(),
-    'forms' : OrderedSet(),
-    'data' : OrderedSet(),
-    'interface' : OrderedSet(),
-  }
+  ftpManifest = new_manifest()
   #get build directory
   build_dir   = os.path.abspath(os.getcwd())
   #get ftp template directory
   template_ftp_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), FTP_FILE_TEMPLATE_NAME)
   #get ftp output directory
   ftp_file_path = os.path.join(build_dir, FTP_FILE_NAME)
+  #kpush.cmd runs the ftp client if there is a script, never the one of an
+  #earlier push
+  if os.path.exists(ftp_file_path):
+    os.remove(ftp_file_path)
 
   #load file manifest
   with open(FILE_MANIFEST) as man:
     file_list = yaml.load(man, Loader=yaml.FullLoader)
 
   #sort files from build manifest into containers for ftp template
+  children_set = set()
   for key in file_list.keys():
     if (key in DATA_TYPES) and isinstance(file_list[key], dict):
       sub_dict = file_list[key]
       for parent, children in sub_dict.items():
+        children_set.update(children)
         ext = os.path.splitext(parent)[-1]
         if ext in formsext:
           for child in children:
@@ -84,27 +131,514 @@ def main():
         #sort parent last for dependencies
         sortfile(key, parent, ftpManifest, args)
   
-  # write out ftp push template
-  with open(ftp_file_path, 'w') as ftp_fl:
-    globls = {
-        'ip' : file_list['ip'],
-        'files'   : ftpManifest,
-        'delete_only' : args.only_delete
-    }
-    ftp_interp = em.Interpreter(
-            output=ftp_fl, globals=dict(globls),
-            options={em.RAW_OPT : True, em.BUFFERED_OPT : True})
-    ftp_interp.file(open(template_ftp_path))
-    ftp_interp.shutdown()
+  #only push what changed since the last push to this controller
+  ip = str(file_list['ip'])
+  ledger = load_ledger(FILE_LEDGER)
+  #what the last ftp.txt pushed, if the listing shows it was run
+  pending = load_ledger(FILE_LEDGER_PENDING).get(ip)
+  skip = ('interface',) if args.exclude_interface else ()
+  uploads, deletes, pushed = plan_push(ftpManifest, ledger.get(ip, {}),
+                                       args.full, args.only_delete, skip)
+
+  sessions = []
+  if args.native:
+    n_sessions = max(1, min(args.jobs, args.max_sessions))
+    sessions = [ControllerSession(ip, args.port, args.timeout, args.retries)
+                for _ in range(n_sessions)]
+
+  #only delete what is on the controller. The built-in client overwrites the
+  #files it puts (and falls back to delete + put for a loaded program), the ftp
+  #client cannot and deletes them first.
+  gone = []
+  if not args.no_list:
+    session = sessions[0] if sessions else ControllerSession(
+      ip, args.port, args.timeout, args.retries)
+    try:
+      listing = fetch_listing(session, plan_devices(ftpManifest, deletes, pending))
+    except ConnectFailedException as e:
+      sys.exit("kpush: {0}".format(e))
+    except ftplib.all_errors as e:
+      print("kpush: could not list the files on {0} ({1}), deleting without "
+            "a listing".format(ip, e))
+    else:
+      pop_pending(FILE_LEDGER_PENDING, ip)
+      if pending is not None and confirm_pending(pending, listing):
+        ledger[ip] = pending['ledger']
+        save_ledger(FILE_LEDGER, ledger)
+        uploads, deletes, pushed = plan_push(ftpManifest, ledger[ip],
+                                             args.full, args.only_delete, skip)
+      elif pending is not None:
+        print("kpush: the last {0} did not complete, pushing its files "
+              "again".format(FTP_FILE_NAME))
+      uploads, deletes, gone = apply_listing(ftpManifest, uploads, deletes, listing,
+                                             args.only_delete, args.native)
+    finally:
+      if not sessions:
+        session.close()
+
+  print("kpush: {0} file(s) to put, {1} to delete on {2}".format(
+    sum(len(uploads[c]) for c in PUT_CATEGORIES),
+    sum(len(deletes[c]) for c in PUT_CATEGORIES + ('karelvr',)), ip))
+
+  if args.native:
+    #the ledger is updated by the push itself
+    pop_pending(FILE_LEDGER_PENDING, ip)
+    ledger_ip = ledger.setdefault(ip, {})
+    #files that are not on the controller need no delete
+    for fl in gone:
+      ledger_ip.pop(fl, None)
+    try:
+      failed = push_native(sessions, transfer_plan(uploads, deletes, children_set),
+                           pushed, ledger_ip)
+    finally:
+      for session in sessions:
+        session.close()
+      save_ledger(FILE_LEDGER, ledger)
+    if failed:
+      sys.exit(1)
+    return
+
+  # write out ftp push template, kpush.cmd must not find a partial script
+  tmp_ftp_file_path = ftp_file_path + '.tmp'
+  try:
+    with open(template_ftp_path) as template_fl, open(tmp_ftp_file_path, 'w') as ftp_fl:
+      globls = {
+          'ip' : file_list['ip'],
+          'files'   : uploads,
+          'deletes' : deletes,
+          'delete_only' : args.only_delete
+      }
+      ftp_interp = em.Interpreter(
+              output=ftp_fl, globals=dict(globls),
+              options={em.RAW_OPT : True, em.BUFFERED_OPT : True})
+      ftp_interp.file(template_fl)
+      ftp_interp.shutdown()
+
+    #remove all blank lines
+    for line in fileinput.FileInput(tmp_ftp_file_path,inplace=1):
+      if line.rstrip():
+          print(line)
+  except:
+    if os.path.exists(tmp_ftp_file_path):
+      os.remove(tmp_ftp_file_path)
+    raise
 
   #delete .bak file
   if os.path.exists(ftp_file_path + ".bak"):
     os.remove(ftp_file_path + ".bak")
 
-  #remove all blank lines
-  for line in fileinput.FileInput(ftp_file_path,inplace=1):
-    if line.rstrip():
-        print(line)
+  os.replace(tmp_ftp_file_path, ftp_file_path)
+
+  #the ftp script is run right after this, but cannot report failed transfers.
+  #What it pushes only goes into the ledger once the listing of the next kpush
+  #finds it on the controller.
+  put = dict((fl, cat) for cat in PUT_CATEGORIES for fl in uploads[cat])
+  pending_ledger = load_ledger(FILE_LEDGER_PENDING)
+  pending_ledger[ip] = {
+    'ledger' : pushed,
+    'put' : put,
+    'deleted' : dict((fl, cat) for cat in PUT_CATEGORIES for fl in deletes[cat]
+                     if fl not in put),
+  }
+  save_ledger(FILE_LEDGER_PENDING, pending_ledger)
+
+
+# number of FTP sessions a controller serves at the same time
+DEFAULT_MAX_SESSIONS = 3
+
+# errors after which a transfer is retried on a new connection
+CONNECTION_ERRORS = (ftplib.error_temp, ftplib.error_reply, socket.error, EOFError)
+
+
+class ConnectFailedException(Exception):
+  """The controller cannot be connected to, or refused the login."""
+  pass
+
+
+class ControllerSession:
+  """One FTP session with a controller, kept open for all transfers.
+  Transfers that fail because the connection dropped (or timed out) are
+  retried on a new connection, after changing back to the same device. If no
+  connection can be made, or the login is refused, ConnectFailedException is
+  raised.
+  """
+
+  def __init__(self, host, port=21, timeout=30.0, retries=2):
+    self.host = host
+    self.port = port
+    self.timeout = timeout
+    self.retries = retries
+    self.ftp = None
+    self.device = None
+
+  def connect(self):
+    ftp = ftplib.FTP(timeout=self.timeout)
+    try:
+      ftp.connect(self.host, self.port)
+      ftp.login()
+      ftp.voidcmd('TYPE I')
+    except:
+      ftp.close()
+      raise
+    self.ftp = ftp
+    if self.device:
+      ftp.cwd(self.device)
+
+  def close(self):
+    if self.ftp is not None:
+      try:
+        self.ftp.quit()
+      except ftplib.all_errors:
+        self.ftp.close()
+      self.ftp = None
+
+  def run(self, fn):
+    """Run 'fn' with the open connection, reconnecting and retrying on
+    connection errors. Permanent (5xx) replies are not retried.
+    """
+    for attempt in range(self.retries + 1):
+      try:
+        if self.ftp is None:
+          self.connect()
+        return fn(self.ftp)
+      except ftplib.error_perm as e:
+        if self.ftp is None:
+          raise ConnectFailedException("{0} refused the login: {1}".format(self.host, e))
+        raise
+      except CONNECTION_ERRORS as e:
+        connected = self.ftp is not None
+        if connected:
+          self.ftp.close()
+          self.ftp = None
+        if attempt == self.retries:
+          if not connected:
+            raise ConnectFailedException("could not connect to {0}: {1}".format(self.host, e))
+          raise
+        print("kpush: {0}, retrying".format(e))
+        time.sleep(0.5 * (attempt + 1))
+
+  def cd(self, device):
+    if device != self.device:
+      self.run(lambda ftp: ftp.cwd(device))
+      self.device = device
+
+  def put(self, fl):
+    with open(fl, 'rb') as f:
+      def store(ftp):
+        f.seek(0)
+        return ftp.storbinary('STOR ' + os.path.basename(fl), f)
+      return self.run(store)
+
+  def listing(self, device):
+    """Names of the files on 'device', in lower case (the controller does not
+    keep the case of file names).
+    """
+    self.cd(device)
+    try:
+      names = self.run(lambda ftp: ftp.nlst())
+    except ftplib.error_perm as e:
+      if str(e).startswith('550'):
+        # an empty device
+        return set()
+      # no NLST, the name is the last column of LIST
+      lines = []
+      self.run(lambda ftp: ftp.retrlines('LIST', lines.append))
+      names = [line.split()[-1] for line in lines if line.strip()]
+    return set(os.path.basename(name.replace('\\', '/')).split(':')[-1].lower()
+               for name in names)
+
+  def delete(self, fl):
+    """Returns False if the file did not exist.
+    """
+    try:
+      self.run(lambda ftp: ftp.delete(os.path.basename(fl)))
+    except ftplib.error_perm as e:
+      if str(e).startswith('550'):
+        return False
+      raise
+    return True
+
+
+def transfer_plan(uploads, deletes, children=()):
+  """The transfers of a push, as a list of waves. The transfers of a wave
+  can run in any order (and in parallel), a wave only starts when the one
+  before it is done:
+
+   1. delete the programs, tp, form and data files that are replaced or
+      removed
+   2. delete the variable files of the deleted (or replaced) programs
+   3. put the files that are 'children' of other files
+   4. put the other files (the parents)
+
+  Transfers are (device, action, file, category) tuples.
+  """
+  def put(files):
+    return [(DEVICES[cat], 'put', fl, cat) for cat in PUT_CATEGORIES
+            for fl in uploads[cat] if files(fl)]
+
+  waves = [
+    [(DEVICES[cat], 'delete', fl, cat) for cat in PUT_CATEGORIES for fl in deletes[cat]],
+    [(DEVICES['karelvr'], 'delete', fl, 'karelvr') for fl in deletes['karelvr']],
+    put(lambda fl: fl in children),
+    put(lambda fl: fl not in children),
+  ]
+  return [wave for wave in waves if wave]
+
+
+def push_native(sessions, waves, pushed, ledger):
+  """Run the transfers of 'waves' over 'sessions', which each take the next
+  transfer of the current wave until it is done. 'ledger' is updated after
+  every successful transfer: a deleted file is removed from it, a put file
+  gets its entry of 'pushed'. A refused transfer is skipped, if the
+  connection of a session cannot be (re)established, or the login is refused,
+  the push is aborted.
+
+  Returns the number of failed (or not attempted) transfers.
+  """
+  lock = threading.Lock()
+  totals = {'failed': 0, 'puts': 0, 'bytes': 0, 'aborted': False}
+
+  def transfer(session, device, action, fl, cat):
+    session.cd(device)
+    if action == 'delete':
+      session.delete(fl)
+      with lock:
+        ledger.pop(fl, None)
+      return
+    t = time.time()
+    try:
+      session.put(fl)
+    except ftplib.error_perm:
+      # a loaded program cannot be overwritten, replace it
+      if not session.delete(fl):
+        raise
+      session.put(fl)
+    size = os.path.getsize(fl)
+    with lock:
+      ledger[fl] = pushed[fl]
+      totals['puts'] += 1
+      totals['bytes'] += size
+      print("  put {0}{1} ({2:.1f} KB, {3:.1f} KB/s)".format(device, fl, size / 1024.0,
+        size / 1024.0 / max(time.time() - t, 1e-6)))
+
+  def worker(session, todo):
+    while not totals['aborted']:
+      try:
+        device, action, fl, cat = todo.get_nowait()
+      except queue.Empty:
+        return
+      try:
+        transfer(session, device, action, fl, cat)
+      except ftplib.error_perm as e:
+        with lock:
+          print("kpush: could not {0} {1}{2}: {3}".format(action, device, fl, e))
+          totals['failed'] += 1
+      except ConnectFailedException as e:
+        with lock:
+          print("kpush: {0}, aborting".format(e))
+          totals['failed'] += 1
+          totals['aborted'] = True
+      except CONNECTION_ERRORS as e:
+        with lock:
+          print("kpush: could not {0} {1}{2}: {3}, aborting".format(action, device, fl, e))
+          totals['failed'] += 1
+          totals['aborted'] = True
+
+  n_transfers = sum(len(wave) for wave in waves)
+  done = 0
+  start = time.time()
+  for wave in waves:
+    todo = queue.Queue()
+    for t in wave:
+      todo.put(t)
+    threads = [threading.Thread(target=worker, args=(session, todo))
+               for session in sessions[:len(wave)]]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    done += len(wave)
+    if totals['aborted']:
+      # the rest of this wave, and all later waves
+      totals['failed'] += todo.qsize() + n_transfers - done
+      break
+  elapsed = time.time() - start
+  print("kpush: {0} transfer(s) over {1} session(s) in {2:.1f} s, {3} put ({4:.1f} KB, "
+    "{5:.1f} KB/s), {6} failed".format(n_transfers, len(sessions),
+      elapsed, totals['puts'], totals['bytes'] / 1024.0,
+      totals['bytes'] / 1024.0 / max(elapsed, 1e-6), totals['failed']))
+  return totals['failed']
+
+
+def new_manifest():
+  return {
+    'karel' : OrderedSet(),
+    'karelvr' : OrderedSet(),
+    'tp' : OrderedSet(),
+    'forms' : OrderedSet(),
+    'data' : OrderedSet(),
+    'interface' : OrderedSet(),
+  }
+
+
+def file_digest(fl):
+  """sha1 of a file in the build directory, None if it does not exist.
+  """
+  try:
+    with open(fl, 'rb') as f:
+      return hashlib.sha1(f.read()).hexdigest()
+  except (IOError, OSError):
+    return None
+
+
+def load_ledger(path):
+  if not os.path.exists(path):
+    return {}
+  try:
+    with open(path) as f:
+      return json.load(f)
+  except ValueError:
+    print("kpush: ignoring unreadable {0}, pushing all files".format(path))
+    return {}
+
+
+def save_ledger(path, ledger):
+  tmp_path = path + '.tmp'
+  with open(tmp_path, 'w') as f:
+    json.dump(ledger, f, indent=1, sort_keys=True)
+  os.replace(tmp_path, path)
+
+
+def pop_pending(path, ip):
+  """Take the pending push to 'ip' out of the pending ledger at 'path'.
+  Returns None if there is none.
+  """
+  if not os.path.exists(path):
+    return None
+  pending = load_ledger(path)
+  entry = pending.pop(ip, None)
+  if pending:
+    save_ledger(path, pending)
+  else:
+    os.remove(path)
+  return entry
+
+
+def plan_push(manifest, pushed, full=False, delete_only=False, skip=()):
+  """Compare the sorted 'manifest' with the files 'pushed' to the controller
+  before ({file: [category, sha1]}). Returns the files to put and the files to
+  delete (both sorted like 'manifest'), and what will have been pushed after.
+
+  Changed files are deleted before they are put again (as a loaded program
+  cannot be overwritten), files no longer in the manifest are deleted.
+  Categories in 'skip' are left alone.
+  """
+  uploads = new_manifest()
+  deletes = new_manifest()
+  after = {}
+
+  current = {}
+  for cat in PUT_CATEGORIES:
+    for fl in manifest[cat]:
+      current[fl] = [cat, file_digest(fl)]
+
+  for cat in PUT_CATEGORIES:
+    for fl in manifest[cat]:
+      digest = current[fl][1]
+      if delete_only:
+        deletes[cat].add(fl)
+      elif digest is None:
+        # not build (yet), leave it as it is on the controller
+        if fl in pushed:
+          after[fl] = pushed[fl]
+      elif full or pushed.get(fl) != current[fl]:
+        deletes[cat].add(fl)
+        uploads[cat].add(fl)
+        after[fl] = current[fl]
+      else:
+        after[fl] = current[fl]
+
+  for fl, (cat, digest) in sorted(pushed.items()):
+    if fl in current:
+      continue
+    if cat in skip:
+      after[fl] = [cat, digest]
+    else:
+      deletes[cat].add(fl)
+
+  # the variables of a program are reset along with it
+  for fl in list(deletes['karel']) + list(deletes['interface']):
+    deletes['karelvr'].add(os.path.splitext(fl)[0] + '.vr')
+
+  return uploads, deletes, after
+
+
+def plan_devices(manifest, deletes, pending=None):
+  """The devices a push with 'manifest' and 'deletes' touches, and those of
+  the files of the 'pending' push.
+  """
+  devices = set(DEVICES[cat] for cat in DEVICES if manifest[cat] or deletes[cat])
+  if pending is not None:
+    for files in (pending['put'], pending['deleted']):
+      devices.update(DEVICES[cat] for cat in files.values())
+  return sorted(devices)
+
+
+def fetch_listing(session, devices):
+  """One listing of each of 'devices': {device: set of file names}.
+  """
+  return dict((device, session.listing(device)) for device in devices)
+
+
+def is_listed(listing, cat, fl):
+  return fl.lower() in listing.get(DEVICES[cat], ())
+
+
+def confirm_pending(pending, listing):
+  """True if 'listing' shows the ftp.txt of the 'pending' push was run: the
+  files it put are on the controller and the files it deleted are not.
+  """
+  return (all(is_listed(listing, cat, fl) for fl, cat in pending['put'].items()) and
+          not any(is_listed(listing, cat, fl) for fl, cat in pending['deleted'].items()))
+
+
+def apply_listing(manifest, uploads, deletes, listing, delete_only=False,
+                  overwrite=False):
+  """Narrow the plan of plan_push down to what 'listing' (of fetch_listing)
+  says is on the controller: a file is only deleted if it is there, and with
+  'overwrite' only if it is not replaced by a put anyway (the variable files
+  of replaced programs are still deleted). The files of 'manifest' that are
+  missing from the controller are put again, changed or not.
+
+  Returns the new uploads and deletes, and the deletes that were dropped
+  because the file is not on the controller.
+  """
+  new_uploads = new_manifest()
+  new_deletes = new_manifest()
+  gone = []
+  for cat in PUT_CATEGORIES:
+    #keep the order of the manifest, children before parents
+    for fl in manifest[cat]:
+      if fl in uploads[cat] or (not delete_only and not is_listed(listing, cat, fl)
+                                and os.path.exists(fl)):
+        new_uploads[cat].add(fl)
+    for fl in deletes[cat]:
+      if not is_listed(listing, cat, fl):
+        gone.append(fl)
+      elif not (overwrite and fl in new_uploads[cat]):
+        new_deletes[cat].add(fl)
+  for fl in deletes['karelvr']:
+    if is_listed(listing, 'karelvr', fl):
+      new_deletes['karelvr'].add(fl)
+    else:
+      gone.append(fl)
+
+  n_skipped = sum(len(deletes[c]) - len(new_deletes[c]) for c in DEVICES)
+  n_missing = sum(len(new_uploads[c]) - len(uploads[c]) for c in PUT_CATEGORIES)
+  if n_skipped or n_missing:
+    print("kpush: {0} delete(s) skipped (overwritten or not on the controller), "
+          "{1} missing file(s) put again".format(n_skipped, n_missing))
+  return new_uploads, new_deletes, gone
 
 
 def sortfile(typ, fl, manifest, args):
@@ -31,12 +31,20 @@ import datetime
 import os, shutil
 import sys
 import json
+import copy
+import hashlib
 import yaml
 import configparser
 import fnmatch
+import filecmp
+import lark
 from send2trash import send2trash
 
 import collections
+import concurrent.futures
+import threading
+import time
+import atexit
 
 import logging
 logger=None
@@ -66,14 +74,42 @@ DICT_SUFFIX = 'utx'
 COMPRESSED_SUFFIX = 'tx'
 
 FILE_MANIFEST = '.man_log'
+FILE_CACHE = '.rossum_cache'
+FILE_FINGERPRINT = '.rossum_fingerprint'
+FILE_INVOCATION = '.rossum_args'
+FILE_OBJECTS = '.rossum_objects'
+FILE_NINJA_LOG = '.ninja_log'
+# ninja pools that can be configured, and the rules that run in them
+NINJA_POOLS = collections.OrderedDict([
+    ('karel', ['ktrans_pc']),
+    ('tp',    ['maketp_tp', 'tpp_tp', 'tpp_ls']),
+    ('forms', ['utx_tx', 'ftx_tx']),
+])
+# optional robot.ini section with the depths of the pools, ie: karel = 4
+ROBOT_INI_POOLS_SECTION = 'Pools'
+
+# directory in the build dir for the per package build files (--subninja)
+SUBNINJA_DIR = 'packages'
+# the key of the build statements in every per package build file
+FILE_SUBNINJA_KEYS = '.rossum_packages'
+
+# outputs of dependency packages that can be shared through an artifact
+# store (--artifacts), by object type: .pc, .tx and .xml/.csv files
+ARTIFACT_TYPES = ('src', 'forms', 'data')
+ARTIFACT_FORMAT = 1
+# the packages of the last configuration that can be published to the store
+FILE_ARTIFACTS = '.rossum_artifacts'
+ARTIFACT_INFO_NAME = 'artifact.json'
 
 
 ENV_PKG_PATH='ROSSUM_PKG_PATH'
 ENV_DEFAULT_CORE_VERSION='ROSSUM_CORE_VERSION'
 ENV_SERVER_IP='ROSSUM_SERVER_IP'
+ENV_ARTIFACTS='ROSSUM_ARTIFACTS'
 
 BUILD_FILE_NAME='build.ninja'
 BUILD_FILE_TEMPLATE_NAME='templates\\build.ninja.em'
+PACKAGE_TEMPLATE_NAME='templates\\package.ninja.em'
 
 FANUC_SEARCH_PATH = [
     'C:\\Program Files\\Fanuc',
@@ -90,10 +126,13 @@ if BUILD_STANDALONE:
   KTRANSW_BIN_NAME='ktransw.exe'
   XML_BIN_NAME='yamljson2xml.exe'
   KCDICT_BIN_NAME='kcdictw.exe'
+  # kcache has its own folder in the release folder, next to that of rossum
+  KCACHE_BIN_NAME='kcache\\kcache.exe'
 else:
   KTRANSW_BIN_NAME='ktransw.cmd'
   XML_BIN_NAME='yamljson2xml.cmd'
   KCDICT_BIN_NAME='kcdictw.cmd'
+  KCACHE_BIN_NAME='kcache.cmd'
 
 
 KTRANS_SEARCH_PATH = [
@@ -112,6 +151,45 @@ DEFAULT_CORE_VERSION='V7.70-1'
 
 ROSSUM_IGNORE_NAME='ROSSUM_IGNORE'
 
+HEADER_SUFFIX = 'klh'
+
+# routine declarations in headers, ie:
+#   ROUTINE func01(p : XYZWPR; i, j : INTEGER) : INTEGER FROM source
+# declarations may span multiple lines and contain comments. This pattern
+# only locates them, they are parsed with ROUTINE_DECL_GRAMMAR.
+ROUTINE_DECL_PATTERN = re.compile(r"^[ \t]*ROUTINE\s+\w+\s*(?:\([^)]*\))?\s*(?::[^()\n]*?)?\s*\bFROM\s+\w+",
+    re.IGNORECASE | re.MULTILINE)
+
+ROUTINE_DECL_GRAMMAR = r'''
+    decl: _ROUTINE NAME params? return_type? _FROM NAME
+    params: "(" (group (";" group)*)? ")"
+    group: NAME ("," NAME)* ":" type
+    return_type: ":" type
+    type: type_word+
+    type_word: NAME dims?
+    dims: "[" DIM ("," DIM)* "]"
+
+    _ROUTINE.2: /ROUTINE\b/i
+    _FROM.2: /FROM\b/i
+    NAME: /[A-Za-z_]\w*/
+    DIM: /[0-9]+|\*|[A-Za-z_]\w*/
+    COMMENT: /--[^\n]*/
+
+    %ignore COMMENT
+    %ignore /\s+/
+'''
+
+# bump whenever the layout of the on-disk cache changes
+CACHE_VERSION=4
+
+# time stamp in the header of the build file, ignored when checking whether
+# the build file changed
+BUILD_FILE_TSTAMP_PATTERN = re.compile(r" at \d{4}-\d\d-\d\dT[0-9:.]+(?=\.$)", re.MULTILINE)
+
+# command line options that have no influence on the generated build file
+FINGERPRINT_IGNORED_ARGS = ('verbose', 'quiet', 'dry_run', 'force', 'no_cache',
+    'profile', 'profile_format', 'stats', 'top', 'json', 'publish')
+
 
 
 class MissingKtransException(Exception):
@@ -132,6 +210,10 @@ KtransWInfo = collections.namedtuple('KtransWInfo', 'path')
 
 KtransRobotIniInfo = collections.namedtuple('KtransRobotIniInfo', 'path ftp env')
 
+# how the build file can regenerate itself: the command to run, and the files
+# that should trigger regeneration when they change
+RossumRegenInfo = collections.namedtuple('RossumRegenInfo', 'command inputs')
+
 # In-memory representation of raw data from a parsed rossum manifest
 RossumManifest = collections.namedtuple('RossumManifest',
     'depends '
@@ -160,6 +242,7 @@ RossumPackage = collections.namedtuple('RossumPackage',
     'dependencies ' # list of pkg names that this pkg depends on
     'include_dirs ' # list of (absolute) dirs that contain headers this pkg needs
     'location '     # absolute path to root dir of pkg
+    'manifest_path ' # absolute path to the manifest of this pkg
     'manifest '     # the rossum manifest of this pkg
     'objects '      # list of (src, obj) tuples
     'tests '         # list of (src, obj) tuples for tests
@@ -189,7 +272,8 @@ robotiniInfo = collections.namedtuple('robotiniInfo',
     'support '
     'output '
     'ftp ' # ftp address where the robot server resides
-    'env' # environment file location for tp-plus
+    'env ' # environment file location for tp-plus
+    'pools' # depths of ninja pools, per pool name (optional [Pools] section)
     )
 
 # container datatype for graph class
@@ -199,6 +283,14 @@ packages = collections.namedtuple('packages',
     'inSource'
 )
 
+# KAREL routine declaration found in a header (.klh) file
+KarelRoutine = collections.namedtuple('KarelRoutine',
+    'name '
+    'file '        # absolute path to the header that declares the routine
+    'arguments '   # list of (name, type) tuples, ie: ('s', 'STRING[16]')
+    'return_type'  # type of the return value, or '' if there is none
+)
+
 #TP program routine interfaces
 TPInterfaces = collections.namedtuple('TPInterfaces',
     'name '
@@ -210,6 +302,52 @@ TPInterfaces = collections.namedtuple('TPInterfaces',
     'return_type'
 )
 
+# Karel program generated for a tp-interface (see compile_interface)
+TPProgram = collections.namedtuple('TPProgram',
+    'alias '      # name of the program
+    'variables '  # list of (name, type) declarations
+    'includes '   # headers to %include
+    'imports '    # list of (header, routines) to %from .. %import
+    'arguments '  # list of (index, argument, variable, getter, default) tpe arguments
+    'poses '      # list of (argument, routine, parameters) reading pose arguments
+    'ret_index '  # index of the tpe argument with the return register, or None
+    'grp_index '  # index of the tpe argument with the group of a returned pose, or None
+    'call'        # statement that calls the routine (and stores its result)
+)
+
+TP_POSE_TYPES = ('position', 'xyzwpr', 'jointpos', 'vector')
+# suffix of the pose__get_posreg_* routine per pose type
+TP_POSE_ACCESSORS = {'position': 'xyz', 'xyzwpr': 'xyz', 'jointpos': 'joint'}
+
+# first line of every generated program, which tells them apart from the
+# programs written by hand (see remove_orphaned_interfaces). This is a
+# deliberate change of the output: programs generated by 0.1.7 did not have
+# it, and nothing else in them is specific enough to tell them apart from a
+# hand written program, so those are rewritten once on the first run
+TP_GENERATED_MARKER = '-- generated by rossum from the tp-interfaces of package.json, do not edit'
+
+# template of the generated program, and of the lines it is made up of
+TP_TEMPLATE = (
+    TP_GENERATED_MARKER + "\n"
+    "PROGRAM {alias}\n"
+    "%NOBUSYLAMP\n"
+    "%NOLOCKGROUP\n"
+    "\n"
+    "{declarations}"
+    "{imports}"
+    "\n"
+    "BEGIN\n"
+    "{body}"
+    "END {alias}"
+)
+TP_TEMPLATE_VAR = '\t{0} : {1}\n'
+TP_TEMPLATE_INCLUDE = '%include {0}\n'
+TP_TEMPLATE_IMPORT = '%from {0} %import {1}\n'
+TP_TEMPLATE_GET_ARG = '\t{0} = tpe__get_{1}_arg({2})\n'
+TP_TEMPLATE_DEFAULT_ARG = 'IF NOT tpe__parameter_exists({0}) THEN\n\t{1} = {2}\nELSE\n{3}ENDIF\n'
+TP_TEMPLATE_ASSIGN = '\t{0} = {1}({2})\n'
+TP_TEMPLATE_STATEMENT = '\t{0}\n'
+
 
 
 
@@ -228,7 +366,10 @@ def main():
     epilog=("Usage example:\n\n"
         "  mkdir C:\\foo\\bar\\build\n"
         "  cd C:\\foo\\bar\\build\n"
-        "  rossum C:\\foo\\bar\\src")
+        "  rossum C:\\foo\\bar\\src\n\n"
+        "After building:\n\n"
+        "  rossum --stats\n"
+        "  rossum --publish")
 
     parser = argparse.ArgumentParser(prog='rossum', description=description,
         epilog=epilog, formatter_class=argparse.RawDescriptionHelpFormatter)
@@ -256,6 +397,10 @@ def main():
         help='Do everything except writing to build file')
     parser.add_argument('--ktransw', type=str, dest='ktransw', metavar='PATH',
         help="Location of ktransw (default: assume it's on the Windows PATH)")
+    parser.add_argument('--kcache', action='store_true', dest='kcache',
+        help="Run ktransw through kcache, which reuses the .pc files of "
+        "earlier translations of the same (preprocessed) source from a "
+        "compilation cache shared by all build dirs")
     parser.add_argument('-E', '--preprocess-only', action='store_true', dest='translate_only',
         help="Preprocess only; do not translate")
     parser.add_argument('-n', '--no-env', action='store_true', dest='no_env',
@@ -286,12 +431,62 @@ def main():
     parser.add_argument('-i', '--build-interfaces', action='store_true', dest='build_interface',
         help='build tp interfaces for karel routines specified in package.json.'
         'This is needed to use karel routines within a tp program')
+    parser.add_argument('--profile', type=str, dest='profile', metavar='PATH',
+        help='Write the wall time, file counts and cache hit rates of every '
+        'stage of the configuration to PATH')
+    parser.add_argument('--profile-format', type=str, dest='profile_format',
+        choices=['json', 'chrome'], default='json',
+        help="Format of the --profile output: plain JSON (default), or the "
+        "Chrome trace event format (chrome://tracing, Perfetto)")
+    parser.add_argument('--renderer', type=str, dest='renderer', choices=['empy', 'native'],
+        default='empy', help="How to generate the build file: by processing the "
+        "EmPy template (default), or with the (faster) built-in renderer that "
+        "produces the same output as the template that ships with rossum.")
+    parser.add_argument('--subninja', action='store_true', dest='subninja',
+        help="Write the build statements of each package to a separate file "
+        "in the '{0}' directory of the build dir, and include those in the "
+        "build file. Only the files of packages that changed are rewritten, "
+        "the build file only when packages are added or removed. A package "
+        "that changed when ninja regenerates the build file is build with its "
+        "new build statements from the next ninja run on.".format(SUBNINJA_DIR))
+    parser.add_argument('--pool', action='append', type=str, dest='pools',
+        metavar='NAME=DEPTH', default=[],
+        help="Run at most DEPTH jobs of pool NAME in parallel (multiple "
+        "allowed). Pools: {0}. Overrides the [{1}] section of {2}.".format(
+            ', '.join('{0} ({1})'.format(n, ', '.join(r)) for n, r in NINJA_POOLS.items()),
+            ROBOT_INI_POOLS_SECTION, ROBOT_INI_NAME))
+    parser.add_argument('--artifacts', type=str, dest='artifacts', metavar='DIR',
+        default=os.environ.get(ENV_ARTIFACTS),
+        help="Artifact store (a local or network directory) to take the .pc, "
+        ".tx and .xml files of dependency packages from, instead of building "
+        "them. Use 'rossum --publish' after a build to add them to the store. "
+        "This will override env variable, {0}.".format(ENV_ARTIFACTS))
     parser.add_argument('-f', '--build-forms', action='store_true', dest='build_forms',
         help='include forms for building')
     parser.add_argument('-l', '--build-tp', action='store_true', dest='build_ls',
         help='include ls files for building')
+    parser.add_argument('--force', action='store_true', dest='force',
+        help='Regenerate the build file, even if none of its inputs changed')
+    parser.add_argument('--no-cache', action='store_true', dest='no_cache',
+        help='Do not use (or update) the discovery cache in the build directory')
+    parser.add_argument('--regenerate', type=str, dest='regenerate', metavar='BUILD',
+        help='Re-run rossum with the arguments it was last configured with in '
+        'BUILD (used by the generated build file)')
     parser.add_argument('--clean', action='store_true', dest='rossum_clean',
         help='clean all files out of build directory')
+    parser.add_argument('--stats', type=str, nargs='?', const='', dest='stats',
+        metavar='BUILD', help="Instead of configuring: report the build time "
+        "per package and per rule, the slowest files and the critical path of "
+        "the last build in BUILD (default: 'cwd'), from its {0}".format(FILE_NINJA_LOG))
+    parser.add_argument('--top', type=int, dest='top', default=10, metavar='N',
+        help='Number of slowest files --stats lists (default: %(default)s)')
+    parser.add_argument('--json', action='store_true', dest='json',
+        help='Output the statistics of --stats as JSON')
+    parser.add_argument('--publish', type=str, nargs='?', const='', dest='publish',
+        metavar='BUILD', help="Instead of configuring: add the .pc, .tx and "
+        ".xml files of the dependency packages build in BUILD (default: 'cwd') "
+        "to the artifact store it was configured with (or to --artifacts DIR). "
+        "Run this after a successful build.")
     parser.add_argument('src_dir', type=str, nargs='?', metavar='SRC',
         help="Main directory with packages to build")
     parser.add_argument('build_dir', type=str, nargs='?', metavar='BUILD',
@@ -303,6 +498,22 @@ def main():
             sys.argv[i] = sys.argv[i].replace('/D', '-D', 1)
     args = parser.parse_args()
 
+    # report on, or publish from, an existing build dir
+    if args.stats is not None:
+        return report_stats(os.path.abspath(args.stats or os.getcwd()), args.top, args.json)
+    if args.publish is not None:
+        return publish(os.path.abspath(args.publish or os.getcwd()), args.artifacts)
+
+    # re-run with exactly the same arguments (and from the same directory) as
+    # the invocation that last configured the given build dir
+    regenerating = bool(args.regenerate)
+    if regenerating:
+        invocation = load_invocation(os.path.abspath(args.regenerate))
+        os.chdir(invocation['cwd'])
+        args = parser.parse_args(invocation['argv'])
+    else:
+        invocation = {'cwd': os.getcwd(), 'argv': sys.argv[1:]}
+
 
 
     ############################################################################
@@ -352,6 +563,16 @@ def main():
 
     logger.info("This is rossum v{0}".format(ROSSUM_VERSION))
 
+    # time the stages of the configuration, the profile is written even if
+    # rossum exits early
+    profiler = Profiler()
+    if args.profile:
+        profile_path = os.path.abspath(args.profile)
+        def write_profile():
+            profiler.write(profile_path, args.profile_format)
+            logger.info("Wrote profile to {0}".format(profile_path))
+        atexit.register(write_profile)
+
 
     # make sure that source dir exists
     if not os.path.exists(source_dir):
@@ -375,9 +596,15 @@ def main():
         sys.exit(_OS_EX_DATAERR)
 
     #find robot.ini file
+    profiler.stage('parse_robotini')
     robot_ini_loc = find_robotini(source_dir, args)
     #parse robot.ini file into collection tuple 'robotiniInfo'
     robot_ini_info = parse_robotini(robot_ini_loc)
+    # depths of the ninja pools (robot.ini, overridden on the command line)
+    pools = resolve_pools(robot_ini_info.pools, args.pools)
+
+    # env file(s) as specified in robot.ini
+    env_files = [f.strip() for f in robot_ini_info.env.split(",")] if robot_ini_info.env else []
 
     # combine env files into one file if multiple are specified
     if robot_ini_info.env:
@@ -401,6 +628,7 @@ def main():
     search_locs.extend(FANUC_SEARCH_PATH)
 
     # try to find base directory for FANUC tools
+    profiler.stage('find_fr_install_dir')
     try:
         fr_base_dir = find_fr_install_dir(search_locs=FANUC_SEARCH_PATH, is64bit=args.rg64)
         logger.info("Using {} as FANUC software base directory".format(fr_base_dir))
@@ -415,6 +643,7 @@ def main():
             sys.exit(_OS_EX_DATAERR)
 
     #make list of tool names
+    profiler.stage('find_tools')
     tools = [KTRANS_BIN_NAME, KTRANSW_BIN_NAME, MAKETP_BIN_NAME, TPP_BIN_NAME, XML_BIN_NAME, KCDICT_BIN_NAME]
     # preset list of paths to search for paths
     search_locs = []
@@ -423,30 +652,11 @@ def main():
     search_locs.extend([p for p in os.environ['Path'].split(os.pathsep) if len(p) > 0])
     #find build tools
     path_lst = find_tools(search_locs, tools, args)
-    # if only precompiling
-    if args.translate_only:
-        kl_comp_ext = KL_SUFFIX
-    else:
-        kl_comp_ext = PCODE_SUFFIX
     # put list into dictionary for file type build rule
-    tool_paths = {
-        'ktrans' : {'from_suffix' : '0', 'to_suffix' : '0', 'path' : path_lst[0], 'type' : 'karel'},
-        'ktransw' : {'from_suffix' : KL_SUFFIX, 'interp_suffix' : kl_comp_ext, 'comp_suffix' : kl_comp_ext, 'path' : (args.ktransw or path_lst[1]), 'type' : 'karel'},
-        'yaml' : {'from_suffix' : YAML_SUFFIX, 'interp_suffix' : XML_SUFFIX,  'comp_suffix' : XML_SUFFIX, 'path' : path_lst[4], 'type' : 'data'},
-        'xml' : {'from_suffix' : XML_SUFFIX, 'interp_suffix' : XML_SUFFIX,  'comp_suffix' : XML_SUFFIX, 'path' : 'C:\\Windows\\SysWOW64\\xcopy.exe', 'type' : 'data'},
-        'csv' : {'from_suffix' : CSV_SUFFIX, 'interp_suffix' : CSV_SUFFIX,  'comp_suffix' : CSV_SUFFIX, 'path' : 'C:\\Windows\\SysWOW64\\xcopy.exe', 'type' : 'data'},
-        'kcdict' : {'from_suffix' : DICT_SUFFIX, 'interp_suffix' : COMPRESSED_SUFFIX, 'comp_suffix' : COMPRESSED_SUFFIX, 'path' : path_lst[5], 'type' : 'forms'},
-        'kcform' : {'from_suffix' : FORM_SUFFIX, 'interp_suffix' : COMPRESSED_SUFFIX, 'comp_suffix' : COMPRESSED_SUFFIX, 'path' : path_lst[5], 'type' : 'forms'}
-    }
-    #for tpp decide if just interpreting, or compiling to tp
-    if args.compiletp:
-      tool_paths['maketp'] = {'from_suffix' : TP_SUFFIX, 'interp_suffix' : TPCODE_SUFFIX, 'comp_suffix' : TPCODE_SUFFIX, 'path' : path_lst[2], 'type' : 'tp'}
-      tool_paths['tpp'] = {'from_suffix' : TPP_SUFFIX, 'interp_suffix' : TPP_INTERP_SUFFIX, 'comp_suffix' : TPCODE_SUFFIX, 'path' : path_lst[3], 'compile' : path_lst[2], 'type' : 'tp'}
-    else:
-      tool_paths['maketp'] = {'from_suffix' : TP_SUFFIX, 'interp_suffix' : TP_SUFFIX, 'comp_suffix' : TP_SUFFIX, 'path' : 'C:\\Windows\\SysWOW64\\xcopy.exe', 'type' : 'tp'}
-      tool_paths['tpp'] = {'from_suffix' : TPP_SUFFIX, 'interp_suffix' : TPP_INTERP_SUFFIX, 'comp_suffix' : TPP_INTERP_SUFFIX, 'path' : path_lst[3], 'type' : 'tp'}
+    tool_paths = tool_mappings(path_lst, args)
 
     # try to find support directory for selected core software version
+    profiler.stage('find_ktrans_support_dir')
     logger.info("Setting default system core version to: {}".format(args.core_version))
     # see if we need to find support dir ourselves
     if not args.support_dir:
@@ -474,12 +684,14 @@ def main():
     # template and output file locations
     template_dir  = os.path.dirname(os.path.realpath(__file__))
     template_path = os.path.join(template_dir, BUILD_FILE_TEMPLATE_NAME) # for ninja file
+    package_template_path = os.path.join(template_dir, PACKAGE_TEMPLATE_NAME) # per package
     build_file_path = os.path.join(build_dir, BUILD_FILE_NAME)
 
     # check
-    if not os.path.isfile(template_path):
-        raise RuntimeError("Template file %s not found in template "
-            "dir %s" % (template_path, template_dir))
+    for path in (template_path, package_template_path):
+        if not os.path.isfile(path):
+            raise RuntimeError("Template file %s not found in template "
+                "dir %s" % (path, template_dir))
 
     logger.debug("Using build file template: {0}".format(template_path))
 
@@ -494,70 +706,87 @@ def main():
     src_space_dirs = [source_dir]
     # and any extra paths the user provided
     src_space_dirs.extend(extra_paths)
-
-    logger.info("Source space(s) searched for packages (in order: src, args):")
-    for p in src_space_dirs:
-        logger.info('  {0}'.format(p))
-
-    # discover packages
-    src_space_pkgs = find_pkgs(src_space_dirs, args)
-    src_space_pkgs = remove_duplicates(src_space_pkgs)
-    logger.info("Found {0} package(s) in source space(s):".format(len(src_space_pkgs)))
-    for pkg in src_space_pkgs:
-        logger.info("  {0} (v{1})".format(pkg.manifest.name, pkg.manifest.version))
-
-
-    # discover pkgs in non-source space directories, if those have been configured
-    other_pkgs = []
+    # and in non-source space directories, if those have been configured
+    other_pkg_dirs = []
     if (not args.no_env) and (ENV_PKG_PATH in os.environ):
-        logger.info("Other location(s) searched for packages ({}):".format(ENV_PKG_PATH))
         other_pkg_dirs = [p for p in os.environ[ENV_PKG_PATH].split(os.pathsep) if len(p) > 0]
-        if logger.getEffectiveLevel() == logging.DEBUG:
-          for p in other_pkg_dirs:
-              logger.debug('  {0}'.format(p))
 
-        other_pkgs.extend(find_pkgs(other_pkg_dirs, args))
-        other_pkgs = remove_duplicates(other_pkgs)
-        logger.info("Found {0} package(s) in other location(s):".format(len(other_pkgs)))
-        if logger.getEffectiveLevel() == logging.DEBUG:
-          for pkg in other_pkgs:
-              logger.debug("  {0} (v{1})".format(pkg.manifest.name, pkg.manifest.version))
+    # cache of directory listings and manifests from earlier runs
+    cache = RossumCache(os.path.join(build_dir, FILE_CACHE))
+    if not args.no_cache:
+        cache.load()
+    profiler.cache = cache
 
+    registry, src_space_pkgs, pkg_parent_dirs = discover_pkgs(
+        src_space_dirs, other_pkg_dirs, args, cache, profiler)
+    dependency_graph, all_pkgs = resolve_pkgs(src_space_pkgs, registry, args, profiler)
 
-    # process all discovered pkgs
-    all_pkgs = []
-    all_pkgs.extend(src_space_pkgs)
-    all_pkgs.extend(other_pkgs)
-    all_pkgs = remove_duplicates(all_pkgs)
-
-    # build out dependency trees
-    # for all packages in src_space
-    dependency_graph = create_dependency_graph(src_space_pkgs, all_pkgs, args)
-    #log dependency trees to logger
-    log_dep_tree(dependency_graph)
-    #filter out additional packages that are not dependencies
-    all_pkgs = filter_packages(all_pkgs, dependency_graph)
-
-    # all discovered pkgs get used for dependency and include path resolution,
-    resolve_includes(all_pkgs, args)
-
-    #determine any user defined macros to pass to ktransw
-    resolve_macros(all_pkgs, args)
+    # manifests of dependencies have been parsed (and cached) by now
+    if not args.no_cache:
+        cache.save()
+        logger.debug("Discovery cache: {0} hit(s), {1} miss(es)".format(
+            sum(cache.hits.values()), sum(cache.misses.values())))
 
     # select to just build source or all related packages
     if args.buildall:
-        build_pkgs = all_pkgs
+        build_pkgs = list(all_pkgs)
     else: 
         build_pkgs = src_space_pkgs
 
+    # nothing to do if none of the inputs changed since the last configure
+    profiler.stage('fingerprint_inputs')
+    fingerprint = fingerprint_inputs(args, registry.manifest_paths(),
+        [robot_ini_loc, template_path, package_template_path] + env_files,
+        [tool_paths, fr_support_dir],
+        [d for pkg in build_pkgs for d in pkg.include_dirs] if args.build_interface else [])
+    fingerprint_path = os.path.join(build_dir, FILE_FINGERPRINT)
+    if (not args.force) and (not args.dry_run) and os.path.exists(build_file_path) \
+            and os.path.exists(FILE_MANIFEST) and fingerprint_up_to_date(fingerprint_path, fingerprint):
+        logger.info("No changes since last configuration, {0} is up-to-date "
+            "(use --force to regenerate it anyway)".format(BUILD_FILE_NAME))
+        sys.exit(0)
+
+    # the outputs of dependency packages may be taken from an artifact store
+    src_names = set(pkg.manifest.name for pkg in src_space_pkgs)
+    dep_pkgs = [pkg for pkg in build_pkgs if pkg.manifest.name not in src_names]
+    artifact_store = os.path.abspath(args.artifacts) if args.artifacts else None
+    artifact_keys = {}
+    # whether the store had an entry for each of the packages
+    store_entries = {}
+    if artifact_store:
+        profiler.stage('artifact_keys')
+        # with the core version ktrans is run with (see 'configs' below)
+        for pkg in dep_pkgs:
+            key = artifact_key(pkg, args, robot_ini_info.version, artifact_keys, cache)
+            entry = artifact_path(artifact_store, pkg.manifest.name, pkg.manifest.version, key)
+            store_entries[entry] = os.path.isdir(entry)
+
     #create tp-interface karel files
     if args.build_interface:
-        interfaces = get_interfaces(build_pkgs)
-        if interfaces:
-            create_interfaces(interfaces)
+        update_interfaces(build_pkgs, cache, profiler)
+        if not args.no_cache:
+            cache.save()
 
     # but only the pkgs in the source space(s) get their objects build
+    profiler.stage('gen_obj_mappings')
     gen_obj_mappings(build_pkgs, tool_paths, args, dependency_graph)
+    profiler.count('objects', sum(len(pkg.objects) for pkg in build_pkgs))
+
+    # dependency packages with outputs in the artifact store are not build,
+    # but their outputs are still pushed to the controller
+    render_pkgs = build_pkgs
+    prefilled = []
+    if artifact_store and not args.dry_run:
+        profiler.stage('prefill_artifacts')
+        prefilled = prefill_artifacts(artifact_store, build_dir, dep_pkgs, artifact_keys)
+        render_pkgs = [pkg._replace(objects=[o for o in pkg.objects if o[3] not in ARTIFACT_TYPES])
+            if pkg.manifest.name in prefilled else pkg for pkg in build_pkgs]
+        profiler.count('packages', len(dep_pkgs))
+        profiler.count('prefilled', len(prefilled))
+        logger.info("Took the outputs of {0} of {1} dependency package(s) from "
+            "artifact store {2}".format(len(prefilled), len(dep_pkgs), artifact_store))
+        if not args.no_cache:
+            cache.save()
 
 
     # notify user of config
@@ -580,6 +809,7 @@ def main():
     # Template processing
     #
 
+    profiler.stage('render')
     configs = {}
     #support directory
     configs['support'] = fr_support_dir
@@ -601,10 +831,7 @@ def main():
 
 
     # populate dicts & lists needed by template
-    ktrans = KtransInfo(path=tool_paths['ktrans']['path'], support=KtransSupportDirInfo(
-        path=configs['support'],
-        version_string=configs['version']))
-    ktransw = KtransWInfo(path=tool_paths['ktransw']['path'])
+    support = KtransSupportDirInfo(path=configs['support'], version_string=configs['version'])
     bs_info = RossumSpaceInfo(path=build_dir)
     sp_infos = [RossumSpaceInfo(path=p) for p in src_space_dirs]
     robini_info = KtransRobotIniInfo(path=robot_ini_loc, ftp=configs['ftp'], env=configs['env'])
@@ -615,9 +842,190 @@ def main():
       make_tpp_env_file = None
 
     ws = RossumWorkspace(build=bs_info, sources=sp_infos,
-        robot_ini=robini_info, pkgs=build_pkgs)
+        robot_ini=robini_info, pkgs=render_pkgs)
+
+
+    # let ninja re-run rossum whenever a manifest, robot.ini, an env file or
+    # the templates change
+    if BUILD_STANDALONE:
+        regen_cmd = [sys.executable]
+    else:
+        regen_cmd = [sys.executable, os.path.realpath(__file__)]
+    regen_cmd.extend(['--regenerate', build_dir])
+    regen_inputs = [pkg.manifest_path for pkg in all_pkgs]
+    regen_inputs.extend([robot_ini_loc, template_path, package_template_path] + env_files)
+    # and when a package is added or removed: that changes the mtime of the
+    # directory it is in. The build dir is skipped, it changes with every build.
+    regen_inputs.extend(sorted(d for d in pkg_parent_dirs
+        if d != build_dir and not d.startswith(build_dir + os.sep)))
+    # a changed source of a prefilled package means its outputs must be build
+    regen_inputs.extend(f for pkg in dep_pkgs if pkg.manifest.name in prefilled
+        for f in artifact_inputs(pkg, args))
+    regen_info = RossumRegenInfo(
+        command=' '.join('"{0}"'.format(a) for a in regen_cmd),
+        inputs=' '.join(ninja_escape_path(p) for p in dedup(regen_inputs)))
+
+    # with --subninja every package gets its own build file, which is only
+    # rendered when the build statements of the package change. The build
+    # file itself then only changes with the set of packages.
+    subninja = None
+    if args.subninja:
+        subninja, pkgs_changed = write_package_build_files(build_dir, render_pkgs,
+            args.compiletp, args.renderer, package_template_path)
+        if pkgs_changed and regenerating:
+            # ninja only reloads its manifest if build.ninja itself changed
+            logger.warning("The build statements of {0} package(s) changed, these "
+                "are used from the next ninja run on".format(len(pkgs_changed)))
+
+    globls = template_globals(ws, tool_paths, support, regen_info,
+        make_tpp_env_file, subninja, pools, package_template_path, args)
+    if not write_build_file(build_file_path, globls, args.renderer, template_path):
+        logger.info("{0} is unchanged".format(BUILD_FILE_NAME))
+
+    profiler.count('bytes', os.path.getsize(build_file_path))
+
+    # write build files in manifest
+    profiler.stage('write_manifest')
+    man_list = [(obj[2], obj[3]) for pkg in build_pkgs for obj in pkg.objects]
+    write_manifest(FILE_MANIFEST, man_list, robini_info.ftp)
+    # and which package and source every output belongs to, for 'rossum --stats'
+    write_object_map(os.path.join(build_dir, FILE_OBJECTS), build_dir, ws.pkgs, args.compiletp)
+    # and which packages 'rossum --publish' can add to the artifact store (a
+    # build dir configured without one has nothing to publish)
+    artifact_record_path = os.path.join(build_dir, FILE_ARTIFACTS)
+    if artifact_store:
+        write_artifact_record(artifact_record_path, artifact_store,
+            [pkg for pkg in dep_pkgs if pkg.manifest.name not in prefilled], artifact_keys, args)
+    elif os.path.exists(artifact_record_path):
+        os.remove(artifact_record_path)
+
+    # only record the fingerprint once everything has been written, along with
+    # the state of the generated tp-interface programs and of the inputs of
+    # the artifact keys, which it does not cover
+    stamps = {}
+    if args.build_interface:
+        stamps.update((p, file_stamp(p)) for p in interface_paths(build_pkgs))
+    if artifact_store:
+        stamps.update(artifact_input_stamps(dep_pkgs, args))
+    with open(fingerprint_path, 'w') as f:
+        json.dump({'fingerprint': fingerprint, 'stamps': stamps,
+            'store_entries': store_entries}, f, indent=1, sort_keys=True)
+    # and how rossum was invoked, for regeneration
+    with open(os.path.join(build_dir, FILE_INVOCATION), 'w') as f:
+        json.dump(invocation, f)
+
+    profiler.end()
+
+    # done
+    logger.info("Configuration successful, you may now run 'ninja' in the "
+        "build directory.")
+
+
+
+
+def discover_pkgs(src_space_dirs, other_pkg_dirs, args, cache, profiler):
+    """Find the packages in the source space(s), and index the manifests in
+    'other_pkg_dirs'. Those are only parsed when (and if) the dependency
+    graph needs them.
+
+    Returns the PackageRegistry, the source space packages and the
+    directories a package can be added to or removed from: the searched
+    dirs themselves and the parent dirs of the packages found in them.
+    """
+    profiler.stage('find_pkgs')
+    logger.info("Source space(s) searched for packages (in order: src, args):")
+    for p in src_space_dirs:
+        logger.info('  {0}'.format(p))
+
+    # the registry keeps every location a package was found at, with the
+    # source space taking precedence over other locations
+    src_space_pkgs = find_pkgs(src_space_dirs, args, cache)
+    pkg_parent_dirs = src_space_dirs + other_pkg_dirs
+    pkg_parent_dirs.extend(os.path.dirname(pkg.location) for pkg in src_space_pkgs)
+    registry = PackageRegistry(src_space_pkgs,
+        loader=lambda manifest_path: load_pkg(manifest_path, args, cache))
+    src_space_pkgs = remove_duplicates(src_space_pkgs)
+    profiler.count('packages', len(src_space_pkgs))
+    logger.info("Found {0} package(s) in source space(s):".format(len(src_space_pkgs)))
+    for pkg in src_space_pkgs:
+        logger.info("  {0} (v{1})".format(pkg.manifest.name, pkg.manifest.version))
+
+    if other_pkg_dirs:
+        logger.info("Other location(s) searched for packages ({}):".format(ENV_PKG_PATH))
+        if logger.getEffectiveLevel() == logging.DEBUG:
+          for p in other_pkg_dirs:
+              logger.debug('  {0}'.format(p))
+
+        other_pkgs = index_pkgs(other_pkg_dirs, cache)
+        registry.index(other_pkgs)
+        pkg_parent_dirs.extend(os.path.dirname(os.path.dirname(manifest_path))
+            for _, manifest_path in other_pkgs)
+        profiler.count('indexed_manifests', len(other_pkgs))
+        # manifests are only parsed for the packages that are needed, so these
+        # are candidates: some may not parse, or be shadowed by another package
+        other_names = set(name for name, _ in other_pkgs)
+        logger.info("Found {0} candidate package(s) in other location(s):".format(len(other_names)))
+        if logger.getEffectiveLevel() == logging.DEBUG:
+          for name, manifest_path in other_pkgs:
+              logger.debug("  {0} ({1})".format(name, os.path.dirname(manifest_path)))
+
+    return registry, src_space_pkgs, dedup([os.path.abspath(d) for d in pkg_parent_dirs])
+
+
+def resolve_pkgs(src_space_pkgs, registry, args, profiler):
+    """Build the dependency graph of the source space packages, and resolve
+    the include dirs and macros of all packages in it.
+
+    Returns the graph and the packages in it.
+    """
+    # report packages that are shadowed by a package with the same name
+    profiler.stage('create_dependency_graph')
+    registry.log_shadowed()
+
+    # build out dependency trees
+    # for all packages in src_space
+    dependency_graph = create_dependency_graph(src_space_pkgs, registry, args)
+    #log dependency trees to logger
+    log_dep_tree(dependency_graph)
+    #filter out additional packages that are not dependencies
+    all_pkgs = filter_packages(registry, dependency_graph)
+    profiler.count('packages', len(all_pkgs))
+    src_space_names = set(pkg.manifest.name for pkg in src_space_pkgs)
+    other_pkgs = [pkg for pkg in all_pkgs if pkg.manifest.name not in src_space_names]
+    if other_pkgs:
+        logger.info("Using {0} package(s) from other location(s):".format(len(other_pkgs)))
+        for pkg in other_pkgs:
+            logger.info("  {0} (v{1})".format(pkg.manifest.name, pkg.manifest.version))
+
+    # all discovered pkgs get used for dependency and include path resolution,
+    profiler.stage('resolve_includes')
+    resolve_includes(all_pkgs, args, dependency_graph)
+    profiler.count('include_dirs', sum(len(pkg.include_dirs) for pkg in all_pkgs))
+
+    #determine any user defined macros to pass to ktransw
+    resolve_macros(all_pkgs, args)
+
+    return dependency_graph, all_pkgs
 
 
+def update_interfaces(pkgs, cache, profiler):
+    """Write the tp-interface programs of 'pkgs', and remove the ones that
+    are no longer declared.
+    """
+    profiler.stage('create_interfaces')
+    interfaces = get_interfaces(pkgs, cache)
+    profiler.count('interfaces', len(interfaces))
+    if interfaces:
+        create_interfaces(interfaces)
+    remove_orphaned_interfaces(pkgs)
+
+
+def template_globals(ws, tool_paths, support, regen, makeenv, subninja, pools,
+        package_template, args):
+    """The globals the build file is rendered with (by the template, or by
+    render_build_file(..)). 'package_template' is the path of the template
+    the build template includes for the build statements of the packages.
+    """
     #if --keepgpp is set insert flag into ktrans call in
     # build.ninja.em so that temp builds in %TEMP% are kept
     keep_buildd = ''
@@ -630,68 +1038,250 @@ def main():
     if args.translate_only:
         copy_karel = '-E'
 
-    #store globals in container to be passed by empy
-    globls = {
+    # kcache ships with rossum. Preprocessing only has nothing to cache.
+    kcache = ''
+    if args.kcache and not args.translate_only:
+        if BUILD_STANDALONE:
+            kcache_dir = os.path.dirname(os.path.dirname(os.path.realpath(sys.executable)))
+        else:
+            kcache_dir = os.path.dirname(os.path.realpath(__file__))
+        kcache = os.path.join(kcache_dir, KCACHE_BIN_NAME)
+
+    with open(package_template) as tpl:
+        package_template = tpl.read()
+
+    return {
         'ws'             : ws,
-        'ktrans'         : ktrans,
-        'ktransw'        : ktransw,
+        'ktrans'         : KtransInfo(path=tool_paths['ktrans']['path'], support=support),
+        'ktransw'        : KtransWInfo(path=tool_paths['ktransw']['path']),
         'rossum_version' : ROSSUM_VERSION,
         'tstamp'         : datetime.datetime.now().isoformat(),
         'tools'          : tool_paths,
         'keepgpp'        : keep_buildd,
         'preprocess_karel' : copy_karel,
+        'kcache'         : kcache,
         'compiletp'      : args.compiletp,
         'hastpp'         : args.hastpp,
-        'makeenv'        : make_tpp_env_file,
+        'makeenv'        : makeenv,
+        'regen'          : regen,
+        'build_file_name': BUILD_FILE_NAME,
+        'subninja'       : subninja,
+        'pools'          : pools,
+        'package_template' : package_template,
     }
-    # write out ninja template
-    ninja_fl = open(build_file_path, 'w')
-    ninja_interp = em.Interpreter(
-            output=ninja_fl, globals=dict(globls),
-            options={em.RAW_OPT : True, em.BUFFERED_OPT : True})
-    # load and process the template
-    logger.debug("Processing template")
-    ninja_interp.file(open(template_path))
-    # shutdown empy interpreters
-    logger.debug("Shutting down empy")
-    ninja_interp.shutdown()
 
-    # write build files in manifest
-    man_list = [(obj[2], obj[3]) for pkg in ws.pkgs for obj in pkg.objects]
-    write_manifest(FILE_MANIFEST, man_list, robini_info.ftp)
 
+def write_build_file(build_file_path, globls, renderer, template_path):
+    """Write out the build file, with the EmPy template at 'template_path'
+    or the native renderer ('renderer'). The build file is only replaced if
+    its content changed, so ninja does not needlessly reload it.
 
-    # done
-    logger.info("Configuration successful, you may now run 'ninja' in the "
-        "build directory.")
+    Returns whether it was replaced.
+    """
+    def render(ninja_fl):
+        if renderer == 'native':
+            logger.debug("Rendering build file")
+            render_build_file(ninja_fl, globls)
+        else:
+            ninja_interp = em.Interpreter(
+                    output=ninja_fl, globals=dict(globls),
+                    options={em.RAW_OPT : True, em.BUFFERED_OPT : True})
+            # load and process the template
+            logger.debug("Processing template")
+            with open(template_path) as tpl:
+                ninja_interp.file(tpl)
+            # shutdown empy interpreters
+            logger.debug("Shutting down empy")
+            ninja_interp.shutdown()
 
+    return update_file(build_file_path, render, ignore=BUILD_FILE_TSTAMP_PATTERN)
 
 
 
 
-def find_files_recur(top_dir, pattern):
-    """
+
+def scan_dir(root, pattern, cache=None):
+    """List a single directory: the names of files in it matching 'pattern',
+    the names of its sub directories (except hidden ones, like .git) and
+    whether it contains an ignore file.
+
+    Uses the cached listing if the mtime of 'root' has not changed since the
+    last run. Returns None if 'root' cannot be read.
+
+    Note that this only saves listing the directory: a directory's mtime does
+    not change when something deeper in the tree does, so unchanged subtrees
+    cannot be skipped and every directory below a search path is still
+    stat'ed on each run.
     """
-    matches = []
-    for root, dirnames, filenames in os.walk(top_dir, topdown=True):
-        # if we find an ignore file, don't go down into that subtree
-        if ROSSUM_IGNORE_NAME in filenames:
-            logger.debug("Ignoring {0} (found {1})".format(root, ROSSUM_IGNORE_NAME))
-            # discard any sub dirs os.walk(..) found in 'root'
-            dirnames[:] = []
-            continue
+    try:
+        mtime = os.stat(root).st_mtime_ns
+    except OSError:
+        return None
+
+    entry = cache.get('dirs', root) if cache is not None else None
+    if entry is not None and entry['mtime'] == mtime and entry['pattern'] == pattern:
+        cache.hit('dirs')
+        cache.put('dirs', root, entry)
+        return entry
+
+    entry = {'mtime': mtime, 'pattern': pattern, 'ignore': False,
+        'files': [], 'dirs': []}
+    match = re.compile(fnmatch.translate(os.path.normcase(pattern))).match
+    files = []
+    try:
+        # scandir gets file types from the directory listing itself, so
+        # (on Windows at least) no extra stat calls are needed here
+        with os.scandir(root) as it:
+            for e in it:
+                if e.is_dir():
+                    # like os.walk(..), don't follow symlinked directories
+                    if not e.is_symlink() and not e.name.startswith('.'):
+                        entry['dirs'].append(e.name)
+                else:
+                    files.append(e.name)
+    except OSError:
+        return None
+
+    # if we find an ignore file, don't go down into that subtree
+    if ROSSUM_IGNORE_NAME in files:
+        entry['ignore'] = True
+        entry['dirs'] = []
+    else:
+        entry['files'] = sorted(f for f in files if match(os.path.normcase(f)))
+        entry['dirs'].sort()
+
+    if cache is not None:
+        cache.miss('dirs')
+        cache.put('dirs', root, entry)
+    return entry
+
 
-        for filename in fnmatch.filter(filenames, pattern):
-            matches.append(os.path.join(root, filename))
+def find_files(top_dirs, pattern, cache=None):
+    """Find all files matching 'pattern' below each of the dirs in 'top_dirs'.
 
+    All directories are scanned concurrently on a thread pool, as on network
+    drives the time spent is mostly latency. Results are returned per top
+    dir (in the order of 'top_dirs'), with the files in each list in the same
+    (depth-first) order a sequential walk would produce.
+
+    Directories that contain a ROSSUM_IGNORE file are not descended into.
+    With a 'cache', the listing of a directory is reused if its mtime did not
+    change (see scan_dir(..)), but all directories are visited.
+    """
+    # every scanned dir gets a key with the index of each of its ancestors,
+    # sorting on those keys restores the depth-first order
+    found = []
+    with concurrent.futures.ThreadPoolExecutor() as pool:
+        pending = {}
+        for i, d in enumerate(top_dirs):
+            pending[pool.submit(scan_dir, d, pattern, cache)] = ((i,), d)
+
+        while pending:
+            done, _ = concurrent.futures.wait(pending,
+                return_when=concurrent.futures.FIRST_COMPLETED)
+            for fut in done:
+                key, root = pending.pop(fut)
+                entry = fut.result()
+                if entry is None:
+                    continue
+                if entry['ignore']:
+                    logger.debug("Ignoring {0} (found {1})".format(root, ROSSUM_IGNORE_NAME))
+                    continue
+                for filename in entry['files']:
+                    found.append((key, os.path.join(root, filename)))
+                for j, name in enumerate(entry['dirs']):
+                    sub_dir = os.path.join(root, name)
+                    pending[pool.submit(scan_dir, sub_dir, pattern, cache)] = (key + (j,), sub_dir)
+
+    found.sort(key=lambda f: f[0])
+    matches = [[] for _ in top_dirs]
+    for key, path in found:
+        matches[key[0]].append(path)
     return matches
 
 
-def parse_manifest(fpath, args):
+def find_files_recur(top_dir, pattern, cache=None):
+    """Find all files matching 'pattern' below 'top_dir'.
+    """
+    return find_files([top_dir], pattern, cache)[0]
+
+
+def cached_manifest_entry(fpath, st, cache):
+    """Return the cache entry for the manifest at 'fpath', if it is still
+    valid for a file with stat result 'st'.
+    """
+    if cache is None:
+        return None
+    entry = cache.get('manifests', fpath)
+    if entry is not None and entry['mtime'] == st.st_mtime_ns and entry['size'] == st.st_size:
+        return entry
+    return None
+
+
+def manifest_name(data):
+    """Return the name of the package described by the parsed manifest 'data',
+    or None if it isn't a rossum manifest of the supported version.
+    """
+    if not isinstance(data, dict) or 'manver' not in data or 'project' not in data:
+        return None
+    try:
+        if int(data['manver']) != MANIFEST_VERSION:
+            return None
+    except (TypeError, ValueError):
+        return None
+    return data['project']
+
+
+def read_manifest_name(fpath, cache=None):
+    """Return the name of the rossum package described by the manifest at
+    'fpath', or None if it isn't a rossum manifest.
+
+    Only the name is kept (and cached), which is enough to build an index of
+    where packages can be found.
+    """
+    st = os.stat(fpath)
+    entry = cached_manifest_entry(fpath, st, cache)
+    if entry is not None and 'name' in entry:
+        cache.hit('manifest_index')
+    else:
+        with open(fpath, 'r') as f:
+            data = json.load(f)
+        entry = {'mtime': st.st_mtime_ns, 'size': st.st_size,
+            'name': manifest_name(data)}
+        if cache is not None:
+            cache.miss('manifest_index')
+
+    if cache is not None:
+        cache.put('manifests', fpath, entry)
+    return entry['name']
+
+
+def load_manifest_data(fpath, cache=None):
+    """Load the raw contents of a manifest, reusing the cached copy if the
+    file's mtime and size have not changed.
+    """
+    st = os.stat(fpath)
+    entry = cached_manifest_entry(fpath, st, cache)
+    if entry is not None and 'data' in entry:
+        cache.hit('manifests')
+    else:
+        with open(fpath, 'r') as f:
+            data = json.load(f)
+        entry = {'mtime': st.st_mtime_ns, 'size': st.st_size,
+            'name': manifest_name(data), 'data': data}
+        if cache is not None:
+            cache.miss('manifests')
+
+    if cache is not None:
+        cache.put('manifests', fpath, entry)
+    # callers are free to modify what they get back
+    return copy.deepcopy(entry['data'])
+
+
+def parse_manifest(fpath, args, cache=None):
     """Convert a package.json file into a RossumManifest struct
     """
-    with open(fpath, 'r') as f:
-        mfest = json.load(f)
+    mfest = load_manifest_data(fpath, cache)
 
     logger.debug("Loaded {0} from {1}".format(os.path.basename(fpath), os.path.dirname(fpath)))
 
@@ -725,37 +1315,73 @@ def parse_manifest(fpath, args):
         tpp_compile_env=mfest['tpp_compile_env'] if 'tpp_compile_env' in mfest else [])
 
 
-def find_pkgs(dirs, args):
-    """find packages in package path directories, and parse package.json files 
-    into RossumPackage structs.
+def find_manifests(dirs, cache=None):
+    """find all manifest files in package path directories.
     """
     manifest_file_paths = []
-    for d in dirs:
-        logger.debug("Searching in {0}".format(d))
-        manifest_file_paths_ = find_files_recur(d, MANIFEST_NAME)
+    for d, manifest_file_paths_ in zip(dirs, find_files(dirs, MANIFEST_NAME, cache)):
+        logger.debug("Searched in {0}".format(d))
         manifest_file_paths.extend(manifest_file_paths_)
         logger.debug("  found {0} manifest(s)".format(len(manifest_file_paths_)))
     logger.debug("Found {0} manifest(s) total".format(len(manifest_file_paths)))
+    return manifest_file_paths
+
 
-    pkgs = []
-    for manifest_file_path in manifest_file_paths:
+def load_pkg(manifest_file_path, args, cache=None):
+    """parse a package.json file into a RossumPackage struct. Returns None
+    (after warning the user) if the manifest could not be parsed.
+    """
+    try:
+        manifest = parse_manifest(manifest_file_path, args, cache)
+        return RossumPackage(
+                dependencies=[],
+                include_dirs=[],
+                location=os.path.dirname(manifest_file_path),
+                manifest_path=manifest_file_path,
+                manifest=manifest,
+                objects=[],
+                tests=[],
+                macros=[])
+    except Exception as e:
+        mfest_loc = os.path.join(os.path.split(
+            os.path.dirname(manifest_file_path))[1], os.path.basename(manifest_file_path))
+        logger.warning("Error parsing manifest {0}: {1}.".format(mfest_loc, e))
+        return None
+
+
+def find_pkgs(dirs, args, cache=None):
+    """find packages in package path directories, and parse package.json files 
+    into RossumPackage structs.
+    """
+    manifest_file_paths = find_manifests(dirs, cache)
+
+    # reading manifests is I/O bound as well. map(..) keeps the order of the
+    # manifests, which remove_duplicates(..) relies on for precedence
+    with concurrent.futures.ThreadPoolExecutor() as pool:
+        pkgs = pool.map(lambda p: load_pkg(p, args, cache), manifest_file_paths)
+        return [pkg for pkg in pkgs if pkg is not None]
+
+
+def index_pkgs(dirs, cache=None):
+    """find packages in package path directories, but only record their name
+    and manifest location. Returns a list of (name, manifest path) tuples.
+
+    Manifests are parsed later (see PackageRegistry), and only for packages
+    that are actually needed.
+    """
+    manifest_file_paths = find_manifests(dirs, cache)
+
+    def read_name(manifest_file_path):
         try:
-            manifest = parse_manifest(manifest_file_path, args)
-            pkg = RossumPackage(
-                    dependencies=[],
-                    include_dirs=[],
-                    location=os.path.dirname(manifest_file_path),
-                    manifest=manifest,
-                    objects=[],
-                    tests=[],
-                    macros=[])
-            pkgs.append(pkg)
+            return read_manifest_name(manifest_file_path, cache)
         except Exception as e:
-            mfest_loc = os.path.join(os.path.split(
-                os.path.dirname(manifest_file_path))[1], os.path.basename(manifest_file_path))
-            logger.warning("Error parsing manifest {0}: {1}.".format(mfest_loc, e))
+            logger.warning("Error reading manifest {0}: {1}.".format(manifest_file_path, e))
+            return None
 
-    return pkgs
+    with concurrent.futures.ThreadPoolExecutor() as pool:
+        names = pool.map(read_name, manifest_file_paths)
+        return [(name, path) for name, path in zip(names, manifest_file_paths)
+            if name is not None]
 
 def remove_duplicates(pkgs):
     """create a seperate set with unique package names.
@@ -772,19 +1398,96 @@ def remove_duplicates(pkgs):
     return set_pkgs
 
 
-def find_in_list(l, pred):
-    """lamba function for finding item in a list
+def load_invocation(build_dir):
+    """Load the working directory and command line arguments rossum was
+    started with when it last configured 'build_dir'.
     """
-    for i in l:
-        if pred(i):
-            return i
-    return None
+    invocation_path = os.path.join(build_dir, FILE_INVOCATION)
+    if not os.path.exists(invocation_path):
+        raise RuntimeError("Cannot regenerate: no {0} in {1}, run rossum manually "
+            "first".format(FILE_INVOCATION, build_dir))
+    with open(invocation_path, 'r') as f:
+        return json.load(f)
 
 
-def create_dependency_graph(source_pkgs, all_pkgs, args):
+def ninja_escape_path(path):
+    """Escape a path for use in a ninja build statement.
+    """
+    return path.replace('$', '$$').replace(' ', '$ ').replace(':', '$:')
+
+
+def file_stamp(fpath):
+    """Cheap identification of the state of a file: (mtime, size), or None
+    if the file does not exist.
+    """
+    try:
+        st = os.stat(fpath)
+        return [st.st_mtime_ns, st.st_size]
+    except OSError:
+        return None
+
+
+def fingerprint_inputs(args, manifest_paths, input_files, tools, header_dirs):
+    """Compute a hash over everything the generated build file depends on:
+
+     - the command line options (and the directory rossum was started from,
+       as paths on the command line may be relative)
+     - the state of all manifests that were discovered
+     - the contents of 'input_files' (robot.ini, the template, env files, ..)
+     - the locations of the FANUC and rossum tools in 'tools'
+     - the state of the headers in 'header_dirs' (used for tp-interfaces)
+
+    What is expensive to compute (the artifact keys) or is written by rossum
+    itself (the tp-interface programs) is checked by fingerprint_up_to_date.
+    """
+    inputs = {
+        'version'   : ROSSUM_VERSION,
+        'cwd'       : os.getcwd(),
+        'args'      : {k: v for k, v in vars(args).items() if k not in FINGERPRINT_IGNORED_ARGS},
+        'pkg_path'  : os.environ.get(ENV_PKG_PATH),
+        'manifests' : {p: file_stamp(p) for p in manifest_paths},
+        'files'     : {},
+        'tools'     : tools,
+        'headers'   : {},
+    }
+    for fpath in input_files:
+        try:
+            with open(fpath, 'rb') as f:
+                inputs['files'][fpath] = hashlib.sha1(f.read()).hexdigest()
+        except OSError:
+            inputs['files'][fpath] = None
+    for d in header_dirs:
+        if os.path.isdir(d):
+            for fl in os.listdir(d):
+                if fl.endswith('.klh'):
+                    inputs['headers'][os.path.join(d, fl)] = file_stamp(os.path.join(d, fl))
+
+    blob = json.dumps(inputs, sort_keys=True, default=str)
+    return hashlib.sha1(blob.encode('utf-8')).hexdigest()
+
+
+def fingerprint_up_to_date(path, fingerprint):
+    """True if the fingerprint file at 'path' was written for 'fingerprint',
+    none of the files it has the stamps of changed (or were removed) since,
+    and the artifact store has the same entries.
+    """
+    try:
+        with open(path, 'r') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return False
+    if not isinstance(data, dict) or data.get('fingerprint') != fingerprint:
+        return False
+    if any(file_stamp(p) != stamp for p, stamp in data['stamps'].items()):
+        return False
+    return all(os.path.isdir(entry) == present for entry, present in data['store_entries'].items())
+
+
+def create_dependency_graph(source_pkgs, registry, args):
     """
     Creates dependency graph for build
-    Maps dependency pkg names to RossumPackage instances
+    Maps dependency pkg names to RossumPackage instances (looked up in the
+    PackageRegistry 'registry')
     """
     # debug: show user source packages to resolve dependencies for
     pkg_names = [p.manifest.name for p in source_pkgs]
@@ -792,53 +1495,58 @@ def create_dependency_graph(source_pkgs, all_pkgs, args):
 
     #start a dependency graph
     dep_graph = Graph()
+    # set to track visited packages to avoid circular referencing. It is shared
+    # by all roots, so every package is only expanded once
+    visited = set()
     for pkg in source_pkgs:
-        # set to track visited packages to avoid circular referencing
-        visited = set()
-        # add to final_pkgs object
         # set package as a root on dependency tree
         dep_graph.setRoot(pkg.manifest.name, pkg.manifest.version)
-        deps = pkg.manifest.depends
-        if (args.inc_tests):
-          deps.extend(pkg.manifest.test_depends)
-        if(args.build_interface):
-          deps.extend(pkg.manifest.interfaces_depends)
         # Search through dependencies and add to dep graph and to
         # dependencies in RossumPackage collection
-        add_dependency(pkg, visited, args, dep_graph, all_pkgs)
-    
+        add_dependency(pkg, visited, args, dep_graph, registry)
+
+    # circular dependencies are allowed, but the user should know about them
+    for cycle in dep_graph.cycles():
+        logger.warning("Circular dependency: {}".format(' -> '.join(cycle)))
+
     return dep_graph
 
-def add_dependency(src_package, visited, args, graph, pkgs):
+def pkg_depends(pkg, args):
+    """Names of the packages 'pkg' depends on, including test and interface
+    dependencies if those were requested.
+    """
+    deps = list(pkg.manifest.depends)
+    if (args.inc_tests):
+        deps.extend(pkg.manifest.test_depends)
+    if (args.build_interface):
+        deps.extend(pkg.manifest.interfaces_depends)
+    # a package can be listed more than once (ie: as a test dependency too)
+    return list(collections.OrderedDict.fromkeys(deps))
+
+def add_dependency(src_package, visited, args, graph, registry):
     """build out dependency tree, traversing dependencies in the parent node.
     """
-    if src_package.manifest.name not in visited:
-        logger.debug("  {}:".format(src_package.manifest.name))
-        for depend_name in src_package.manifest.depends:
-            dep_pkg = find_in_list(pkgs, lambda p: p.manifest.name == depend_name)
+    stack = [src_package]
+    while stack:
+        pkg = stack.pop()
+        if pkg.manifest.name in visited:
+            continue
+        # track to visited set to avoid circular dependencies
+        visited.add(pkg.manifest.name)
+        logger.debug("  {}:".format(pkg.manifest.name))
+        dep_pkgs = []
+        for depend_name in pkg_depends(pkg, args):
+            dep_pkg = registry.get(depend_name)
             if dep_pkg is None:
                 raise MissingPkgDependency("Error finding internal pkg instance for '{}', "
                     "can't find it".format(depend_name))
             # add graph edge and put dependencies into RossumPackage Object
-            graph.addEdge(src_package.manifest.name, depend_name, dep_pkg.manifest.version, False)
+            graph.addEdge(pkg.manifest.name, depend_name, dep_pkg.manifest.version, False)
             logger.debug("    {}: found".format(depend_name))
-            src_package.dependencies.append(dep_pkg)
-            # after dependency has been added track to visited set to avoid circular dependencies
-            visited.add(src_package.manifest.name)
-            #if depend package has dependencies search for those as well
-            deps = dep_pkg.manifest.depends
-            if (args.inc_tests):
-              if len(deps) > 0:
-                deps.extend(dep_pkg.manifest.test_depends)
-              else:
-                deps = dep_pkg.manifest.test_depends
-            if(args.build_interface):
-              if len(deps) > 0:
-                deps.extend(dep_pkg.manifest.interfaces_depends)
-              else:
-                deps = dep_pkg.manifest.interfaces_depends
-            if len(deps) > 0:
-                add_dependency(dep_pkg, visited, args, graph, pkgs)
+            pkg.dependencies.append(dep_pkg)
+            dep_pkgs.append(dep_pkg)
+        #search dependencies of the dependencies as well (in order)
+        stack.extend(reversed(dep_pkgs))
 
 def log_dep_tree(graph):
     """write depedency trees from source packages
@@ -856,25 +1564,19 @@ def log_dep_tree(graph):
                 logger.debug("  {}".format(line))
 
 
-def filter_packages(pkgs, graph):
-    """filter out packages in RossumPackage that
+def filter_packages(registry, graph):
+    """filter out packages in the PackageRegistry 'registry' that
        are not in the dependency tree
     """
-    #create new list to store applicable packages
-    filtered = []
+    #create new registry to store applicable packages
+    filtered = PackageRegistry()
     #find all root packages in the source
     pkg_names = [p.name for p in graph.root]
-    # track visited packages to avoid duplicates
-    visited = set()
-    for name in pkg_names:
-        #retrieve all packages the source package depends on
-        deps = graph.depthFirstSearch(name)
-        if len(deps) > 0:
-            for d in deps:
-                if d not in visited:
-                    filtered.append(find_in_list(pkgs, lambda p: p.manifest.name == d))
-                    visited.add(d)
-    # return filtered list of packages
+    #retrieve all packages the source packages depend on. Each package is
+    # only visited once, even if it is shared by multiple roots.
+    for d in graph.reachable(pkg_names):
+        filtered.add(registry[d])
+    # return filtered registry of packages
     return filtered
 
 
@@ -890,44 +1592,91 @@ def dedup(seq):
 
     b is now: [3 4 1 6 2]
     """
+    seen = set()
     out = []
     for e in reversed(seq):
-        if e not in out:
-            out.insert(0, e)
+        if e not in seen:
+            seen.add(e)
+            out.append(e)
+    out.reverse()
     return out
 
-def resolve_includes(pkgs, args):
+def resolve_includes(pkgs, args, graph):
     """ Gather include directories for all packages in 'pkgs'.
+
+    The include dirs of a package are those of the packages met on a
+    depth-first walk of its dependencies, the package itself first. Packages
+    are visited in topological order (dependencies first), so the walk of
+    every package is built from the walks of its dependencies, instead of
+    being repeated for all packages that depend on it.
     """
     pkg_names = [p.manifest.name for p in pkgs]
     logger.debug("Resolving includes for: {}".format(', '.join(pkg_names)))
-    
+
+    by_name = {p.manifest.name: p for p in pkgs}
+    # packages in a cycle are walked on their own (as a walk then depends on
+    # where it enters the cycle), as are the packages that depend on them
+    cyclic = set(v for scc in graph.stronglyConnected() for v in scc
+        if len(scc) > 1 or v in graph.successors(v))
+    walks = {}
+    own_dirs = {}
+    for name in graph.topologicalOrder():
+        pkg = by_name.get(name)
+        if pkg is None:
+            continue
+        own_dirs[name] = pkg_include_dirs(pkg, args)
+        deps = [d.manifest.name for d in pkg.dependencies]
+        if name in cyclic or any(walks.get(d) is None for d in deps):
+            walks[name] = None
+            continue
+        # a dependency that was already met (through an earlier dependency)
+        # is not visited again
+        walk = collections.OrderedDict([(name, None)])
+        for d in deps:
+            for v in walks[d]:
+                walk.setdefault(v)
+        walks[name] = walk
+
     for pkg in pkgs:
-        visited = set()
         logger.debug("  {}".format(pkg.manifest.name))
-        inc_dirs = dedup(resolve_includes_for_pkg(pkg, visited, args))
+        walk = walks.get(pkg.manifest.name)
+        if walk is None:
+            inc_dirs = resolve_includes_for_pkg(pkg, set(), args)
+        else:
+            inc_dirs = [d for v in walk for d in own_dirs[v]]
+        inc_dirs = dedup(inc_dirs)
         pkg.include_dirs.extend(inc_dirs)
         logger.debug("    added {} path(s)".format(len(inc_dirs)))
 
 
+def pkg_include_dirs(pkg, args):
+    """ Absolute include directories of 'pkg' itself (not of its dependencies).
+    """
+    inc_dirs = []
+    for inc_dir in pkg.manifest.includes:
+        inc_dirs.append(os.path.abspath(os.path.join(pkg.location, inc_dir)))
+    if (args.inc_tests):
+      for inc_dir in pkg.manifest.test_includes:
+        inc_dirs.append(os.path.abspath(os.path.join(pkg.location, inc_dir)))
+    return inc_dirs
+
+
 def resolve_includes_for_pkg(pkg, visited, args):
-    """ Recursively gather include directories for a specific package.
+    """ Gather include directories for a specific package, and (depth-first)
+    for all of its dependencies not in 'visited'.
     Makes all include directories absolute as well.
     """
     inc_dirs = []
-    if pkg.manifest.name not in visited:
+    stack = [pkg]
+    while stack:
+        pkg = stack.pop()
+        if pkg.manifest.name in visited:
+            continue
         # include dirs of current pkg first
-        for inc_dir in pkg.manifest.includes:
-            abs_inc = os.path.abspath(os.path.join(pkg.location, inc_dir))
-            inc_dirs.append(abs_inc)
-        if (args.inc_tests):
-          for inc_dir in pkg.manifest.test_includes:
-            abs_inc = os.path.abspath(os.path.join(pkg.location, inc_dir))
-            inc_dirs.append(abs_inc)
+        inc_dirs.extend(pkg_include_dirs(pkg, args))
         visited.add(pkg.manifest.name)
         # then ask dependencies
-        for dep_pkg in pkg.dependencies:
-            inc_dirs.extend(resolve_includes_for_pkg(dep_pkg, visited, args))
+        stack.extend(reversed(pkg.dependencies))
     return inc_dirs
 
 def resolve_macros(pkgs, args):
@@ -940,79 +1689,281 @@ def resolve_macros(pkgs, args):
         pkg.macros.extend(pkg.manifest.macros)
 
 
-def get_interfaces(pkgs):
+_routine_parser = None
+
+def routine_parser():
+    """Returns the (shared) parser for routine declarations. The LALR tables
+    are only computed the first time rossum runs, after which lark loads them
+    from its cache.
+    """
+    global _routine_parser
+    if _routine_parser is None:
+        _routine_parser = lark.Lark(ROUTINE_DECL_GRAMMAR, start='decl',
+            parser='lalr', cache=True)
+    return _routine_parser
+
+
+def parse_routine_decl(text):
+    """Parse a single routine declaration. Returns a tuple of the name of the
+    routine, a list of (name, type) arguments and the return type ('' if the
+    routine is not a function).
+    """
+    def type_str(tree):
+        words = []
+        for word in tree.children:
+            s = str(word.children[0])
+            if len(word.children) > 1:
+                s += '[{}]'.format(','.join(str(d) for d in word.children[1].children))
+            words.append(s)
+        return ' '.join(words)
+
+    tree = routine_parser().parse(text)
+    name = str(tree.children[0])
+    arguments = []
+    return_type = ''
+    for child in tree.children[1:-1]:
+        if child.data == 'params':
+            for group in child.children:
+                typ = type_str(group.children[-1])
+                arguments.extend((str(n), typ) for n in group.children[:-1])
+        elif child.data == 'return_type':
+            return_type = type_str(child.children[0])
+    return name, arguments, return_type
+
+
+def base_type(typ):
+    """Returns the name of a (possibly parameterised) KAREL type, ie: STRING
+    for 'STRING[16]' or XYZWPR for 'XYZWPR IN GROUP[2]'.
+    """
+    return typ.split('[')[0].split()[0] if typ else typ
+
+
+def index_header(fpath, cache=None):
+    """Find all routine declarations in the header file 'fpath'. Returns a
+    dict mapping routine names to KarelRoutine instances.
+
+    The result is cached, keyed on the mtime and size of the header.
+    """
+    st = os.stat(fpath)
+    entry = cache.get('headers', fpath) if cache is not None else None
+    if entry is not None and entry['mtime'] == st.st_mtime_ns and entry['size'] == st.st_size:
+        cache.hit('headers')
+    else:
+        routines = {}
+        with open(fpath, 'r') as f:
+            text = f.read()
+        for m in ROUTINE_DECL_PATTERN.finditer(text):
+            try:
+                name, arguments, ret_type = parse_routine_decl(m.group())
+            except lark.exceptions.LarkError as e:
+                logger.debug("Could not parse routine declaration in {0}: '{1}' ({2})".format(
+                    fpath, ' '.join(m.group().split()), str(e).splitlines()[0]))
+                continue
+            if name not in routines:
+                routines[name] = [arguments, ret_type]
+        entry = {'mtime': st.st_mtime_ns, 'size': st.st_size, 'routines': routines}
+        if cache is not None:
+            cache.miss('headers')
+
+    if cache is not None:
+        cache.put('headers', fpath, entry)
+    return {name: KarelRoutine(name=name, file=fpath,
+                arguments=[tuple(a) for a in arguments], return_type=ret_type)
+            for name, (arguments, ret_type) in entry['routines'].items()}
+
+
+def index_include_dir(inc_dir, cache=None):
+    """Find all routine declarations in the headers in 'inc_dir'. If a
+    routine is declared in more than one header, the first one wins.
+    """
+    routines = {}
+    for fl in os.listdir(inc_dir):
+        if fl.endswith('.' + HEADER_SUFFIX):
+            for name, routine in index_header(os.path.join(inc_dir, fl), cache).items():
+                routines.setdefault(name, routine)
+    return routines
+
+
+def get_interfaces(pkgs, cache=None):
     """Get all of the TP interfaces specified in package.json, and store them
     as TPInterfaces collections.
     """
     programs = []
     for pkg in pkgs:
-        for include in  pkg.manifest.includes:
-            #get all .klh files in include directory
+        if not pkg.manifest.interfaces:
+            continue
+
+        #index all routines declared in the headers of the package
+        routines = {}
+        for include in pkg.manifest.includes:
             if not os.path.isabs(include):
-              f_name = pkg.location + '\\' + include
+              inc_dir = os.path.join(pkg.location, include)
             else:
-              f_name = include
-            inc_files = [f_name + "\\" + fl for fl in os.listdir(f_name) if fl.endswith(".klh")]
-            for interface in pkg.manifest.interfaces:
-                found_routine = False
-                #match routine specified in tp-interfaces
-                #interface['name'] will be the full name of the program
-                #interface['alias'] will be the 12 character limit program name sent to the controller
-                pattern = r"(?:ROUTINE\s*{0})\s*\(?(?:\s*(\w+)\s*\:\s*(\w+)\s*;?)*\)?\s*(?:\:\s*(\w+))?\s*(?:FROM\s*\w+)".format(interface['routine'])
-                for fname in inc_files:
-                    if found_routine : break #have found the routine and parsed move to next interface
-                    #search through each .klh file
-                    with open(fname,"r") as f:
-                        lines = f.readlines()
-                        for ln in lines :
-                            m = re.match(pattern, ln)
-                            if m:
-                                #find all of the arguments and their types
-                                # *** This will not work if formated
-                                # *** ROUTINE t(v1,v2,v3 : INTEGER)
-                                # *** must be formatted
-                                # *** ROTUINE t(v1 : INTEGER; v2 : INTEGER; v3 : INTEGER)
-                                routine = m.group()
-                                var_matches = re.findall(r"(\w+)\s*\:\s*(\w+)\s*(;|\))",routine)
-                                arguments = []
-
-                                if 'default_params' in interface:
-                                  #convert keys to integers
-                                  default_args = {int(k)-1:v for k,v in interface['default_params'].items()}
-                                else:
-                                  default_args = {}
-                                
-                                #for var_matches with index
-                                for i, v in enumerate(var_matches):
-                                  if i in default_args:
-                                    arguments.append([v[0], v[1], default_args[i]])
-                                  else:
-                                    arguments.append([v[0], v[1], None])
-
-                                #store return type
-                                if m.group(3):
-                                  ret_type = m.group(3)
-                                else:
-                                  ret_type = ''
-
-                                programs.append(TPInterfaces(
-                                    name= interface['routine'],
-                                    alias= interface['program_name'],
-                                    include_file= os.path.basename(fname),
-                                    path= '{}\\tp\\{}.kl'.format(pkg.location, interface['program_name']),
-                                    depends= pkgs[0].manifest.interfaces_depends,
-                                    arguments= arguments,
-                                    return_type= ret_type
-                                ))
-                                # outer loop break control
-                                found_routine = True
-                                break
+              inc_dir = include
+            for name, routine in index_include_dir(inc_dir, cache).items():
+                routines.setdefault(name, routine)
+
+        for interface in pkg.manifest.interfaces:
+            #match routine specified in tp-interfaces
+            #interface['name'] will be the full name of the program
+            #interface['alias'] will be the 12 character limit program name sent to the controller
+            routine = routines.get(interface['routine'])
+            if routine is None:
+                logger.warning("Could not find a declaration of routine '{0}' (tp-interface "
+                    "'{1}') in the headers of {2}".format(interface['routine'],
+                        interface['program_name'], pkg.manifest.name))
+                continue
+
+            if 'default_params' in interface:
+              #convert keys to integers
+              default_args = {int(k)-1:v for k,v in interface['default_params'].items()}
+            else:
+              default_args = {}
+
+            arguments = []
+            for i, (arg_name, arg_type) in enumerate(routine.arguments):
+              arguments.append([arg_name, base_type(arg_type), default_args.get(i)])
+
+            programs.append(TPInterfaces(
+                name= interface['routine'],
+                alias= interface['program_name'],
+                include_file= os.path.basename(routine.file),
+                path= os.path.join(pkg.location, 'tp', '{}.kl'.format(interface['program_name'])),
+                depends= pkgs[0].manifest.interfaces_depends,
+                arguments= arguments,
+                return_type= base_type(routine.return_type)
+            ))
 
     return programs
 
+def compile_interface(interface):
+    """Compile the TPInterfaces 'interface' into a TPProgram, the description
+    of the Karel program that wraps the routine. All decisions about the
+    generated code are made here, render_interface only fills them in.
+    """
+    ret_type = interface.return_type.lower()
+    ret_pose = ret_type in TP_POSE_TYPES
+    arguments = [(name, typ, typ.lower(), default) for name, typ, default in interface.arguments]
+
+    variables = []
+    if ret_type:
+        variables.append(('out_reg', 'INTEGER'))
+        if ret_pose:
+            variables.append(('out_grp', 'INTEGER'))
+
+    # pose arguments are passed in as position register numbers, per register
+    # the argument it is read into, its type and group (None for group 1)
+    getters = []
+    poses = collections.OrderedDict()
+    for i, (name, typ, ltyp, default) in enumerate(arguments, 1):
+        default = '{}'.format(default) if default else None
+        if ltyp in TP_POSE_TYPES:
+            pr_num = 'pr_num{}'.format(i)
+            variables.append((pr_num, 'INTEGER'))
+            poses[pr_num] = [name, ltyp, None]
+            getters.append((i, name, pr_num, 'int', default))
+        else:
+            getters.append((i, name, name, 'int' if ltyp == 'integer' else ltyp, default))
+        # var definition of strings must specify a size.
+        variables.append((name, 'STRING[32]' if typ == 'STRING' else typ))
+
+    # group number arguments select the group of the pose arguments, in order
+    is_groups = False
+    if poses:
+        n = 1
+        for name, _, _, _ in arguments:
+            if name.lower() in 'grp_no':
+                is_groups = True
+                if 'pr_num{}'.format(n) in poses:
+                    poses['pr_num{}'.format(n)][2] = name.lower()
+                n += 1
+
+    pose_getters = []
+    for pr_num, (name, ltyp, group) in poses.items():
+        if ltyp == 'vector':
+            pose_getters.append((name, 'tpe__get_vector_arg', pr_num))
+        else:
+            pose_getters.append((name, 'pose__get_posreg_{}'.format(TP_POSE_ACCESSORS[ltyp]),
+                '{0}, {1}'.format(pr_num, group or 1)))
+
+    includes = ['tpe.vars.klh'] if variables else []
+    imports = []
+    if ret_type:
+        imports.append(('registers.klh', 'set_{}'.format('int' if ret_type == 'integer' else ret_type)))
+    imports.append(('pose.klh', 'get_posreg_xyz, get_posreg_joint, set_posreg_xyz, '
+        'set_posreg_joint, set_vector_to_posreg'))
+    # assuming formating is 'namespace__function'
+    imports.append((interface.include_file, interface.name.split('__')[-1]))
+
+    # the return register (and group) follow the arguments of the routine
+    ret_index = grp_index = None
+    if ret_type:
+        ret_index = len(arguments) + 1
+        if ret_pose and is_groups:
+            grp_index = ret_index + 1
+
+    call = interface.name
+    if arguments:
+        call += '({})'.format(','.join(name for name, _, _, _ in arguments))
+    if ret_type:
+        t_return = 'int' if ret_type == 'integer' else ret_type
+        if ret_type in ('xyzwpr', 'position'): t_return = 'xyz'
+        if ret_type in 'jointpos': t_return = 'joint'
+        if arguments and ret_pose:
+            if t_return == 'vector':
+                call = 'pose__set_vector_to_posreg({0}, out_reg)'.format(call)
+            else:
+                call = 'pose__set_posreg_{0}({1}, out_reg, {2})'.format(t_return, call,
+                    'out_grp' if is_groups else 1)
+        else:
+            call = 'registers__set_{0}(out_reg, {1})'.format(t_return, call)
+
+    return TPProgram(
+        alias=interface.alias,
+        variables=variables,
+        includes=includes,
+        imports=imports,
+        arguments=getters,
+        poses=pose_getters,
+        ret_index=ret_index,
+        grp_index=grp_index,
+        call=call
+    )
+
+
+def render_interface(program):
+    """Render the TPProgram 'program' to Karel source.
+    """
+    declarations = ''
+    if program.variables:
+        declarations = 'VAR\n' + ''.join(TP_TEMPLATE_VAR.format(*v) for v in program.variables)
+
+    imports = ''.join(TP_TEMPLATE_INCLUDE.format(h) for h in program.includes) \
+            + ''.join(TP_TEMPLATE_IMPORT.format(*i) for i in program.imports)
+
+    body = []
+    for index, name, target, getter, default in program.arguments:
+        get = TP_TEMPLATE_GET_ARG.format(target, getter, index)
+        if default is None:
+            body.append(get)
+        else:
+            body.append(TP_TEMPLATE_DEFAULT_ARG.format(index, name, default, get))
+    body.extend(TP_TEMPLATE_ASSIGN.format(*p) for p in program.poses)
+    if program.ret_index:
+        body.append(TP_TEMPLATE_GET_ARG.format('out_reg', 'int', program.ret_index))
+    if program.grp_index:
+        body.append(TP_TEMPLATE_DEFAULT_ARG.format(program.grp_index, 'out_grp', 1,
+            TP_TEMPLATE_GET_ARG.format('out_grp', 'int', program.grp_index)))
+    body.append(TP_TEMPLATE_STATEMENT.format(program.call))
+
+    return TP_TEMPLATE.format(alias=program.alias, declarations=declarations,
+        imports=imports, body=''.join(body))
+
+
 def create_interfaces(interfaces):
     """Generates Karel program for the specified interface in package.json.
     example:
+    -- generated by rossum from the tp-interfaces of package.json, do not edit
     PROGRAM mth_abs
       %NOBUSYLAMP
       %NOLOCKGROUP
@@ -1030,167 +1981,368 @@ def create_interfaces(interfaces):
         registers__set_real(out_reg, math__abs(val))
       END mth_abs
     """
+    written = 0
     for interface in interfaces:
-        program = "PROGRAM {0}\n" \
-                  "%NOBUSYLAMP\n" \
-                  "%NOLOCKGROUP\n" \
-                  "\n".format(interface.alias)
+        program = render_interface(compile_interface(interface))
 
-        pose_types = ('position', 'xyzwpr', 'jointpos', 'vector')
-        
-        if interface.return_type or interface.arguments:
-          program += 'VAR\n'
-
-        #if return type first tpe argument should be return register
-        if interface.return_type:
-            program += '\tout_reg : INTEGER\n'
-            if interface.return_type.lower() in pose_types:
-              program += '\tout_grp : INTEGER\n'
-
-        # make arguments
-        i = 1
-        pr_dict = {}
-        for args in interface.arguments:
-            if args[1].lower() in pose_types:
-              program += '\tpr_num{0} : INTEGER\n'.format(i)
-              # key = pr_variable : val = group_num
-              # if no group num is specified mark value as 'None'
-              pr_dict['pr_num{0}'.format(i)] = {'index' : i, 'group' : 'None', 'type' : args[1].lower(), 'map_var' : args[0] }
-
-            # var definition of strings must specify a size. 
-            var_typ = args[1]
-            if var_typ == 'STRING':
-              var_typ = 'STRING[32]'
-            program += '\t{0} : {1}\n'.format(args[0], var_typ)
-            i += 1
-        
-        #flag if groups are specified
-        is_groups = False
-        #do second pass through pr_dict to replace any groups with specified arguement
-        if any(args[1].lower() in pose_types for args in interface.arguments):
-          i = 1
-          for args in interface.arguments:
-            if args[0].lower() in 'grp_no':
-              is_groups = True
-              pr_dict['pr_num{0}'.format(i)]['group'] = args[0].lower()
-              i += 1
-        
-        # load applicable tpe interfaces
-        if interface.return_type or interface.arguments:
-          program += "%include tpe.vars.klh\n"
-        
-        #use set to remove duplicates
-        load_funcs = set()
-        for args in interface.arguments:
-          t_arg = 'int' if args[1].lower() == 'integer' else args[1].lower()
-          load_funcs.add("get_{0}_arg".format(t_arg))
-        if interface.return_type:
-          load_funcs.add("get_int_arg")
-        
-        #load write to register function
-        if interface.return_type:
-          t_return = 'int' if interface.return_type.lower() == 'integer' else interface.return_type.lower()
-          program += "%from registers.klh %import set_{0}\n".format(t_return)
-
-        #include function for handling position types
-        #if 'pose' in interface.depends:
-        program += "%from pose.klh %import get_posreg_xyz, get_posreg_joint, set_posreg_xyz, set_posreg_joint, set_vector_to_posreg\n"
-
-
-        #include header files
-        func_name = interface.name.split('__')[-1] # assuming formating is 'namespace__function'
-        program += "%from {0} %import {1}\n\n".format(interface.include_file, func_name)
-        program += "BEGIN\n"
-        # tpe arguments
-        arg_list = []
-        i = 1
-        for args in interface.arguments:
-            t_arg = 'int' if args[1].lower() == 'integer' else args[1].lower()
-
-            #check for default values
-            has_default = False
-            if args[2]:
-              program += 'IF NOT tpe__parameter_exists({0}) THEN\n'.format(i)
-              has_default = True
-              program += '\t{0} = {1}\n'.format(args[0], args[2])
-              program += 'ELSE\n'
-
-            if args[1].lower() in pose_types:
-              if args[1].lower() in ['xyzwpr','position']: t_arg = 'xyz'
-              if args[1].lower() in 'jointpos': t_arg = 'joint'
-              
-              program += '\tpr_num{0} = tpe__get_int_arg({0})\n'.format(i)
-            else:
-              program += '\t{0} = tpe__get_{1}_arg({2})\n'.format(args[0], t_arg, i)
+        #save program to path. Unchanged programs are not touched, so ninja
+        #does not translate them again.
+        if write_if_changed(interface.path, program):
+            logger.debug("Generated {0}".format(interface.path))
+            written += 1
 
-            if has_default:
-              program += 'ENDIF\n'
+    logger.info("Generated {0} tp-interface program(s), {1} up-to-date".format(
+        written, len(interfaces) - written))
 
-            arg_list.append(args[0])
-            i += 1
-        
-        # add calls to retrieve position register
-        for key, value in pr_dict.items():
-          if value['type'] in ['xyzwpr','position']: value['type'] = 'xyz'
-          if value['type'] in 'jointpos': value['type'] = 'joint'
-          if value['type'] == 'vector':
-            program += '\t{0} = tpe__get_vector_arg({1})\n'.format(value['map_var'], key)
-          else:
-            if value['group'] == 'None':
-              program += '\t{0} = pose__get_posreg_{1}({2}, 1)\n'.format(value['map_var'], value['type'], key)
-            else:
-              program += '\t{0} = pose__get_posreg_{1}({2}, {3})\n'.format(value['map_var'], value['type'], key, value['group'])
 
-        
-        #set return register
-        if interface.return_type:
-          program += '\tout_reg = tpe__get_int_arg({})\n'.format(i)
-          i += 1
-        
-        #set arguement for group number if return type is a position
-        if interface.return_type.lower() in pose_types and is_groups:
-          program += 'IF NOT tpe__parameter_exists({0}) THEN\n'.format(i)
-          program += '\tout_grp = 1\n'
-          program += 'ELSE\n'
-          program += '\tout_grp = tpe__get_int_arg({})\n'.format(i)
-          program += 'ENDIF\n'
-          i += 1
-        
-        #set return and karel routine
-        if interface.return_type:
-            t_return = 'int' if interface.return_type.lower() == 'integer' else interface.return_type.lower()
-            if interface.return_type.lower() in ['xyzwpr', 'position']: t_return = 'xyz'
-            if interface.return_type.lower() in 'jointpos': t_return = 'joint'
-
-            if interface.arguments:
-              arg_str = ",".join(arg_list)
-              if interface.return_type.lower() in pose_types:
-                if t_return == 'vector':
-                  program += '\tpose__set_vector_to_posreg({0}({1}), out_reg)\n'.format(interface.name, arg_str)
-                else:
-                  if is_groups:
-                    program += '\tpose__set_posreg_{0}({1}({2}), out_reg, out_grp)\n'.format(t_return, interface.name, arg_str)
-                  else:
-                    program += '\tpose__set_posreg_{0}({1}({2}), out_reg, 1)\n'.format(t_return, interface.name, arg_str)
-              else:
-                program += '\tregisters__set_{0}(out_reg, {1}({2}))\n'.format(t_return, interface.name, arg_str)
-            else:
-              program += '\tregisters__set_{0}(out_reg, {1})\n'.format(t_return, interface.name)
+def write_if_changed(path, content):
+    """Write 'content' to 'path', unless the file already has exactly that
+    content. Returns True if the file was written.
+    """
+    if os.path.isfile(path):
+        with open(path, 'r') as f:
+            if f.read() == content:
+                return False
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+        f.write(content)
+    return True
+
+
+def interface_paths(pkgs):
+    """Paths of the tp-interface programs of 'pkgs'."""
+    return [os.path.join(pkg.location, f) for pkg in pkgs for f in pkg.manifest.interface_files]
+
+
+def remove_orphaned_interfaces(pkgs):
+    """Remove tp-interface programs generated by an earlier run of rossum
+    whose entries have since been removed from the 'tp-interfaces' of their
+    package. Generated programs are found in the 'tp' directory of every
+    package by their first line (TP_GENERATED_MARKER).
+    """
+    for pkg in pkgs:
+        tp_dir = os.path.join(pkg.location, 'tp')
+        if not os.path.isdir(tp_dir):
+            continue
+        declared = set(os.path.normcase(os.path.normpath(os.path.join(pkg.location, f)))
+            for f in pkg.manifest.interface_files)
+        for fl in sorted(os.listdir(tp_dir)):
+            path = os.path.join(tp_dir, fl)
+            if not fl.lower().endswith('.' + KL_SUFFIX) or os.path.normcase(path) in declared:
+                continue
+            try:
+                with open(path, 'r') as f:
+                    generated = f.readline().rstrip('\n') == TP_GENERATED_MARKER
+            except (OSError, UnicodeDecodeError):
+                continue
+            if generated:
+                logger.info("Removing orphaned tp-interface program {0}".format(path))
+                send2trash(path)
+
+
+def build_rules(compiletp):
+    """Rules that build an object, as (substring, rule) tuples. An object is
+    build with every rule whose substring occurs in its (lowercased) source,
+    in this order.
+    """
+    return [
+        ('.kl', 'ktrans_pc'),
+        ('.ls', 'maketp_tp' if compiletp else 'maketp_ls'),
+        ('.tpp', 'tpp_tp' if compiletp else 'tpp_ls'),
+        ('.yml', 'yaml_xml'),
+        ('.xml', 'xml_xml'),
+        ('.csv', 'csv_csv'),
+        ('.utx', 'utx_tx'),
+        ('.ftx', 'ftx_tx'),
+    ]
+
+
+def render_build_file(fl, globls):
+    """Write the build file to 'fl' without going through EmPy. The output is
+    identical to that of templates/build.ninja.em, given the same globals.
+
+    Build statements are streamed to 'fl' per object, the rule(s) of an
+    object are selected once from its source file.
+    """
+    ws = globls['ws']
+    ktrans = globls['ktrans']
+    tools = globls['tools']
+    keepgpp = globls['keepgpp']
+    preprocess_karel = globls['preprocess_karel']
+    kcache = '"{0}" '.format(globls['kcache']) if globls['kcache'] else ''
+    compiletp = globls['compiletp']
+    makeenv = globls['makeenv']
+    robot_ini = ws.robot_ini.path
+    pools = globls['pools']
+
+    def pool(name):
+        return '  pool = {0}\n'.format(name) if name in pools else ''
+
+    w = fl.write
+    w("################################################################################\n"
+      "#\n"
+      "# This file was auto-generated by rossum v{0} at {1}.\n"
+      "#\n"
+      "# Package directories searched at configuration time:\n"
+      "#\n".format(globls['rossum_version'], globls['tstamp']))
+    for pkg_dir in ws.sources:
+        w("#   {0}\n".format(pkg_dir.path))
+    w("#\n"
+      "# Packages build by this build file:\n"
+      "#\n")
+    for pkg in ws.pkgs:
+        w("#   - {0}\n".format(pkg.manifest.name.replace(" ", "_")))
+    w("#\n"
+      "# Do not modify this file. Rather, regenerate it using rossum.\n"
+      "#\n"
+      "################################################################################\n"
+      "\n\n"
+      "### build setup ################################################################\n"
+      "\n"
+      "build_dir = {0}\n"
+      "\n\n".format(ws.build.path))
+    if pools:
+        w("### pools ######################################################################\n"
+          "\n"
+          "# limit the number of concurrent jobs of the heavier FANUC tools\n")
+        for name, depth in pools.items():
+            w("pool {0}\n"
+              "  depth = {1}\n"
+              "\n".format(name, depth))
+        w("\n")
+    w("### build rules ################################################################\n"
+      "\n"
+      "# .kl -> .pc\n"
+      "#\n"
+      "# this rule always places the Karel support directory corresponding to the\n"
+      "# runtime version on the include path, as that is a globally needed path.\n"
+      "rule ktrans_pc\n" + pool('karel'))
+    if preprocess_karel:
+        w('  command = "{0}" $\n'
+          '               -q {1}{2} $\n'.format(globls['ktransw'].path, keepgpp, preprocess_karel))
+    else:
+        w('  command = {3}"{0}" $\n'
+          '               -q {1} $\n'
+          '               -MM -MP -MT $out -MF $out.d $\n'
+          '               --ktrans="{2}" $\n'.format(globls['ktransw'].path, keepgpp, ktrans.path, kcache))
+    w('               $lib_includes $\n'
+      '               /I"{0}" $\n'
+      '               $macros $\n'
+      '               $in $\n'
+      '               /ver {1} $\n'
+      '               /config "{2}"\n'
+      '  depfile = $out.d\n'
+      '  deps = gcc\n'
+      '\n'.format(ktrans.support.path, ktrans.support.version_string, robot_ini))
+
+    if compiletp:
+        w('# .ls -> .tp\n'
+          '#\n'
+          '# Run ls files through\n'
+          'rule maketp_tp\n'
+          '{2}'
+          '  command = "{0}" $\n'
+          '               $in $\n'
+          '               /config "{1}"\n'.format(tools['maketp']['path'], robot_ini, pool('tp')))
+    else:
+        w('# .ls -> .ls\n'
+          '#\n'
+          '# Run ls files through\n'
+          'rule maketp_ls\n'
+          '  command = "{0}" /y /q $\n'
+          '               $in $\n'
+          '               "$build_dir" $\n'.format(tools['maketp']['path']))
+    w('\n')
+
+    if globls['hastpp']:
+        if compiletp:
+            w('# .tpp -> .tp\n'
+              '#\n'
+              '# Run ls files through\n'
+              'rule tpp_tp\n' + pool('tp'))
         else:
-            #if not return type just run function
-            if interface.arguments:
-              arg_str = ",".join(arg_list)
-              program += '\t{0}({1})\n'.format(interface.name, arg_str)
-            else:
-              program += '\t{0}\n'.format(interface.name)
+            w('# .tpp -> .ls\n'
+              '#\n'
+              '# Run ls files through\n'
+              'rule tpp_ls\n' + pool('tp'))
+        w('  command = "{0}" $\n'
+          '               $in $\n'
+          '               -o $out {1} $\n'
+          '               {2}$\n'
+          '               {3}$\n'
+          '               $lib_includes $\n'.format(tools['tpp']['path'],
+              '-e "{0}"'.format(ws.robot_ini.env) if len(ws.robot_ini.env) > 0 else '',
+              '-k "{0}, {1}, {2}" '.format(makeenv['name'], makeenv['clear'], makeenv['config']) if makeenv else '',
+              '-p ' if keepgpp else ''))
+        if compiletp:
+            w('               && "{0}" $out /config "{1}" $\n'
+              '               && del $out\n'.format(tools['tpp']['compile'], robot_ini))
+    w('\n\n\n')
+
+    w('# .yaml -> .xml\n'
+      '#\n'
+      'rule yaml_xml\n'
+      '  command = "{0}" $\n'
+      '               $in $\n'
+      '               $out $\n'
+      '\n'
+      '# .xml -> .xml\n'
+      '#\n'
+      'rule xml_xml\n'
+      '  command = "{1}" /y /q $\n'
+      '               $in $\n'
+      '               "$build_dir" $\n'
+      '\n'
+      '# .csv -> .csv\n'
+      '#\n'
+      'rule csv_csv\n'
+      '  command = "{2}" /y /q $\n'
+      '               $in $\n'
+      '               "$build_dir" $\n'
+      '\n'.format(tools['yaml']['path'], tools['xml']['path'], tools['csv']['path']))
+    for ext, tool in (('utx', 'kcdict'), ('ftx', 'kcform')):
+        w('# .{0} -> .tx, .vr\n'
+          '#\n'
+          'rule {0}_tx\n'
+          '{4}'
+          '  command = "{1}" $\n'
+          '               {2} $\n'
+          '               $lib_includes $\n'
+          '               $in $\n'
+          '               "$build_dir" $\n'
+          '               /config "{3}"\n'
+          '\n'.format(ext, tools[tool]['path'], keepgpp, robot_ini, pool('forms')))
+
+    w('\n'
+      '### regeneration ###############################################################\n'
+      '\n'
+      '# re-run rossum (with the arguments it was last run with) whenever one of the\n'
+      '# inputs of this build file changes\n'
+      'rule rossum_regen\n'
+      '  command = {0}\n'
+      '  description = Regenerating {1}\n'
+      '  generator = 1\n'
+      '  restat = 1\n'
+      '\n'
+      'build {1}: rossum_regen | {2}\n'
+      '\n'
+      '# an input that is removed (ie: the manifest of a deleted package) triggers\n'
+      '# regeneration as well, instead of failing the build\n'
+      'build {2}: phony\n'
+      '\n\n'
+      '### build statements ###########################################################\n'
+      '\n'.format(globls['regen'].command, globls['build_file_name'], globls['regen'].inputs))
+
+    if globls.get('subninja'):
+        for path in globls['subninja']:
+            w('subninja {0}\n'.format(path))
+        return
+
+    rules = build_rules(compiletp)
+    for pkg in ws.pkgs:
+        # don't generate rules for packages that don't have any objects declared
+        if len(pkg.objects) > 0:
+            render_package(fl, pkg, rules)
+
+
+def render_package(fl, pkg, rules):
+    """Write the variables and build statements of 'pkg' to 'fl', like
+    templates/package.ninja.em does. 'rules' is the list returned by
+    build_rules(..).
+    """
+    w = fl.write
+    name = pkg.manifest.name.replace(" ", "_")
+    w('### {0} ###################\n'
+      '\n'
+      '{0}_dir = {1}\n'
+      '{0}_deps = {2}\n'
+      '{0}_include_flags = {3}\n'
+      '{0}_macros = {4}\n'
+      '\n'.format(name, pkg.location,
+          ' '.join(d.manifest.name for d in pkg.dependencies),
+          ' '.join('/I"{0}"'.format(d) for d in pkg.include_dirs),
+          ' '.join('/D{0}'.format(d) for d in pkg.macros)))
+    # the variables are the same for all objects of the package
+    variables = ('  macros = ${0}_macros\n'
+                 '  lib_includes = ${0}_include_flags\n'
+                 '  description = {0} :: '.format(name))
+    for (src, obj, _, _) in pkg.objects:
+        lsrc = src.lower()
+        w('build $build_dir\\{0}: {1}${2}_dir\\{3}\n{4}{3}\n\n'.format(obj,
+            ''.join(rule + ' ' for ext, rule in rules if ext in lsrc), name, src, variables))
+    w('\n\n')
+
+
+def package_key(pkg, compiletp, renderer, template_path):
+    """Identifies the build statements of 'pkg': changes when anything they
+    are rendered from changes.
+    """
+    key = [pkg.manifest.name, pkg.location, [d.manifest.name for d in pkg.dependencies],
+        pkg.include_dirs, pkg.macros, pkg.objects, compiletp, renderer]
+    if renderer != 'native':
+        key.append(file_stamp(template_path))
+    return hashlib.sha1(json.dumps(key).encode('utf-8')).hexdigest()
+
+
+def write_package_build_files(build_dir, pkgs, compiletp, renderer, template_path):
+    """Write the build statements of every package (with objects) to its own
+    file in the SUBNINJA_DIR of 'build_dir', with the EmPy template at
+    'template_path' or the native renderer ('renderer'). A package is only
+    rendered if its key (see package_key(..)) changed since the last run,
+    files of packages that are no longer build are removed.
+
+    Returns the paths of the files (relative to 'build_dir'), and the names
+    of the files that changed.
+    """
+    pkg_dir = os.path.join(build_dir, SUBNINJA_DIR)
+    if not os.path.isdir(pkg_dir):
+        os.makedirs(pkg_dir)
 
-        program += 'END {}'.format(interface.alias)
+    keys_path = os.path.join(build_dir, FILE_SUBNINJA_KEYS)
+    try:
+        with open(keys_path, 'r') as f:
+            keys = json.load(f)
+    except (OSError, ValueError):
+        keys = {}
+
+    rules = build_rules(compiletp)
+    template = None
+    def render(fl, pkg):
+        if renderer == 'native':
+            render_package(fl, pkg, rules)
+        else:
+            interp = em.Interpreter(
+                    output=fl, globals={'pkgs': [pkg], 'compiletp': compiletp},
+                    options={em.RAW_OPT : True, em.BUFFERED_OPT : True})
+            interp.string(template, 'package.ninja.em')
+            interp.shutdown()
+    if renderer != 'native':
+        with open(template_path) as tpl:
+            template = tpl.read()
+
+    paths = []
+    changed = []
+    new_keys = {}
+    for pkg in pkgs:
+        if len(pkg.objects) == 0:
+            continue
+        fname = '{0}.ninja'.format(pkg.manifest.name.replace(" ", "_"))
+        fpath = os.path.join(pkg_dir, fname)
+        new_keys[fname] = package_key(pkg, compiletp, renderer, template_path)
+        if keys.get(fname) != new_keys[fname] or not os.path.isfile(fpath):
+            if update_file(fpath, lambda fl: render(fl, pkg)):
+                logger.debug("Updated {0}".format(fname))
+                changed.append(fname)
+        paths.append(os.path.join(SUBNINJA_DIR, fname))
+
+    for fname in os.listdir(pkg_dir):
+        if fname.endswith('.ninja') and fname not in new_keys:
+            logger.debug("Removing {0}".format(fname))
+            os.remove(os.path.join(pkg_dir, fname))
 
-        #save program to path
-        if not os.path.exists(os.path.dirname(interface.path)):
-            os.makedirs(os.path.dirname(interface.path))
-        with open(interface.path, 'w+') as fl:
-            fl.write(program)
+    update_file(keys_path, lambda fl: json.dump(new_keys, fl, indent=1, sort_keys=True))
+    return [ninja_escape_path(p) for p in paths], changed
 
 
 def gen_obj_mappings(pkgs, mappings, args, dep_graph):
@@ -1203,6 +2355,9 @@ def gen_obj_mappings(pkgs, mappings, args, dep_graph):
     # start with assumption no tpp files are in package
     args.hastpp = False
 
+    # only the source space packages (roots of the graph) get their tests build
+    root_names = set(p.name for p in dep_graph.root)
+
     for pkg in pkgs:
         logger.debug("  {}".format(pkg.manifest.name))
 
@@ -1235,7 +2390,7 @@ def gen_obj_mappings(pkgs, mappings, args, dep_graph):
 
         # add interfaces to mappings
         if (args.build_interface):
-          if args.buildall or any(pkg.manifest.name in x.name for x in dep_graph.root):
+          if args.buildall or pkg.manifest.name in root_names:
             for src in pkg.manifest.interface_files:
               src = src.replace('/', '\\')
               for (k, v) in mappings.items():
@@ -1247,7 +2402,7 @@ def gen_obj_mappings(pkgs, mappings, args, dep_graph):
               pkg.objects.append((src, obj, build, typ))
 
         # add tests to mappings
-        if (args.inc_tests) and any(pkg.manifest.name in x.name for x in dep_graph.root):
+        if (args.inc_tests) and pkg.manifest.name in root_names:
           for src in pkg.manifest.tests:
               src = src.replace('/', '\\')
               for (k, v) in mappings.items():
@@ -1265,6 +2420,35 @@ def gen_obj_mappings(pkgs, mappings, args, dep_graph):
               pkg.objects.append((src, obj, build, typ))
 
 
+def tool_mappings(path_lst, args):
+    """Build rule information (suffixes, tool path and type of object) per
+    tool. 'path_lst' are the paths of the tools as found by find_tools(..).
+    """
+    # if only precompiling
+    if args.translate_only:
+        kl_comp_ext = KL_SUFFIX
+    else:
+        kl_comp_ext = PCODE_SUFFIX
+    # put list into dictionary for file type build rule
+    tool_paths = {
+        'ktrans' : {'from_suffix' : '0', 'to_suffix' : '0', 'path' : path_lst[0], 'type' : 'karel'},
+        'ktransw' : {'from_suffix' : KL_SUFFIX, 'interp_suffix' : kl_comp_ext, 'comp_suffix' : kl_comp_ext, 'path' : (args.ktransw or path_lst[1]), 'type' : 'karel'},
+        'yaml' : {'from_suffix' : YAML_SUFFIX, 'interp_suffix' : XML_SUFFIX,  'comp_suffix' : XML_SUFFIX, 'path' : path_lst[4], 'type' : 'data'},
+        'xml' : {'from_suffix' : XML_SUFFIX, 'interp_suffix' : XML_SUFFIX,  'comp_suffix' : XML_SUFFIX, 'path' : 'C:\\Windows\\SysWOW64\\xcopy.exe', 'type' : 'data'},
+        'csv' : {'from_suffix' : CSV_SUFFIX, 'interp_suffix' : CSV_SUFFIX,  'comp_suffix' : CSV_SUFFIX, 'path' : 'C:\\Windows\\SysWOW64\\xcopy.exe', 'type' : 'data'},
+        'kcdict' : {'from_suffix' : DICT_SUFFIX, 'interp_suffix' : COMPRESSED_SUFFIX, 'comp_suffix' : COMPRESSED_SUFFIX, 'path' : path_lst[5], 'type' : 'forms'},
+        'kcform' : {'from_suffix' : FORM_SUFFIX, 'interp_suffix' : COMPRESSED_SUFFIX, 'comp_suffix' : COMPRESSED_SUFFIX, 'path' : path_lst[5], 'type' : 'forms'}
+    }
+    #for tpp decide if just interpreting, or compiling to tp
+    if args.compiletp:
+      tool_paths['maketp'] = {'from_suffix' : TP_SUFFIX, 'interp_suffix' : TPCODE_SUFFIX, 'comp_suffix' : TPCODE_SUFFIX, 'path' : path_lst[2], 'type' : 'tp'}
+      tool_paths['tpp'] = {'from_suffix' : TPP_SUFFIX, 'interp_suffix' : TPP_INTERP_SUFFIX, 'comp_suffix' : TPCODE_SUFFIX, 'path' : path_lst[3], 'compile' : path_lst[2], 'type' : 'tp'}
+    else:
+      tool_paths['maketp'] = {'from_suffix' : TP_SUFFIX, 'interp_suffix' : TP_SUFFIX, 'comp_suffix' : TP_SUFFIX, 'path' : 'C:\\Windows\\SysWOW64\\xcopy.exe', 'type' : 'tp'}
+      tool_paths['tpp'] = {'from_suffix' : TPP_SUFFIX, 'interp_suffix' : TPP_INTERP_SUFFIX, 'comp_suffix' : TPP_INTERP_SUFFIX, 'path' : path_lst[3], 'type' : 'tp'}
+    return tool_paths
+
+
 def find_fr_install_dir(search_locs, is64bit=False):
     """Find install directory of roboguide looking through registry keys
     """
@@ -1444,7 +2628,39 @@ def parse_robotini(fpath):
         support=config['WinOLPC_Util']['Support'],
         output=config['WinOLPC_Util']['Output'],
         ftp=config['WinOLPC_Util']['Ftp'],
-        env=config['WinOLPC_Util']['Env'])
+        env=config['WinOLPC_Util']['Env'],
+        pools=dict(config[ROBOT_INI_POOLS_SECTION]) if ROBOT_INI_POOLS_SECTION in config else {})
+
+
+def resolve_pools(ini_pools, cli_pools):
+    """Determine the depth of the ninja pools, as configured in robot.ini
+    ('ini_pools', a dict) and on the command line ('cli_pools', a list of
+    NAME=DEPTH strings), the latter taking precedence. Returns an ordered dict
+    with the depths of the pools to use. A depth of 0 disables a pool.
+    """
+    depths = dict(ini_pools)
+    for pool in cli_pools:
+        if '=' not in pool:
+            logger.fatal("Invalid pool '{0}', expected NAME=DEPTH. Aborting".format(pool))
+            sys.exit(_OS_EX_DATAERR)
+        name, depth = pool.split('=', 1)
+        depths[name.strip()] = depth
+
+    for name, depth in depths.items():
+        if name not in NINJA_POOLS:
+            logger.fatal("Unknown pool '{0}' (known pools: {1}). Aborting".format(
+                name, ', '.join(NINJA_POOLS)))
+            sys.exit(_OS_EX_DATAERR)
+        if not str(depth).strip().isdigit():
+            logger.fatal("Invalid depth '{0}' for pool '{1}'. Aborting".format(depth, name))
+            sys.exit(_OS_EX_DATAERR)
+
+    pools = collections.OrderedDict()
+    for name in NINJA_POOLS:
+        if int(depths.get(name, 0)) > 0:
+            pools[name] = int(depths[name])
+    return pools
+
 
 def write_manifest(manifest, files, ipAddress):
     """Write manifest file for kpush. Catagorize out source, test,
@@ -1471,18 +2687,684 @@ def write_manifest(manifest, files, ipAddress):
         file_list[fl[1]][fl[0]] = []
 
     #save back to yaml file
-    with open(manifest, 'w') as man:
-      yaml.dump(file_list, man)
+    update_file(manifest, lambda man: yaml.dump(file_list, man))
+
+
+def update_file(path, render, ignore=None):
+    """Atomically replace 'path' with the output of 'render'. 'render' is
+    called with a temporary file next to 'path' to write to. If the result
+    has the same content as 'path' (apart from anything matched by the
+    'ignore' pattern), 'path' is left untouched.
+
+    Returns True if 'path' was replaced.
+    """
+    tmp_path = '{0}.tmp'.format(path)
+    try:
+        with open(tmp_path, 'w') as fl:
+            render(fl)
+        if os.path.isfile(path):
+            with open(path, 'r') as old, open(tmp_path, 'r') as new:
+                old_content, new_content = old.read(), new.read()
+            if ignore is not None:
+                old_content = ignore.sub('', old_content)
+                new_content = ignore.sub('', new_content)
+            if old_content == new_content:
+                os.remove(tmp_path)
+                return False
+        os.replace(tmp_path, path)
+        return True
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def write_object_map(path, build_dir, pkgs, compiletp):
+    """Record the package, source and rule of every output in the build file,
+    so build times in the ninja log can be attributed to them.
+    """
+    rules = build_rules(compiletp)
+    objects = {}
+    for pkg in pkgs:
+        for (src, obj, _, _) in pkg.objects:
+            lsrc = src.lower()
+            objects[ninja_log_key('{0}\\{1}'.format(build_dir, obj))] = {
+                'package': pkg.manifest.name,
+                'source': src,
+                'rule': ' '.join(rule for ext, rule in rules if ext in lsrc),
+            }
+    update_file(path, lambda fl: json.dump(objects, fl, indent=1, sort_keys=True))
+
+
+def artifact_inputs(pkg, args):
+    """Absolute paths of the files the outputs of 'pkg' are build from: its
+    sources (and forms) and the files in its own include dirs.
+    """
+    sources = list(pkg.manifest.source)
+    if args.build_forms:
+        sources.extend(pkg.manifest.forms)
+    files = [os.path.join(pkg.location, src) for src in dedup(sources)]
+    for inc_dir in pkg_include_dirs(pkg, args):
+        for root, dirs, fls in os.walk(inc_dir):
+            dirs.sort()
+            files.extend(os.path.join(root, fl) for fl in sorted(fls))
+    return files
+
+
+def file_digest(fpath, cache):
+    """sha1 of the content of 'fpath', reused from 'cache' if the file did not
+    change since the last run.
+    """
+    stamp = file_stamp(fpath)
+    entry = cache.get('digests', fpath)
+    if entry is not None and entry[0] == stamp:
+        cache.hit('digests')
+        digest = entry[1]
+    else:
+        cache.miss('digests')
+        try:
+            with open(fpath, 'rb') as f:
+                digest = hashlib.sha1(f.read()).hexdigest()
+        except OSError:
+            digest = None
+    cache.put('digests', fpath, [stamp, digest])
+    return digest
+
+
+def artifact_key(pkg, args, core_version, keys, cache):
+    """Key of the outputs of 'pkg' in the artifact store: a hash of its name,
+    version, the core version, its macros, the contents of its inputs and the
+    keys of its dependencies (whose headers it includes). Keys are memoised in
+    'keys', per package name.
+    """
+    name = pkg.manifest.name
+    if name not in keys:
+        inputs = {
+            'format'    : ARTIFACT_FORMAT,
+            'name'      : name,
+            'version'   : pkg.manifest.version,
+            'core'      : core_version,
+            'macros'    : pkg.macros,
+            'files'     : {os.path.relpath(f, pkg.location).replace('\\', '/'): file_digest(f, cache)
+                            for f in artifact_inputs(pkg, args)},
+            'depends'   : {d.manifest.name: artifact_key(d, args, core_version, keys, cache)
+                            for d in pkg.dependencies},
+        }
+        blob = json.dumps(inputs, sort_keys=True)
+        keys[name] = hashlib.sha1(blob.encode('utf-8')).hexdigest()
+    return keys[name]
+
+
+def artifact_outputs(pkg):
+    """The outputs of 'pkg' that can be shared through an artifact store.
+    """
+    return [obj for (_, obj, _, typ) in pkg.objects if typ in ARTIFACT_TYPES]
+
+
+def artifact_path(store, name, version, key):
+    return os.path.join(store, name, version, key)
+
+
+def prefill_artifacts(store, build_dir, pkgs, keys):
+    """Copy the outputs of the 'pkgs' that have an entry in the artifact
+    'store' into 'build_dir'. Files that are already up-to-date are left
+    alone, so ninja does not consider them changed.
+
+    Returns the names of the packages that were taken from the store.
+    """
+    prefilled = []
+    for pkg in pkgs:
+        outputs = artifact_outputs(pkg)
+        entry = artifact_path(store, pkg.manifest.name, pkg.manifest.version, keys[pkg.manifest.name])
+        if not outputs or not all(os.path.isfile(os.path.join(entry, obj)) for obj in outputs):
+            logger.debug("  {0}: not in artifact store".format(pkg.manifest.name))
+            continue
+        try:
+            for obj in outputs:
+                src, dst = os.path.join(entry, obj), os.path.join(build_dir, obj)
+                if not (os.path.isfile(dst) and filecmp.cmp(src, dst, shallow=False)):
+                    shutil.copyfile(src, dst)
+        except OSError as e:
+            logger.warning("Could not copy the outputs of {0} from the artifact "
+                "store, building them: {1}".format(pkg.manifest.name, e))
+            continue
+        logger.debug("  {0}: {1} file(s) from artifact store".format(pkg.manifest.name, len(outputs)))
+        prefilled.append(pkg.manifest.name)
+    return prefilled
+
+
+def artifact_key_pkgs(pkg):
+    """'pkg' and all its dependencies: the packages its artifact key is
+    computed from.
+    """
+    pkgs, visited, todo = [], set(), [pkg]
+    while todo:
+        p = todo.pop()
+        if p.manifest.name in visited:
+            continue
+        visited.add(p.manifest.name)
+        pkgs.append(p)
+        todo.extend(p.dependencies)
+    return pkgs
+
+
+def artifact_key_inputs(pkg, args):
+    """The inputs of 'pkg' and of all its dependencies: everything its
+    artifact key is computed from.
+    """
+    return [f for p in artifact_key_pkgs(pkg) for f in artifact_inputs(p, args)]
+
+
+def artifact_input_stamps(pkgs, args):
+    """Stamps of everything the artifact keys of 'pkgs' are computed from,
+    and of the include dirs the headers are found in (which change when a
+    header is added or removed).
+    """
+    key_pkgs = collections.OrderedDict((p.manifest.name, p)
+        for pkg in pkgs for p in artifact_key_pkgs(pkg))
+    paths = []
+    for pkg in key_pkgs.values():
+        paths.extend(artifact_inputs(pkg, args))
+        for inc_dir in pkg_include_dirs(pkg, args):
+            paths.append(inc_dir)
+            paths.extend(root for root, _, _ in os.walk(inc_dir))
+    return {p: file_stamp(p) for p in paths}
+
+
+def write_artifact_record(path, store, pkgs, keys, args):
+    """Record the key, inputs and outputs of the 'pkgs' that are build in this
+    build dir, for 'rossum --publish'. The inputs are recorded with their
+    stamps, so publishing can check the outputs still belong to the key.
+    """
+    record = {
+        'store'    : store,
+        'packages' : [{
+            'name'    : pkg.manifest.name,
+            'version' : pkg.manifest.version,
+            'key'     : keys[pkg.manifest.name],
+            'inputs'  : {f: file_stamp(f) for f in artifact_key_inputs(pkg, args)},
+            'outputs' : artifact_outputs(pkg),
+        } for pkg in pkgs if artifact_outputs(pkg)],
+    }
+    update_file(path, lambda fl: json.dump(record, fl, indent=1, sort_keys=True))
+
+
+def artifact_outdated(build_dir, pkg):
+    """Why the outputs of 'pkg' (an entry of the artifact record) in
+    'build_dir' do not belong to its key, or None if they do: an input
+    changed since rossum was run, or an output is missing or older than the
+    newest input (ie: it was not build after the last change).
+    """
+    newest = 0
+    for fpath, stamp in sorted(pkg['inputs'].items()):
+        if file_stamp(fpath) != stamp:
+            return "{0} changed, run rossum again".format(fpath)
+        if stamp:
+            newest = max(newest, stamp[0])
+    for obj in pkg['outputs']:
+        stamp = file_stamp(os.path.join(build_dir, obj))
+        if stamp is None:
+            return "{0} has not been build".format(obj)
+        if stamp[0] < newest:
+            return "{0} is out of date".format(obj)
+    return None
+
+
+def publish_artifacts(store, build_dir, record):
+    """Add the outputs of the packages in 'record' to the artifact 'store'.
+    Only outputs that are up-to-date are published. Entries are written to a
+    temporary directory first, and then renamed, so other build dirs never
+    see a partial entry.
+
+    Returns the number of published, already present and outdated packages.
+    """
+    published = present = outdated_pkgs = 0
+    for pkg in record['packages']:
+        entry = artifact_path(store, pkg['name'], pkg['version'], pkg['key'])
+        if os.path.isdir(entry):
+            present += 1
+            continue
+        outdated = artifact_outdated(build_dir, pkg)
+        if outdated:
+            print("{0}: {1}, skipping".format(pkg['name'], outdated))
+            outdated_pkgs += 1
+            continue
+        tmp = '{0}.tmp-{1}'.format(entry, os.getpid())
+        try:
+            os.makedirs(tmp)
+            for obj in pkg['outputs']:
+                shutil.copyfile(os.path.join(build_dir, obj), os.path.join(tmp, obj))
+            with open(os.path.join(tmp, ARTIFACT_INFO_NAME), 'w') as f:
+                json.dump({'name': pkg['name'], 'version': pkg['version'],
+                    'outputs': pkg['outputs'], 'published': datetime.datetime.now().isoformat()}, f, indent=1)
+            os.rename(tmp, entry)
+        except OSError:
+            # published by someone else in the meantime
+            shutil.rmtree(tmp, ignore_errors=True)
+            if not os.path.isdir(entry):
+                raise
+            present += 1
+            continue
+        print("{0}: published {1} file(s)".format(pkg['name'], len(pkg['outputs'])))
+        published += 1
+    return published, present, outdated_pkgs
+
+
+def ninja_log_key(path):
+    """Normalise the path of an output, so paths from the build file and from
+    the ninja log (which uses forward slashes on Windows) compare equal.
+    """
+    return path.replace('\\', '/')
+
+
+# a single job in the ninja log (times in milliseconds since the start of the build)
+NinjaJob = collections.namedtuple('NinjaJob', 'start end output')
+
+
+def read_ninja_log(path):
+    """Parse the ninja log at 'path'. Returns the most recent job of every
+    output, and all jobs of the most recent build (in order of completion).
+    """
+    latest = collections.OrderedDict()
+    last_build = []
+    with open(path, 'r') as f:
+        header = f.readline()
+        if not header.startswith('# ninja log v'):
+            raise RuntimeError("{0} is not a ninja log".format(path))
+        for ln in f:
+            fields = ln.rstrip('\n').split('\t')
+            if len(fields) < 4:
+                continue
+            job = NinjaJob(start=int(fields[0]), end=int(fields[1]), output=fields[3])
+            # jobs are logged as they finish, so a job that ended before the
+            # previous one belongs to a later build
+            if last_build and job.end < last_build[-1].end:
+                last_build = []
+            last_build.append(job)
+            latest.pop(job.output, None)
+            latest[job.output] = job
+    return list(latest.values()), last_build
+
+
+def critical_path(jobs):
+    """Estimate the critical path of a build from the start and end times of
+    its jobs: starting at the job that finished last, repeatedly take the job
+    that finished last before the current one started. Returns the jobs on the
+    path, in order of execution.
+    """
+    path = []
+    remaining = sorted(jobs, key=lambda j: j.end)
+    while remaining:
+        job = remaining.pop()
+        path.append(job)
+        remaining = [j for j in remaining if j.end <= job.start]
+    return list(reversed(path))
+
+
+def build_stats(build_dir, top=10):
+    """Collect build time statistics from the ninja log in 'build_dir'.
+    """
+    log_path = os.path.join(build_dir, FILE_NINJA_LOG)
+    if not os.path.exists(log_path):
+        raise RuntimeError("No {0} in {1}, run ninja first".format(FILE_NINJA_LOG, build_dir))
+    objects = {}
+    objects_path = os.path.join(build_dir, FILE_OBJECTS)
+    if os.path.exists(objects_path):
+        with open(objects_path, 'r') as f:
+            objects = json.load(f)
+
+    def describe(job):
+        info = objects.get(ninja_log_key(job.output), {})
+        return {
+            'output': job.output,
+            'package': info.get('package', '(other)'),
+            'source': info.get('source', ''),
+            'rule': info.get('rule', ''),
+            'time': (job.end - job.start) / 1000.0,
+        }
+
+    latest, last_build = read_ninja_log(log_path)
+    jobs = [describe(job) for job in latest]
+
+    def totals(key):
+        result = {}
+        for job in jobs:
+            entry = result.setdefault(job[key] or '(none)', [0.0, 0])
+            entry[0] += job['time']
+            entry[1] += 1
+        return [{key: name, 'time': t, 'jobs': n}
+            for name, (t, n) in sorted(result.items(), key=lambda e: -e[1][0])]
+
+    path = critical_path(last_build)
+    return {
+        'jobs': len(jobs),
+        'total_time': sum(j['time'] for j in jobs),
+        'packages': totals('package'),
+        'rules': totals('rule'),
+        'slowest': sorted(jobs, key=lambda j: -j['time'])[:top],
+        'critical_path': {
+            'time': (path[-1].end - path[0].start) / 1000.0 if path else 0.0,
+            'jobs': [describe(job) for job in path],
+        },
+    }
+
+
+def format_stats(stats):
+    """Human readable version of the result of build_stats(..).
+    """
+    lines = ['{0} outputs, {1:.1f} s of build time in total'.format(
+        stats['jobs'], stats['total_time']), '']
+    lines.append('per package:')
+    lines.extend('  {0:<32} {1:>9.1f} s {2:>6} jobs'.format(e['package'], e['time'], e['jobs'])
+        for e in stats['packages'])
+    lines.extend(['', 'per rule:'])
+    lines.extend('  {0:<32} {1:>9.1f} s {2:>6} jobs'.format(e['rule'], e['time'], e['jobs'])
+        for e in stats['rules'])
+    lines.extend(['', 'slowest files:'])
+    lines.extend('  {0:>9.1f} s  {1} :: {2}'.format(j['time'], j['package'], j['source'] or j['output'])
+        for j in stats['slowest'])
+    lines.extend(['', 'critical path of the last build ({0:.1f} s):'.format(stats['critical_path']['time'])])
+    lines.extend('  {0:>9.1f} s  {1} :: {2}'.format(j['time'], j['package'], j['source'] or j['output'])
+        for j in stats['critical_path']['jobs'])
+    return '\n'.join(lines)
+
+
+def report_stats(build_dir, top, as_json):
+    """'rossum --stats': report where the build time of 'build_dir' went.
+    """
+    try:
+        stats = build_stats(build_dir, top)
+    except RuntimeError as e:
+        sys.exit(str(e))
+    if as_json:
+        print(json.dumps(stats, indent=2))
+    else:
+        print(format_stats(stats))
+
+
+def publish(build_dir, store=None):
+    """'rossum --publish': add the outputs of the dependency packages build in
+    'build_dir' to the artifact store it was configured with (or to 'store').
+    """
+    record_path = os.path.join(build_dir, FILE_ARTIFACTS)
+    if not os.path.isfile(record_path):
+        sys.exit("{0} was not configured with an artifact store (no {1})".format(
+            build_dir, FILE_ARTIFACTS))
+    with open(record_path, 'r') as f:
+        record = json.load(f)
+
+    store = os.path.abspath(store) if store else record['store']
+    published, present, outdated = publish_artifacts(store, build_dir, record)
+    print("Published {0} package(s) to {1}, {2} already present".format(published, store, present))
+    if outdated:
+        sys.exit(1)
+
+
+class PackageRegistry:
+    """All discovered packages, indexed by package name.
+
+    A package can be found at more than one location (ie: in the source space
+    as well as on the ROSSUM_PKG_PATH). All candidates are kept, in order of
+    discovery, but lookups always return the first one: packages that were
+    added first take precedence. Iterating over a registry yields only those
+    packages, in order of discovery.
+
+    Packages can also be added by name and manifest location only (see
+    'index(..)'). Their manifest is then parsed by 'loader' the first time the
+    package is looked up. Membership tests and len(..) only count packages
+    that parse, so they resolve the candidates they need: len(..) parses every
+    manifest that has not been parsed yet.
+    """
+
+    def __init__(self, pkgs=None, loader=None):
+        self._candidates = collections.OrderedDict()
+        self.loader = loader
+        if pkgs is not None:
+            self.extend(pkgs)
+
+    def add(self, pkg):
+        self._candidates.setdefault(pkg.manifest.name, []).append(pkg)
+
+    def extend(self, pkgs):
+        for pkg in pkgs:
+            self.add(pkg)
+
+    def index(self, entries):
+        """Add (name, manifest path) tuples, as returned by index_pkgs(..).
+        """
+        for name, manifest_path in entries:
+            self._candidates.setdefault(name, []).append(manifest_path)
+
+    def _resolve(self, name):
+        """Parse the manifest of the first candidate for 'name' if that
+        hasn't been done yet. Candidates that fail to parse are dropped.
+        """
+        candidates = self._candidates.get(name)
+        while candidates and isinstance(candidates[0], str):
+            pkg = self.loader(candidates[0])
+            if pkg is not None and pkg.manifest.name != name:
+                logger.warning("Manifest {0} declares package '{1}', expected '{2}'".format(
+                    candidates[0], pkg.manifest.name, name))
+                pkg = None
+            if pkg is None:
+                candidates.pop(0)
+            else:
+                candidates[0] = pkg
+        if not candidates:
+            self._candidates.pop(name, None)
+            return None
+        return candidates[0]
+
+    def get(self, name, default=None):
+        pkg = self._resolve(name)
+        return pkg if pkg is not None else default
+
+    def candidates(self, name):
+        """Return the locations of all packages found for 'name', in order of
+        precedence.
+        """
+        return [os.path.dirname(c) if isinstance(c, str) else c.location
+            for c in self._candidates.get(name, [])]
+
+    def manifest_paths(self):
+        """Return the manifest locations of all candidates of all packages.
+        """
+        return [c if isinstance(c, str) else c.manifest_path
+            for candidates in self._candidates.values() for c in candidates]
+
+    def log_shadowed(self):
+        for name in self._candidates:
+            locations = self.candidates(name)
+            if len(locations) > 1:
+                logger.debug("Package '{0}' found at {1} location(s), using: {2}".format(
+                    name, len(locations), locations[0]))
+                for loc in locations[1:]:
+                    logger.debug("  ignoring: {0}".format(loc))
+
+    def __getitem__(self, name):
+        pkg = self._resolve(name)
+        if pkg is None:
+            raise KeyError(name)
+        return pkg
+
+    def __contains__(self, name):
+        return self._resolve(name) is not None
+
+    def __iter__(self):
+        for name in list(self._candidates):
+            pkg = self._resolve(name)
+            if pkg is not None:
+                yield pkg
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+class RossumCache:
+    """Persistent store for state that can be reused between invocations of
+    rossum (directory listings, parsed manifests, ..).
+
+    Entries are read from the state saved by the previous run, and only the
+    entries that are put back during this run are saved again. This makes
+    sure stale entries (removed directories, deleted manifests) get dropped.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.old = {}
+        self.new = {}
+        self.hits = collections.Counter()
+        self.misses = collections.Counter()
+        # discovery fills the cache from several threads
+        self.lock = threading.Lock()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning("Ignoring unreadable cache {0}: {1}".format(self.path, e))
+            return
+        if data.get('version') != CACHE_VERSION:
+            logger.debug("Discarding cache with version {0}".format(data.get('version')))
+            return
+        self.old = data.get('sections', {})
+
+    def save(self):
+        sections = dict(self.old)
+        sections.update(self.new)
+        try:
+            with open(self.path, 'w') as f:
+                json.dump({'version': CACHE_VERSION, 'sections': sections}, f)
+        except OSError as e:
+            logger.warning("Could not write cache {0}: {1}".format(self.path, e))
+
+    def get(self, section, key):
+        return self.old.get(section, {}).get(key)
+
+    def put(self, section, key, value):
+        with self.lock:
+            self.new.setdefault(section, {})[key] = value
+
+    def keep(self, section):
+        """Carry the entries of 'section' saved by the previous run over to
+        the next, unless they were put again during this run.
+        """
+        with self.lock:
+            entries = self.new.setdefault(section, {})
+            for key, value in self.old.get(section, {}).items():
+                entries.setdefault(key, value)
+
+    def hit(self, section):
+        with self.lock:
+            self.hits[section] += 1
+
+    def miss(self, section):
+        with self.lock:
+            self.misses[section] += 1
+
+
+class Profiler:
+    """Records the wall time of the stages of a configuration, together with
+    counts (packages, objects, ..) and the hits and misses of the rossum
+    cache during each stage.
+
+    Stages are consecutive: starting a stage ends the previous one.
+    """
+
+    def __init__(self):
+        self.origin = time.perf_counter()
+        self.stages = []
+        self.current = None
+        # RossumCache to report the hit rates of, if any
+        self.cache = None
+        self._cache_counts = None
+
+    def stage(self, name):
+        self.end()
+        self.current = {
+            'name': name,
+            'start': time.perf_counter() - self.origin,
+            'counts': collections.OrderedDict(),
+        }
+        self._cache_counts = self.cache_counts()
+
+    def count(self, key, n):
+        if self.current is not None:
+            self.current['counts'][key] = self.current['counts'].get(key, 0) + n
+
+    def end(self):
+        if self.current is None:
+            return
+        stage, self.current = self.current, None
+        stage['duration'] = time.perf_counter() - self.origin - stage['start']
+
+        hits, misses = self.cache_counts()
+        start_hits, start_misses = self._cache_counts
+        stage['cache'] = collections.OrderedDict()
+        for section in sorted(set(hits) | set(misses)):
+            h = hits[section] - start_hits[section]
+            m = misses[section] - start_misses[section]
+            if h or m:
+                stage['cache'][section] = {'hits': h, 'misses': m, 'hit_rate': h / float(h + m)}
+        self.stages.append(stage)
+
+    def cache_counts(self):
+        if self.cache is None:
+            return collections.Counter(), collections.Counter()
+        with self.cache.lock:
+            return collections.Counter(self.cache.hits), collections.Counter(self.cache.misses)
+
+    def write(self, path, fmt='json'):
+        """Write the recorded stages to 'path', either as plain JSON or in the
+        Chrome trace event format ('chrome').
+        """
+        self.end()
+        if fmt == 'chrome':
+            events = []
+            for stage in self.stages:
+                args = dict(stage['counts'])
+                args.update(('cache_{0}'.format(section), c) for section, c in stage['cache'].items())
+                events.append({'name': stage['name'], 'cat': 'rossum', 'ph': 'X',
+                    'ts': int(stage['start'] * 1e6), 'dur': int(stage['duration'] * 1e6),
+                    'pid': os.getpid(), 'tid': 0, 'args': args})
+            data = {'traceEvents': events, 'displayTimeUnit': 'ms'}
+        else:
+            data = {
+                'rossum_version': ROSSUM_VERSION,
+                'total': time.perf_counter() - self.origin,
+                'stages': self.stages,
+            }
+        with open(path, 'w') as f:
+            json.dump(data, f, indent=1)
 
 
 #Class to represent a graph 
 class Graph:
+    """Package dependency graph.
+
+    All traversals are iterative, so deep dependency chains cannot exceed the
+    recursion limit. Strongly connected components (packages that depend on
+    each other in a cycle) are computed once (Tarjan's algorithm) and used
+    for the transitive closures, the topological order and cycle reports.
+    These are cached until the graph is modified.
+    """
 
     def __init__(self, root=None, version=None): 
         self.graph = collections.defaultdict(list) #dictionary containing adjacency List
         self.root = []
+        # all nodes, in order of insertion
+        self.nodes = collections.OrderedDict()
+        # names of direct dependencies per node (without duplicates)
+        self.adjacent = collections.defaultdict(collections.OrderedDict)
+        # lazily computed: list of sccs (dependencies first), and per node
+        # its transitive closure (shared by all nodes in an scc)
+        self._sccs = None
+        self._closures = None
         if root is not None and version is not None:
-            self.root.append(self.addPackage(root, version, True))
+            self.setRoot(root, version)
 
     def __getitem__(self, key):
         for next in self.root:
@@ -1491,28 +3373,35 @@ class Graph:
 
     def print_dependencies(self, rootname):
         depList = ''
-        
-        stack = self.depthFirstSearch(rootname)
+
+        # every package in the closure is printed only once
+        pending = set(self.closure(rootname))
         depList += '<{}> {} {x}\n'.format(rootname, self[rootname].version, x='*' if self[rootname].inSource else '')
-        stack.remove(rootname)
+        pending.discard(rootname)
+
+        # stack of (iterator over children, prefix for those children)
+        stack = []
+        def enter(pkg, prepStr):
+            out = ''
+            if pkg.name in pending:
+                out = prepStr + '<{}> {} {x}\n'.format(pkg.name, pkg.version, x='*' if pkg.inSource else '')
+                pending.discard(pkg.name)
+            stack.append((iter(self.graph[pkg.name]), '|   ' + prepStr))
+            return out
 
         for next in self.graph[rootname]:
-            depList = self.depPrintRec(next, stack, '|-- ', depList)
+            depList += enter(next, '|-- ')
+            while stack:
+                children, prepStr = stack[-1]
+                for child in children:
+                    if child.name in pending:
+                        depList += enter(child, prepStr)
+                        break
+                else:
+                    stack.pop()
 
         return depList
 
-    def depPrintRec(self, pkg, stack, prepStr, outstr):
-        if pkg.name in stack:
-            outstr += prepStr + '<{}> {} {x}\n'.format(pkg.name, pkg.version, x='*' if pkg.inSource else '')
-            stack.remove(pkg.name)
-
-        for next in self.graph[pkg.name]:
-            if next.name in stack:
-                outstr = self.depPrintRec(next, stack, '|   ' + prepStr, outstr)
-
-        return outstr
-
-  
     def addPackage(self, Name, Version, Source):
         return packages(
                 name= Name,
@@ -1521,27 +3410,154 @@ class Graph:
 
     def setRoot(self, name, version):
         self.root.append(self.addPackage(name, version, True))
+        self.nodes[name] = None
+        self._sccs = None
 
     # function to add an edge to graph 
     def addEdge(self, pNode, cNode, version, isSource):
         self.graph[pNode].append(self.addPackage(cNode, version, isSource))
-
-    def depthFirstSearch(self, start, visited=None, stack=None):
-        if visited is None:
-            visited = set()
-        if stack is None:
-            stack = []
-            
-        stack.append(start)
-        visited.add(start)
-        
-        pkg_names = set([p.name for p in self.graph[start]])
-
-        difference = pkg_names - visited
-        for next in difference:
-            self.depthFirstSearch(next,visited, stack)
-        
-        return stack
+        self.adjacent[pNode][cNode] = None
+        self.nodes[pNode] = None
+        self.nodes[cNode] = None
+        self._sccs = None
+
+    def successors(self, name):
+        """Names of the direct dependencies of 'name' (without duplicates).
+        """
+        return list(self.adjacent.get(name, ()))
+
+    def depthFirstSearch(self, start):
+        """All packages reachable from 'start' (including 'start'), in
+        depth-first pre-order.
+        """
+        return self.reachable([start])
+
+    def reachable(self, starts):
+        """All packages reachable from any of the packages in 'starts', in
+        depth-first pre-order. Shared dependencies are visited only once.
+        """
+        visited = set()
+        order = []
+        for start in starts:
+            if start in visited:
+                continue
+            visited.add(start)
+            order.append(start)
+            stack = [iter(self.successors(start))]
+            while stack:
+                for next in stack[-1]:
+                    if next not in visited:
+                        visited.add(next)
+                        order.append(next)
+                        stack.append(iter(self.successors(next)))
+                        break
+                else:
+                    stack.pop()
+        return order
+
+    def stronglyConnected(self):
+        """Strongly connected components of the graph (Tarjan), in reverse
+        topological order: a component is listed after all components it
+        depends on.
+        """
+        if self._sccs is not None:
+            return self._sccs
+
+        index = {}
+        lowlink = {}
+        on_stack = set()
+        stack = []
+        sccs = []
+        for node in self.nodes:
+            if node in index:
+                continue
+            index[node] = lowlink[node] = len(index)
+            stack.append(node)
+            on_stack.add(node)
+            work = [(node, iter(self.successors(node)))]
+            while work:
+                v, children = work[-1]
+                for w in children:
+                    if w not in index:
+                        index[w] = lowlink[w] = len(index)
+                        stack.append(w)
+                        on_stack.add(w)
+                        work.append((w, iter(self.successors(w))))
+                        break
+                    elif w in on_stack:
+                        lowlink[v] = min(lowlink[v], index[w])
+                else:
+                    work.pop()
+                    if work:
+                        u = work[-1][0]
+                        lowlink[u] = min(lowlink[u], lowlink[v])
+                    if lowlink[v] == index[v]:
+                        scc = []
+                        while True:
+                            w = stack.pop()
+                            on_stack.discard(w)
+                            scc.append(w)
+                            if w == v:
+                                break
+                        sccs.append(list(reversed(scc)))
+
+        # closures are shared by all members of an scc, and built from the
+        # (already computed) closures of the sccs it depends on
+        closures = {}
+        for scc in sccs:
+            closure = set(scc)
+            for v in scc:
+                for w in self.successors(v):
+                    if w not in closure:
+                        closure.update(closures[w])
+            closure = frozenset(closure)
+            for v in scc:
+                closures[v] = closure
+
+        self._sccs = sccs
+        self._closures = closures
+        return sccs
+
+    def closure(self, name):
+        """Set of all packages 'name' depends on (directly or indirectly),
+        including 'name' itself.
+        """
+        self.stronglyConnected()
+        return self._closures.get(name, frozenset([name]))
+
+    def topologicalOrder(self):
+        """All packages, ordered such that every package comes after the
+        packages it depends on. Packages in a cycle are kept together.
+        """
+        return [v for scc in self.stronglyConnected() for v in scc]
+
+    def cycles(self):
+        """One dependency cycle per strongly connected component that has
+        one, as a list of package names starting and ending with the same
+        package.
+        """
+        cycles = []
+        for scc in self.stronglyConnected():
+            members = set(scc)
+            start = scc[0]
+            if len(scc) == 1 and start not in self.successors(start):
+                continue
+            # breadth-first search inside the scc for the shortest way back
+            parents = {}
+            queue = collections.deque([start])
+            while queue:
+                v = queue.popleft()
+                if start in self.successors(v):
+                    path = [v]
+                    while path[-1] != start:
+                        path.append(parents[path[-1]])
+                    cycles.append(list(reversed(path)) + [start])
+                    break
+                for w in self.successors(v):
+                    if w in members and w not in parents and w != start:
+                        parents[w] = v
+                        queue.append(w)
+        return cycles
 
 
 def graph_tests():
@@ -48,6 +48,17 @@
 build_dir = @(ws.build.path)
 
 
+@[if pools]@
+### pools ######################################################################
+
+# limit the number of concurrent jobs of the heavier FANUC tools
+@[for name, depth in pools.items()]@
+pool @(name)
+  depth = @(depth)
+
+@[end for]@
+
+@[end if]@
 ### build rules ################################################################
 
 # .kl -> .pc
@@ -55,6 +66,9 @@ build_dir = @(ws.build.path)
 # this rule always places the Karel support directory corresponding to the
 # runtime version on the include path, as that is a globally needed path.
 rule ktrans_pc
+@[if 'karel' in pools]@
+  pool = karel
+@[end if]@
 @[if preprocess_karel]@
   command = "@(ktransw.path)" $
                -q @(keepgpp)@(preprocess_karel) $
@@ -67,7 +81,7 @@ rule ktrans_pc
   depfile = $out.d
   deps = gcc
 @[else]@
-  command = "@(ktransw.path)" $
+  command = @[if kcache]"@(kcache)" @[end if]"@(ktransw.path)" $
                -q @(keepgpp) $
                -MM -MP -MT $out -MF $out.d $
                --ktrans="@(ktrans.path)" $
@@ -86,6 +100,9 @@ rule ktrans_pc
 #
 # Run ls files through
 rule maketp_tp
+@[if 'tp' in pools]@
+  pool = tp
+@[end if]@
   command = "@(tools['maketp']['path'])" $
                $in $
                /config "@(ws.robot_ini.path)"
@@ -105,6 +122,9 @@ rule maketp_ls
 #
 # Run ls files through
 rule tpp_tp
+@[if 'tp' in pools]@
+  pool = tp
+@[end if]@
   command = "@(tools['tpp']['path'])" $
                $in $
                -o $out @[if len(ws.robot_ini.env) > 0]@ -e "@(ws.robot_ini.env)"@[end if]@  $
@@ -118,6 +138,9 @@ rule tpp_tp
 #
 # Run ls files through
 rule tpp_ls
+@[if 'tp' in pools]@
+  pool = tp
+@[end if]@
   command = "@(tools['tpp']['path'])" $
                $in $
                -o $out @[if len(ws.robot_ini.env) > 0]@ -e "@(ws.robot_ini.env)"@[end if]@  $
@@ -153,6 +176,9 @@ rule csv_csv
 # .utx -> .tx, .vr
 #
 rule utx_tx
+@[if 'forms' in pools]@
+  pool = forms
+@[end if]@
   command = "@(tools['kcdict']['path'])" $
                @(keepgpp) $
                $lib_includes $
@@ -163,6 +189,9 @@ rule utx_tx
 # .ftx -> .tx, .vr
 #
 rule ftx_tx
+@[if 'forms' in pools]@
+  pool = forms
+@[end if]@
   command = "@(tools['kcform']['path'])" $
                @(keepgpp) $
                $lib_includes $
@@ -171,39 +200,30 @@ rule ftx_tx
                /config "@(ws.robot_ini.path)"
 
 
-### build statements ###########################################################
+### regeneration ###############################################################
 
-@[for pkg in ws.pkgs]@
-@# don't generate rules for packages that don't have any objects declared
-@[if len(pkg.objects) > 0]@
-### @(pkg.manifest.name.replace(" ", "_")) ###################
-
-@(pkg.manifest.name.replace(" ", "_"))_dir = @(pkg.location)
-@(pkg.manifest.name.replace(" ", "_"))_deps = @(str.join(' ', [d.manifest.name for d in pkg.dependencies]))
-@(pkg.manifest.name.replace(" ", "_"))_include_flags = @(str.join(' ', ['/I"{0}"'.format(d) for d in pkg.include_dirs]))
-@(pkg.manifest.name.replace(" ", "_"))_macros = @(str.join(' ', ['/D{0}'.format(d) for d in pkg.macros]))
-
-@[for (src, obj, _, _) in pkg.objects]@
-build $build_dir\@(obj): @
-@[if '.kl' in src.lower()]@ ktrans_pc @[end if]@ @
-@[if '.ls' in src.lower() and compiletp]@ maketp_tp @[end if]@ @
-@[if '.ls' in src.lower() and not compiletp]@ maketp_ls @[end if]@ @
-@[if '.tpp' in src.lower() and compiletp]@ tpp_tp @[end if]@ @
-@[if '.tpp' in src.lower() and not compiletp]@ tpp_ls @[end if]@ @
-@[if '.yml' in src.lower()]@ yaml_xml @[end if]@ @
-@[if '.xml' in src.lower()]@ xml_xml @[end if]@ @
-@[if '.csv' in src.lower()]@ csv_csv @[end if]@ @
-@[if '.utx' in src.lower()]@ utx_tx @[end if]@ @
-@[if '.ftx' in src.lower()]@ ftx_tx @[end if]@ @
-$@(pkg.manifest.name.replace(" ", "_"))_dir\@(src)
-  macros = $@(pkg.manifest.name.replace(" ", "_"))_macros
-  lib_includes = $@(pkg.manifest.name.replace(" ", "_"))_include_flags
-  description = @(pkg.manifest.name.replace(" ", "_")) :: @(src)
+# re-run rossum (with the arguments it was last run with) whenever one of the
+# inputs of this build file changes
+rule rossum_regen
+  command = @(regen.command)
+  description = Regenerating @(build_file_name)
+  generator = 1
+  restat = 1
 
-@[end for]@
+build @(build_file_name): rossum_regen | @(regen.inputs)
 
-@# TODO: add tests
+# an input that is removed (ie: the manifest of a deleted package) triggers
+# regeneration as well, instead of failing the build
+build @(regen.inputs): phony
 
-@# pkg in ws.pkgs
-@[end if]@
+
+### build statements ###########################################################
+
+@[if subninja]@
+@# build statements of the packages are in separate files (--subninja)
+@[for path in subninja]@
+subninja @(path)
 @[end for]@
+@[else]@
+@{empy.string(package_template, 'package.ninja.em', {'pkgs': ws.pkgs})}@
+@[end if]@
@@ -4,38 +4,35 @@ bin
 prompt
 cd md:\
 
-@[if len(files['karel']) > 0]@
+@[if len(deletes['karel']) > 0]@
 @# delete pc files
 mdel @
-@[for fl in files['karel']]@
-"@(fl)" @
-@[end for]@
-
-@# delete vr files
-mdel @
-@[for fl in files['karelvr']]@
+@[for fl in deletes['karel']]@
 "@(fl)" @
 @[end for]@
 @[end if]@
 
-@[if len(files['tp']) > 0]@
+@[if len(deletes['tp']) > 0]@
 @# delete tp files
 mdel @
-@[for fl in files['tp']]@
+@[for fl in deletes['tp']]@
 "@(fl)" @
 @[end for]@
 @[end if]@
 
-@[if len(files['interface']) > 0]@
+@[if len(deletes['interface']) > 0]@
 @# del interfaces
 mdel @
-@[for fl in files['interface']]@
+@[for fl in deletes['interface']]@
 "@(fl)" @
 @[end for]@
+@[end if]@
 
+@[if len(deletes['karelvr']) > 0]@
+@# delete vr files, of the programs and interfaces
 mdel @
-@[for fl in files['interface']]@
-"@(fl.replace('.pc','.vr'))" @
+@[for fl in deletes['karelvr']]@
+"@(fl)" @
 @[end for]@
 @[end if]@
 
@@ -69,16 +66,18 @@ mput @
 @[end if]@
 
 
-@[if len(files['forms']) > 0]@
+@[if len(files['forms']) > 0 or len(deletes['forms']) > 0]@
 @# change directories for forms
 cd mf2:\
+@[if len(deletes['forms']) > 0]@
 @# delete form files
 mdel @
-@[for fl in files['forms']]@
+@[for fl in deletes['forms']]@
 "@(fl)" @
 @[end for]@
+@[end if]@
 
-@[if not delete_only]@
+@[if len(files['forms']) > 0]@
 
 @# put form files
 mput @
@@ -90,16 +89,18 @@ mput @
 @# end put
 @[end if]@
 
-@[if len(files['data']) > 0]@
+@[if len(files['data']) > 0 or len(deletes['data']) > 0]@
 @#change directories for storing data files
 cd fr:\
+@[if len(deletes['data']) > 0]@
 @# delete data files
 mdel @
-@[for fl in files['data']]@
+@[for fl in deletes['data']]@
 "@(fl)" @
 @[end for]@
+@[end if]@
 
-@[if not delete_only]@
+@[if len(files['data']) > 0]@
 
 @# upload data files
 mput @
@@ -0,0 +1,38 @@
+@# build statements of the packages in 'pkgs', included by build.ninja.em for
+@# all packages, or rendered for a single package to a separate file with
+@# --subninja. Uses 'pkgs' and 'compiletp' (and, when included, has all the
+@# globals of build.ninja.em).
+@[for pkg in pkgs]@
+@# don't generate rules for packages that don't have any objects declared
+@[if len(pkg.objects) > 0]@
+### @(pkg.manifest.name.replace(" ", "_")) ###################
+
+@(pkg.manifest.name.replace(" ", "_"))_dir = @(pkg.location)
+@(pkg.manifest.name.replace(" ", "_"))_deps = @(str.join(' ', [d.manifest.name for d in pkg.dependencies]))
+@(pkg.manifest.name.replace(" ", "_"))_include_flags = @(str.join(' ', ['/I"{0}"'.format(d) for d in pkg.include_dirs]))
+@(pkg.manifest.name.replace(" ", "_"))_macros = @(str.join(' ', ['/D{0}'.format(d) for d in pkg.macros]))
+
+@[for (src, obj, _, _) in pkg.objects]@
+build $build_dir\@(obj): @
+@[if '.kl' in src.lower()]@ ktrans_pc @[end if]@ @
+@[if '.ls' in src.lower() and compiletp]@ maketp_tp @[end if]@ @
+@[if '.ls' in src.lower() and not compiletp]@ maketp_ls @[end if]@ @
+@[if '.tpp' in src.lower() and compiletp]@ tpp_tp @[end if]@ @
+@[if '.tpp' in src.lower() and not compiletp]@ tpp_ls @[end if]@ @
+@[if '.yml' in src.lower()]@ yaml_xml @[end if]@ @
+@[if '.xml' in src.lower()]@ xml_xml @[end if]@ @
+@[if '.csv' in src.lower()]@ csv_csv @[end if]@ @
+@[if '.utx' in src.lower()]@ utx_tx @[end if]@ @
+@[if '.ftx' in src.lower()]@ ftx_tx @[end if]@ @
+$@(pkg.manifest.name.replace(" ", "_"))_dir\@(src)
+  macros = $@(pkg.manifest.name.replace(" ", "_"))_macros
+  lib_includes = $@(pkg.manifest.name.replace(" ", "_"))_include_flags
+  description = @(pkg.manifest.name.replace(" ", "_")) :: @(src)
+
+@[end for]@
+
+@# TODO: add tests
+
+@# pkg in pkgs
+@[end if]@
+@[end for]@
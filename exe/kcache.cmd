@@ -0,0 +1,3 @@
+@echo off
+REM
+"%~dp0\kcache\kcache.exe" %*
\ No newline at end of file
@@ -1,6 +1,7 @@
 param(
     [string]$penv,
-    [switch]$SetEnvVariables  # Optional switch to set environment variables
+    [switch]$SetEnvVariables,  # Optional switch to set environment variables
+    [string]$Standalone  # Optional release folder to build the standalone executables into
 )
 
 function ktransw_install {
@@ -59,6 +60,43 @@ function rossum_install {
     }
 }
 
+function standalone_build {
+    Write-Output "Building standalone rossum, kpush and kcache ..."
+
+    # build from a copy of the repo, with BUILD_STANDALONE set
+    $build = Join-Path ([System.IO.Path]::GetTempPath()) "rossum-standalone"
+    if (Test-Path $build) {
+        Remove-Item $build -Recurse -Force
+    }
+    New-Item -ItemType Directory -Path $build | Out-Null
+    Copy-Item "$PSScriptRoot\bin", "$PSScriptRoot\exe", "$PSScriptRoot\*.spec" -Destination $build -Recurse
+    $rossum_py = Join-Path $build "bin\rossum.py"
+    (Get-Content $rossum_py) -replace '^BUILD_STANDALONE = False', 'BUILD_STANDALONE = True' | Set-Content $rossum_py
+
+    Push-Location $build
+    foreach ($prog in @("rossum", "kpush", "kcache")) {
+        pyinstaller --noconfirm "$prog.spec"
+        if ($LASTEXITCODE -ne 0) {
+            Pop-Location
+            throw "pyinstaller $prog.spec failed"
+        }
+    }
+    Pop-Location
+
+    # every program gets its own folder in the release folder (rossum expects
+    # kcache\kcache.exe next to its own folder), and a .cmd to call it
+    New-Item -ItemType Directory -Path $Standalone -Force | Out-Null
+    foreach ($prog in @("rossum", "kpush", "kcache")) {
+        $target = Join-Path $Standalone $prog
+        if (Test-Path $target) {
+            Remove-Item $target -Recurse -Force
+        }
+        Copy-Item (Join-Path $build "dist\$prog") -Destination $target -Recurse
+        Copy-Item (Join-Path $build "exe\$prog.cmd") -Destination $Standalone -Force
+    }
+    Write-Output "Standalone executables written to: $Standalone"
+}
+
 # Activate Python environment if provided
 if ($penv) {
     $pactivate = Join-Path $penv "Scripts\Activate.ps1"
@@ -70,10 +108,14 @@ if ($penv) {
 $OLDPATH = [System.Environment]::GetEnvironmentVariable('PATH', 'User')
 $global:NEWPATH = $OLDPATH
 
-# Run installations
-ktransw_install
-yaml_install
-rossum_install
+# Run installations, or only build the standalone executables
+if ($Standalone) {
+    standalone_build
+} else {
+    ktransw_install
+    yaml_install
+    rossum_install
+}
 
 # Update PATH environment variable
 if ($SetEnvVariables) {
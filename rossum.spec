@@ -8,7 +8,8 @@ a = Analysis(
     ['bin\\rossum.py'],
     pathex=[],
     binaries=[],
-    datas=[('bin\\templates\\build.ninja.em', 'templates')],
+    datas=[('bin\\templates\\build.ninja.em', 'templates'),
+           ('bin\\templates\\package.ninja.em', 'templates')],
     hiddenimports=[],
     hookspath=[],
     hooksconfig={},
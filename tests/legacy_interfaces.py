@@ -0,0 +1,184 @@
+#
+# Copyright (c) 2020, kobbled
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+#
+# the tp-interface generator of rossum 0.1.7 (create_interfaces, before it
+# was split into compile_interface and render_interface), kept as the
+# reference the golden files in fixtures/interfaces/expected are checked
+# against. Generated programs did not have the TP_GENERATED_MARKER line yet.
+#
+
+
+def legacy_program(interface):
+    """The Karel program rossum 0.1.7 generated for the TPInterfaces
+    'interface'.
+    """
+    program = "PROGRAM {0}\n" \
+              "%NOBUSYLAMP\n" \
+              "%NOLOCKGROUP\n" \
+              "\n".format(interface.alias)
+
+    pose_types = ('position', 'xyzwpr', 'jointpos', 'vector')
+    
+    if interface.return_type or interface.arguments:
+      program += 'VAR\n'
+
+    #if return type first tpe argument should be return register
+    if interface.return_type:
+        program += '\tout_reg : INTEGER\n'
+        if interface.return_type.lower() in pose_types:
+          program += '\tout_grp : INTEGER\n'
+
+    # make arguments
+    i = 1
+    pr_dict = {}
+    for args in interface.arguments:
+        if args[1].lower() in pose_types:
+          program += '\tpr_num{0} : INTEGER\n'.format(i)
+          # key = pr_variable : val = group_num
+          # if no group num is specified mark value as 'None'
+          pr_dict['pr_num{0}'.format(i)] = {'index' : i, 'group' : 'None', 'type' : args[1].lower(), 'map_var' : args[0] }
+
+        # var definition of strings must specify a size. 
+        var_typ = args[1]
+        if var_typ == 'STRING':
+          var_typ = 'STRING[32]'
+        program += '\t{0} : {1}\n'.format(args[0], var_typ)
+        i += 1
+    
+    #flag if groups are specified
+    is_groups = False
+    #do second pass through pr_dict to replace any groups with specified arguement
+    if any(args[1].lower() in pose_types for args in interface.arguments):
+      i = 1
+      for args in interface.arguments:
+        if args[0].lower() in 'grp_no':
+          is_groups = True
+          pr_dict['pr_num{0}'.format(i)]['group'] = args[0].lower()
+          i += 1
+    
+    # load applicable tpe interfaces
+    if interface.return_type or interface.arguments:
+      program += "%include tpe.vars.klh\n"
+    
+    #use set to remove duplicates
+    load_funcs = set()
+    for args in interface.arguments:
+      t_arg = 'int' if args[1].lower() == 'integer' else args[1].lower()
+      load_funcs.add("get_{0}_arg".format(t_arg))
+    if interface.return_type:
+      load_funcs.add("get_int_arg")
+    
+    #load write to register function
+    if interface.return_type:
+      t_return = 'int' if interface.return_type.lower() == 'integer' else interface.return_type.lower()
+      program += "%from registers.klh %import set_{0}\n".format(t_return)
+
+    #include function for handling position types
+    #if 'pose' in interface.depends:
+    program += "%from pose.klh %import get_posreg_xyz, get_posreg_joint, set_posreg_xyz, set_posreg_joint, set_vector_to_posreg\n"
+
+
+    #include header files
+    func_name = interface.name.split('__')[-1] # assuming formating is 'namespace__function'
+    program += "%from {0} %import {1}\n\n".format(interface.include_file, func_name)
+    program += "BEGIN\n"
+    # tpe arguments
+    arg_list = []
+    i = 1
+    for args in interface.arguments:
+        t_arg = 'int' if args[1].lower() == 'integer' else args[1].lower()
+
+        #check for default values
+        has_default = False
+        if args[2]:
+          program += 'IF NOT tpe__parameter_exists({0}) THEN\n'.format(i)
+          has_default = True
+          program += '\t{0} = {1}\n'.format(args[0], args[2])
+          program += 'ELSE\n'
+
+        if args[1].lower() in pose_types:
+          if args[1].lower() in ['xyzwpr','position']: t_arg = 'xyz'
+          if args[1].lower() in 'jointpos': t_arg = 'joint'
+          
+          program += '\tpr_num{0} = tpe__get_int_arg({0})\n'.format(i)
+        else:
+          program += '\t{0} = tpe__get_{1}_arg({2})\n'.format(args[0], t_arg, i)
+
+        if has_default:
+          program += 'ENDIF\n'
+
+        arg_list.append(args[0])
+        i += 1
+    
+    # add calls to retrieve position register
+    for key, value in pr_dict.items():
+      if value['type'] in ['xyzwpr','position']: value['type'] = 'xyz'
+      if value['type'] in 'jointpos': value['type'] = 'joint'
+      if value['type'] == 'vector':
+        program += '\t{0} = tpe__get_vector_arg({1})\n'.format(value['map_var'], key)
+      else:
+        if value['group'] == 'None':
+          program += '\t{0} = pose__get_posreg_{1}({2}, 1)\n'.format(value['map_var'], value['type'], key)
+        else:
+          program += '\t{0} = pose__get_posreg_{1}({2}, {3})\n'.format(value['map_var'], value['type'], key, value['group'])
+
+    
+    #set return register
+    if interface.return_type:
+      program += '\tout_reg = tpe__get_int_arg({})\n'.format(i)
+      i += 1
+    
+    #set arguement for group number if return type is a position
+    if interface.return_type.lower() in pose_types and is_groups:
+      program += 'IF NOT tpe__parameter_exists({0}) THEN\n'.format(i)
+      program += '\tout_grp = 1\n'
+      program += 'ELSE\n'
+      program += '\tout_grp = tpe__get_int_arg({})\n'.format(i)
+      program += 'ENDIF\n'
+      i += 1
+    
+    #set return and karel routine
+    if interface.return_type:
+        t_return = 'int' if interface.return_type.lower() == 'integer' else interface.return_type.lower()
+        if interface.return_type.lower() in ['xyzwpr', 'position']: t_return = 'xyz'
+        if interface.return_type.lower() in 'jointpos': t_return = 'joint'
+
+        if interface.arguments:
+          arg_str = ",".join(arg_list)
+          if interface.return_type.lower() in pose_types:
+            if t_return == 'vector':
+              program += '\tpose__set_vector_to_posreg({0}({1}), out_reg)\n'.format(interface.name, arg_str)
+            else:
+              if is_groups:
+                program += '\tpose__set_posreg_{0}({1}({2}), out_reg, out_grp)\n'.format(t_return, interface.name, arg_str)
+              else:
+                program += '\tpose__set_posreg_{0}({1}({2}), out_reg, 1)\n'.format(t_return, interface.name, arg_str)
+          else:
+            program += '\tregisters__set_{0}(out_reg, {1}({2}))\n'.format(t_return, interface.name, arg_str)
+        else:
+          program += '\tregisters__set_{0}(out_reg, {1})\n'.format(t_return, interface.name)
+    else:
+        #if not return type just run function
+        if interface.arguments:
+          arg_str = ",".join(arg_list)
+          program += '\t{0}({1})\n'.format(interface.name, arg_str)
+        else:
+          program += '\t{0}\n'.format(interface.name)
+
+    program += 'END {}'.format(interface.alias)
+
+    return program
@@ -0,0 +1,140 @@
+#
+# Copyright (c) 2020, kobbled
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import os
+import json
+import argparse
+import collections
+
+import pytest
+
+import rossum
+
+# what the artifact store uses of a package
+FixtureManifest = collections.namedtuple('FixtureManifest',
+    'name version source forms includes test_includes')
+FixturePkg = collections.namedtuple('FixturePkg',
+    'manifest location dependencies macros objects')
+
+ARGS = argparse.Namespace(build_forms=False, inc_tests=False)
+CORE = 'V9.10-1'
+
+
+def fixture_pkg(src_dir, name, dependencies=()):
+    """A package with a source and a header, and a .pc output."""
+    location = src_dir / name
+    (location / 'src').mkdir(parents=True)
+    (location / 'include').mkdir()
+    (location / 'src' / (name + '.kl')).write_text('PROGRAM {0}\nBEGIN\nEND {0}\n'.format(name))
+    (location / 'include' / (name + '.klh')).write_text('-- {0}\n'.format(name))
+    return FixturePkg(
+        manifest=FixtureManifest(name, '0.1.0', ['src/{0}.kl'.format(name)], [], ['include'], []),
+        location=str(location),
+        dependencies=list(dependencies),
+        macros=[],
+        objects=[('src/{0}.kl'.format(name), name + '.pc', name + '.pc', 'src')])
+
+
+def keys_of(pkgs, cache):
+    keys = {}
+    for pkg in pkgs:
+        rossum.artifact_key(pkg, ARGS, CORE, keys, cache)
+    return keys
+
+
+def build(build_dir, pkgs, mtime_ns):
+    """Stand-in for ninja: write the outputs of 'pkgs' with 'mtime_ns'."""
+    for pkg in pkgs:
+        for obj in rossum.artifact_outputs(pkg):
+            path = build_dir / obj
+            path.write_text('pc of ' + pkg.manifest.name)
+            os.utime(str(path), ns=(mtime_ns, mtime_ns))
+
+
+def newest_input(pkgs):
+    return max(os.stat(f).st_mtime_ns for pkg in pkgs for f in rossum.artifact_inputs(pkg, ARGS))
+
+
+@pytest.fixture
+def workspace(tmp_path):
+    lib = fixture_pkg(tmp_path / 'src', 'lib')
+    app = fixture_pkg(tmp_path / 'src', 'app', [lib])
+    for d in ('store', 'build', 'other'):
+        (tmp_path / d).mkdir()
+    return tmp_path, [lib, app]
+
+
+def configure(tmp_path, build_dir, pkgs):
+    cache = rossum.RossumCache(str(build_dir / rossum.FILE_CACHE))
+    keys = keys_of(pkgs, cache)
+    record_path = str(build_dir / rossum.FILE_ARTIFACTS)
+    rossum.write_artifact_record(record_path, str(tmp_path / 'store'), pkgs, keys, ARGS)
+    with open(record_path) as f:
+        return keys, json.load(f)
+
+
+def test_publish_and_prefill(workspace):
+    tmp_path, pkgs = workspace
+    store, build_dir, other_dir = tmp_path / 'store', tmp_path / 'build', tmp_path / 'other'
+
+    keys, record = configure(tmp_path, build_dir, pkgs)
+    build(build_dir, pkgs, newest_input(pkgs) + 1)
+    assert rossum.publish_artifacts(str(store), str(build_dir), record) == (2, 0, 0)
+    assert rossum.publish_artifacts(str(store), str(build_dir), record) == (0, 2, 0)
+    for pkg in pkgs:
+        entry = rossum.artifact_path(str(store), pkg.manifest.name, '0.1.0', keys[pkg.manifest.name])
+        assert sorted(os.listdir(entry)) == sorted([rossum.ARTIFACT_INFO_NAME, pkg.manifest.name + '.pc'])
+
+    # another build dir takes the outputs from the store
+    prefilled = rossum.prefill_artifacts(str(store), str(other_dir), pkgs, keys)
+    assert prefilled == ['lib', 'app']
+    for pkg in pkgs:
+        obj = pkg.manifest.name + '.pc'
+        assert (other_dir / obj).read_text() == (build_dir / obj).read_text()
+
+    # unless a source changed
+    (tmp_path / 'src' / 'app' / 'src' / 'app.kl').write_text('PROGRAM app\n')
+    keys = keys_of(pkgs, rossum.RossumCache(str(other_dir / rossum.FILE_CACHE)))
+    assert rossum.prefill_artifacts(str(store), str(other_dir), pkgs, keys) == ['lib']
+
+
+def test_publish_only_up_to_date_outputs(workspace, capsys):
+    tmp_path, pkgs = workspace
+    store, build_dir = tmp_path / 'store', tmp_path / 'build'
+
+    # nothing has been build
+    _, record = configure(tmp_path, build_dir, pkgs)
+    assert rossum.publish_artifacts(str(store), str(build_dir), record) == (0, 0, 2)
+    assert 'lib.pc has not been build' in capsys.readouterr().out
+
+    # a header of lib changed since rossum was run: the key of lib, and of app
+    # that includes it, no longer match the outputs
+    build(build_dir, pkgs, newest_input(pkgs) + 1)
+    header = tmp_path / 'src' / 'lib' / 'include' / 'lib.klh'
+    header.write_text('-- changed\n')
+    os.utime(str(header), ns=(newest_input(pkgs) + 2,) * 2)
+    assert rossum.publish_artifacts(str(store), str(build_dir), record) == (0, 0, 2)
+    assert 'lib.klh changed, run rossum again' in capsys.readouterr().out
+
+    # rossum was run again, but the outputs were not build since
+    _, record = configure(tmp_path, build_dir, pkgs)
+    assert rossum.publish_artifacts(str(store), str(build_dir), record) == (0, 0, 2)
+    assert 'app.pc is out of date' in capsys.readouterr().out
+
+    # and after a build they are published
+    build(build_dir, pkgs, newest_input(pkgs) + 1)
+    assert rossum.publish_artifacts(str(store), str(build_dir), record) == (2, 0, 0)
+    assert not [d for d in os.listdir(str(store / 'lib' / '0.1.0')) if '.tmp-' in d]
@@ -0,0 +1,67 @@
+#
+# Copyright (c) 2020, kobbled
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import os
+import json
+
+import rossum
+
+
+def write_fingerprint(path, fingerprint, stamped=(), store_entries=None):
+    with open(str(path), 'w') as f:
+        json.dump({'fingerprint': fingerprint,
+            'stamps': {str(p): rossum.file_stamp(str(p)) for p in stamped},
+            'store_entries': store_entries or {}}, f)
+
+
+def test_fingerprint(tmp_path):
+    path = tmp_path / rossum.FILE_FINGERPRINT
+    assert not rossum.fingerprint_up_to_date(str(path), 'abc')
+    write_fingerprint(path, 'abc')
+    assert rossum.fingerprint_up_to_date(str(path), 'abc')
+    assert not rossum.fingerprint_up_to_date(str(path), 'def')
+    # the plain hash of earlier versions
+    path.write_text('abc')
+    assert not rossum.fingerprint_up_to_date(str(path), 'abc')
+
+
+def test_stamped_files(tmp_path):
+    # a generated tp-interface program, and a header an artifact key uses
+    program = tmp_path / 'mth_abs.kl'
+    program.write_text('PROGRAM mth_abs\n')
+    header = tmp_path / 'math.klh'
+    header.write_text('-- math\n')
+    path = tmp_path / rossum.FILE_FINGERPRINT
+    write_fingerprint(path, 'abc', [program, header])
+    assert rossum.fingerprint_up_to_date(str(path), 'abc')
+
+    program.unlink()
+    assert not rossum.fingerprint_up_to_date(str(path), 'abc')
+
+    write_fingerprint(path, 'abc', [header])
+    header.write_text('-- math, changed\n')
+    assert not rossum.fingerprint_up_to_date(str(path), 'abc')
+
+
+def test_store_entries(tmp_path):
+    entry = tmp_path / 'store' / 'math' / '0.1.0' / 'abcd'
+    path = tmp_path / rossum.FILE_FINGERPRINT
+    write_fingerprint(path, 'abc', store_entries={str(entry): False})
+    assert rossum.fingerprint_up_to_date(str(path), 'abc')
+
+    # published by another build dir since
+    os.makedirs(str(entry))
+    assert not rossum.fingerprint_up_to_date(str(path), 'abc')
@@ -0,0 +1,87 @@
+#
+# Copyright (c) 2020, kobbled
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import random
+import argparse
+
+import rossum
+
+
+ARGS = argparse.Namespace(inc_tests=False)
+
+
+def make_pkgs(depends):
+    """Packages (and their dependency graph) for 'depends', a list of
+    (name, [dependency names]) tuples. Every package has one include dir,
+    named after the package.
+    """
+    pkgs = {}
+    for name, _ in depends:
+        manifest = rossum.RossumManifest(depends=[], description='', includes=[name],
+            name=name, source=[], forms=[], tp=[], tests=[], test_depends=[],
+            test_includes=[], test_tp=[], version='0.0.1', interfaces=[],
+            interfaces_depends=[], interface_files=[], macros=[], tpp_compile_env=[])
+        pkgs[name] = rossum.RossumPackage(dependencies=[], include_dirs=[],
+            location='/ws', manifest_path='/ws/{0}/package.json'.format(name),
+            manifest=manifest, objects=[], tests=[], macros=[])
+    graph = rossum.Graph()
+    graph.setRoot(depends[0][0], '0.0.1')
+    for name, deps in depends:
+        for dep in deps:
+            graph.addEdge(name, dep, '0.0.1', False)
+            pkgs[name].dependencies.append(pkgs[dep])
+    return [pkgs[name] for name, _ in depends], graph
+
+
+def walked_includes(pkg):
+    """The include dirs of 'pkg' as found by walking its dependencies on its
+    own, which is what resolve_includes(..) must produce.
+    """
+    return rossum.dedup(rossum.resolve_includes_for_pkg(pkg, set(), ARGS))
+
+
+def names(include_dirs):
+    return [d.split('/')[-1] for d in include_dirs]
+
+
+def test_depth_first_order():
+    pkgs, graph = make_pkgs([('A', ['C', 'B']), ('B', ['C']), ('C', [])])
+    rossum.resolve_includes(pkgs, ARGS, graph)
+    assert names(pkgs[0].include_dirs) == ['A', 'C', 'B']
+    assert names(pkgs[1].include_dirs) == ['B', 'C']
+
+
+def test_cycle():
+    pkgs, graph = make_pkgs([('A', ['B', 'D']), ('B', ['C']), ('C', ['B', 'D']), ('D', [])])
+    rossum.resolve_includes(pkgs, ARGS, graph)
+    assert names(pkgs[0].include_dirs) == ['A', 'B', 'C', 'D']
+    assert names(pkgs[2].include_dirs) == ['C', 'B', 'D']
+
+
+def test_random_graphs():
+    rnd = random.Random(0)
+    for _ in range(200):
+        n = rnd.randint(1, 12)
+        cyclic = rnd.random() < 0.3
+        depends = []
+        for i in range(n):
+            candidates = [j for j in range(n) if j != i and (cyclic or j > i)]
+            deps = rnd.sample(candidates, rnd.randint(0, min(3, len(candidates))))
+            depends.append(('p{0}'.format(i), ['p{0}'.format(j) for j in deps]))
+        pkgs, graph = make_pkgs(depends)
+        expected = [walked_includes(pkg) for pkg in pkgs]
+        rossum.resolve_includes(pkgs, ARGS, graph)
+        assert [pkg.include_dirs for pkg in pkgs] == expected
@@ -0,0 +1,83 @@
+#
+# Copyright (c) 2020, kobbled
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import os
+import argparse
+
+import pytest
+
+import rossum
+from legacy_interfaces import legacy_program
+
+FIXTURE_DIR = os.path.join(
+    os.path.dirname(os.path.realpath(__file__)), 'fixtures', 'interfaces')
+EXPECTED_DIR = os.path.join(FIXTURE_DIR, 'expected')
+
+
+def fixture_interfaces():
+    args = argparse.Namespace(buildsource=True)
+    pkg = rossum.load_pkg(os.path.join(FIXTURE_DIR, 'package.json'), args)
+    return rossum.get_interfaces([pkg])
+
+
+def expected_program(interface):
+    with open(os.path.join(EXPECTED_DIR, interface.alias + '.kl'), 'r') as f:
+        return f.read()
+
+
+def make_pkg(location, interface_files):
+    manifest = rossum.RossumManifest(depends=[], description='', includes=['include'],
+        name='pkg', source=[], forms=[], tp=[], tests=[], test_depends=[],
+        test_includes=[], test_tp=[], version='0.0.1', interfaces=[],
+        interfaces_depends=[], interface_files=interface_files, macros=[],
+        tpp_compile_env=[])
+    return rossum.RossumPackage(dependencies=[], include_dirs=[], location=location,
+        manifest_path=os.path.join(location, 'package.json'), manifest=manifest,
+        objects=[], tests=[], macros=[])
+
+
+def test_remove_orphaned_interfaces(tmpdir, monkeypatch):
+    monkeypatch.setattr(rossum, 'send2trash', os.remove)
+    tp_dir = tmpdir.mkdir('tp')
+    generated = rossum.TP_GENERATED_MARKER + '\nPROGRAM {0}\nBEGIN\nEND {0}'
+    tp_dir.join('kept.kl').write(generated.format('kept'))
+    tp_dir.join('orphan.kl').write(generated.format('orphan'))
+    tp_dir.join('manual.kl').write('PROGRAM manual\nBEGIN\nEND manual')
+    tp_dir.join('prog.ls').write(rossum.TP_GENERATED_MARKER)
+
+    # no record of earlier runs is needed (ie: after --no-cache or --clean)
+    rossum.remove_orphaned_interfaces([make_pkg(str(tmpdir), ['tp/kept.kl'])])
+    assert sorted(os.listdir(str(tp_dir))) == ['kept.kl', 'manual.kl', 'prog.ls']
+
+
+def test_fixture_declarations():
+    # every interface of the fixture package was found in its headers
+    assert len(fixture_interfaces()) == 11
+
+
+@pytest.mark.parametrize('interface', fixture_interfaces(), ids=lambda i: i.alias)
+def test_golden_output(interface):
+    program = rossum.render_interface(rossum.compile_interface(interface))
+    assert program == expected_program(interface)
+
+
+@pytest.mark.parametrize('interface', fixture_interfaces(), ids=lambda i: i.alias)
+def test_golden_output_legacy(interface):
+    # the golden files are the output of the original generator, with the
+    # marker line of generated programs added
+    marker, expected = expected_program(interface).split('\n', 1)
+    assert marker == rossum.TP_GENERATED_MARKER
+    assert legacy_program(interface) == expected
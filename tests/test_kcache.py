@@ -0,0 +1,83 @@
+#
+# Copyright (c) 2020, kobbled
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import os
+import time
+import threading
+
+import pytest
+
+import kcache
+
+
+@pytest.mark.parametrize('hardlink', [False, True])
+def test_restore_removes_stale_outputs(tmp_path, hardlink):
+    # an entry of a source without a .vr file
+    entry = tmp_path / 'cache' / 'ab' / 'abcd'
+    entry.mkdir(parents=True)
+    (entry / 'pc').write_text('cached pc')
+
+    # outputs of an earlier translation of the source, that did have one
+    build = tmp_path / 'build'
+    build.mkdir()
+    (build / 'prog.pc').write_text('old pc')
+    (build / 'prog.vr').write_text('old vr')
+    (build / 'prog.d').write_text('old deps')
+
+    info = {'out': str(build / 'prog.pc'), 'depfile': str(build / 'prog.d')}
+    assert kcache.restore(str(entry), kcache.output_files(info), hardlink)
+
+    assert (build / 'prog.pc').read_text() == 'cached pc'
+    assert not (build / 'prog.vr').exists()
+    assert not (build / 'prog.d').exists()
+
+
+def test_restore_incomplete_entry(tmp_path):
+    entry = tmp_path / 'abcd'
+    entry.mkdir()
+    (tmp_path / 'prog.pc').write_text('old pc')
+
+    info = {'out': str(tmp_path / 'prog.pc'), 'depfile': None}
+    assert not kcache.restore(str(entry), kcache.output_files(info), False)
+    # left for the translation to replace
+    assert (tmp_path / 'prog.pc').read_text() == 'old pc'
+
+
+def test_stats_are_counters(tmp_path, capsys):
+    # translations run in parallel
+    events = ['hits'] * 30 + ['misses'] * 10
+    threads = [threading.Thread(target=kcache.record, args=(str(tmp_path), e)) for e in events]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert kcache.read_stats(str(tmp_path)) == {'hits': 30, 'misses': 10}
+    assert sorted(os.listdir(str(tmp_path))) == [kcache.FILE_STATS]
+    kcache.show_stats(str(tmp_path))
+    assert 'hit rate             75.0 %' in capsys.readouterr().out
+
+
+def test_stale_stats_lock(tmp_path):
+    # left behind by a killed translation
+    lock_path = tmp_path / kcache.FILE_STATS_LOCK
+    lock_path.write_text('')
+    stale = time.time() - kcache.STALE_LOCK - 1
+    os.utime(str(lock_path), (stale, stale))
+
+    kcache.record(str(tmp_path), 'hits')
+    assert kcache.read_stats(str(tmp_path)) == {'hits': 1}
+    assert not lock_path.exists()
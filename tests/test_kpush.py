@@ -0,0 +1,309 @@
+#
+# Copyright (c) 2020, kobbled
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# kpush --native against the stand-in controller of bench/fake_controller.py
+
+import os
+import sys
+import json
+import socket
+import ftplib
+
+import em
+import pytest
+import yaml
+
+pytest.importorskip('pyftpdlib')
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'bench'))
+import fake_controller
+
+import kpush
+
+pytestmark = pytest.mark.filterwarnings('ignore:write permissions assigned to anonymous user')
+
+
+@pytest.fixture(autouse=True)
+def empy_stdout_proxy(monkeypatch):
+    # empy installs a sys.stdout proxy once and never removes it, pytest
+    # replaces sys.stdout for every test
+    monkeypatch.setattr(em.Interpreter, '_wasProxyInstalled', False)
+
+
+@pytest.fixture
+def controller(tmp_path):
+    root = tmp_path / 'controller'
+    server = fake_controller.start(str(root))
+    yield root, server.address[1]
+    server.close_all()
+
+
+@pytest.fixture
+def build_dir(tmp_path, monkeypatch):
+    build = tmp_path / 'build'
+    build.mkdir()
+    monkeypatch.chdir(str(build))
+    return build
+
+
+def write_build(build_dir, files):
+    """The build files 'files' ({name: content}) and their .man_log."""
+    man = {'ip': '127.0.0.1', 'karel': {}, 'tp': {}, 'data': {}}
+    for fl, content in files.items():
+        (build_dir / fl).write_text(content)
+        typ = {'.pc': 'karel', '.tp': 'tp', '.xml': 'data'}[os.path.splitext(fl)[1]]
+        man[typ][fl] = []
+    with open(str(build_dir / kpush.FILE_MANIFEST), 'w') as f:
+        yaml.dump(man, f)
+
+
+def run_kpush(monkeypatch, capsys, port, *args, native=True):
+    """Run kpush (--native), returns its exit code and the files it put."""
+    monkeypatch.setattr(sys, 'argv', ['kpush', '--port', str(port)] + list(args)
+        + (['--native'] if native else []))
+    code = 0
+    try:
+        kpush.main()
+    except SystemExit as e:
+        code = e.code
+    out = capsys.readouterr().out
+    puts = sorted(line.split()[1] for line in out.splitlines() if line.startswith('  put '))
+    return code, puts, out
+
+
+def ledger(build_dir):
+    with open(str(build_dir / kpush.FILE_LEDGER)) as f:
+        return json.load(f)['127.0.0.1']
+
+
+def test_incremental_push(controller, build_dir, monkeypatch, capsys):
+    root, port = controller
+    write_build(build_dir, {'a.pc': 'a', 'b.pc': 'b', 'c.tp': 'c', 'd.xml': 'd'})
+
+    code, puts, out = run_kpush(monkeypatch, capsys, port)
+    assert code == 0, out
+    assert puts == ['fr:\\d.xml', 'md:\\a.pc', 'md:\\b.pc', 'md:\\c.tp']
+    assert (root / 'md:' / 'a.pc').read_text() == 'a'
+    assert (root / 'fr:' / 'd.xml').read_text() == 'd'
+    assert sorted(ledger(build_dir)) == ['a.pc', 'b.pc', 'c.tp', 'd.xml']
+
+    # nothing changed
+    code, puts, _ = run_kpush(monkeypatch, capsys, port)
+    assert code == 0 and puts == []
+
+    # only what changed, and what is missing from the controller
+    (build_dir / 'a.pc').write_text('a2')
+    (root / 'md:' / 'c.tp').unlink()
+    code, puts, _ = run_kpush(monkeypatch, capsys, port)
+    assert code == 0
+    assert puts == ['md:\\a.pc', 'md:\\c.tp']
+    assert (root / 'md:' / 'a.pc').read_text() == 'a2'
+
+    # --full puts everything
+    code, puts, _ = run_kpush(monkeypatch, capsys, port, '--full')
+    assert len(puts) == 4
+
+
+def test_delete(controller, build_dir, monkeypatch, capsys):
+    root, port = controller
+    write_build(build_dir, {'a.pc': 'a', 'b.pc': 'b'})
+    assert run_kpush(monkeypatch, capsys, port)[0] == 0
+    (root / 'md:' / 'b.vr').write_text('variables of b')
+
+    # b.pc is no longer build, it is deleted along with its variables
+    (build_dir / 'b.pc').unlink()
+    write_build(build_dir, {'a.pc': 'a'})
+    code, puts, out = run_kpush(monkeypatch, capsys, port)
+    assert code == 0 and puts == []
+    assert '0 file(s) to put, 2 to delete' in out
+    assert sorted(os.listdir(str(root / 'md:'))) == ['a.pc']
+    assert sorted(ledger(build_dir)) == ['a.pc']
+
+    # --delete removes everything
+    code, puts, _ = run_kpush(monkeypatch, capsys, port, '--delete')
+    assert code == 0
+    assert os.listdir(str(root / 'md:')) == []
+    assert ledger(build_dir) == {}
+
+
+def test_refused_transfer(controller, build_dir, monkeypatch, capsys):
+    root, port = controller
+    write_build(build_dir, {'a.pc': 'a', 'b.pc': 'b', 'c.pc': 'c'})
+    # the controller replies 550 to a put (and delete) of b.pc
+    (root / 'md:' / 'b.pc').mkdir()
+
+    code, puts, out = run_kpush(monkeypatch, capsys, port)
+    assert code == 1
+    assert puts == ['md:\\a.pc', 'md:\\c.pc']
+    assert 'could not put md:\\b.pc: 550' in out
+    assert ', 1 failed' in out
+    # b.pc is put again by the next push
+    assert sorted(ledger(build_dir)) == ['a.pc', 'c.pc']
+
+
+def test_dropped_connection(controller, build_dir, monkeypatch, capsys):
+    root, port = controller
+    write_build(build_dir, {'a.pc': 'a', 'b.pc': 'b', 'c.pc': 'c'})
+
+    # the connection drops when b.pc is put
+    storbinary = ftplib.FTP.storbinary
+    dropped = []
+    def dropping_storbinary(self, cmd, fp, *args, **kwargs):
+        if cmd == 'STOR b.pc' and not dropped:
+            dropped.append(cmd)
+            self.sock.shutdown(socket.SHUT_RDWR)
+        return storbinary(self, cmd, fp, *args, **kwargs)
+    monkeypatch.setattr(ftplib.FTP, 'storbinary', dropping_storbinary)
+
+    code, puts, out = run_kpush(monkeypatch, capsys, port)
+    assert dropped
+    assert 'retrying' in out
+    assert code == 0
+    assert puts == ['md:\\a.pc', 'md:\\b.pc', 'md:\\c.pc']
+    assert (root / 'md:' / 'b.pc').read_text() == 'b'
+    assert sorted(ledger(build_dir)) == ['a.pc', 'b.pc', 'c.pc']
+
+
+@pytest.mark.parametrize('no_list', [False, True])
+def test_refused_login_is_fatal(controller, build_dir, monkeypatch, capsys, no_list):
+    root, port = controller
+    write_build(build_dir, {'a.pc': 'a', 'b.pc': 'b', 'c.pc': 'c'})
+
+    logins = []
+    def refused_login(self, *args, **kwargs):
+        logins.append(args)
+        raise ftplib.error_perm('530 Login incorrect.')
+    monkeypatch.setattr(ftplib.FTP, 'login', refused_login)
+
+    code, puts, out = run_kpush(monkeypatch, capsys, port, *(['--no-list'] if no_list else []))
+    assert code
+    assert '127.0.0.1 refused the login: 530' in str(code) + out
+    # not retried, nor tried again for every file
+    assert len(logins) == 1
+    assert puts == []
+    assert os.listdir(str(root / 'md:')) == []
+
+
+def unused_port():
+    # nothing listens on this port
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def test_no_controller_is_fatal(build_dir, monkeypatch, capsys):
+    write_build(build_dir, {'a.pc': 'a'})
+    code, _, _ = run_kpush(monkeypatch, capsys, unused_port(), '--retries', '0')
+    assert 'could not connect to 127.0.0.1' in str(code)
+
+
+@pytest.mark.parametrize('native', [False, True])
+def test_no_controller_keeps_pending_push(build_dir, monkeypatch, capsys, native):
+    write_build(build_dir, {'a.pc': 'a'})
+    # the script of the last push, that still has to be confirmed
+    (build_dir / kpush.FTP_FILE_NAME).write_text('open 127.0.0.1\nmput "a.pc"\nquit\n')
+    pending = {'127.0.0.1': {'ledger': {'a.pc': ['karel', kpush.file_digest('a.pc')]},
+                             'put': {'a.pc': 'karel'}, 'deleted': {}}}
+    kpush.save_ledger(str(build_dir / kpush.FILE_LEDGER_PENDING), pending)
+
+    code, _, _ = run_kpush(monkeypatch, capsys, unused_port(), '--retries', '0', native=native)
+    assert 'could not connect to 127.0.0.1' in str(code)
+    # kpush.cmd must not run the script of the last push again
+    assert not (build_dir / kpush.FTP_FILE_NAME).exists()
+    assert kpush.load_ledger(str(build_dir / kpush.FILE_LEDGER_PENDING)) == pending
+
+
+@pytest.mark.parametrize('overwrite', [False, True])
+def test_apply_listing(build_dir, overwrite):
+    write_build(build_dir, {'a.pc': 'a', 'b.pc': 'b'})
+    manifest = kpush.new_manifest()
+    manifest['karel'].update(['a.pc', 'b.pc'])
+    manifest['karelvr'].update(['a.vr', 'b.vr'])
+    # a.pc changed, b.pc did not, c.pc is no longer build
+    pushed = {'a.pc': ['karel', 'old'], 'b.pc': ['karel', kpush.file_digest('b.pc')],
+              'c.pc': ['karel', 'old'], 'd.pc': ['karel', 'old']}
+    uploads, deletes, _ = kpush.plan_push(manifest, pushed)
+    # someone else already removed d.pc
+    listing = {'md:\\': {'a.pc', 'a.vr', 'b.pc', 'c.pc'}}
+
+    uploads, deletes, gone = kpush.apply_listing(manifest, uploads, deletes, listing,
+        overwrite=overwrite)
+    assert list(uploads['karel']) == ['a.pc']
+    # the ftp client cannot overwrite a loaded program, it deletes a.pc first
+    assert list(deletes['karel']) == (['c.pc'] if overwrite else ['a.pc', 'c.pc'])
+    assert list(deletes['karelvr']) == ['a.vr']
+    assert sorted(gone) == ['c.vr', 'd.pc', 'd.vr']
+
+
+def test_ledger_drops_files_not_on_controller(controller, build_dir, monkeypatch, capsys):
+    root, port = controller
+    write_build(build_dir, {'a.pc': 'a', 'b.pc': 'b'})
+    assert run_kpush(monkeypatch, capsys, port)[0] == 0
+
+    # b.pc is no longer build, and was already removed from the controller
+    (build_dir / 'b.pc').unlink()
+    write_build(build_dir, {'a.pc': 'a'})
+    (root / 'md:' / 'b.pc').unlink()
+    code, _, out = run_kpush(monkeypatch, capsys, port)
+    assert code == 0
+    assert '0 file(s) to put, 0 to delete' in out
+    assert sorted(ledger(build_dir)) == ['a.pc']
+
+
+@pytest.fixture
+def ftp_template(monkeypatch):
+    # FTP_FILE_TEMPLATE_NAME is a Windows path
+    monkeypatch.setattr(kpush, 'FTP_FILE_TEMPLATE_NAME', os.path.join('templates', 'ftp.txt.em'))
+
+
+def test_ftp_script(controller, build_dir, monkeypatch, capsys, ftp_template):
+    root, port = controller
+    write_build(build_dir, {'a.pc': 'a', 'b.pc': 'b'})
+    (root / 'md:' / 'a.pc').write_text('old a')
+
+    code, _, _ = run_kpush(monkeypatch, capsys, port, native=False)
+    assert code == 0
+    script = (build_dir / kpush.FTP_FILE_NAME).read_text()
+    # a loaded program cannot be overwritten, the ftp client deletes it first
+    assert 'mdel "a.pc"' in script
+    assert 'mput "a.pc" "b.pc"' in script
+    assert sorted(os.listdir(str(build_dir))) == sorted([kpush.FILE_MANIFEST,
+        kpush.FILE_LEDGER_PENDING, kpush.FTP_FILE_NAME, 'a.pc', 'b.pc'])
+
+
+def test_failed_ftp_script(controller, build_dir, monkeypatch, capsys):
+    root, port = controller
+    write_build(build_dir, {'a.pc': 'a'})
+    (build_dir / kpush.FTP_FILE_NAME).write_text('open 127.0.0.1\nquit\n')
+    monkeypatch.setattr(kpush, 'FTP_FILE_TEMPLATE_NAME', 'missing.em')
+
+    with pytest.raises(IOError):
+        run_kpush(monkeypatch, capsys, port, native=False)
+    # neither the old nor a partial script is left for kpush.cmd, and no
+    # pending push is recorded
+    assert sorted(os.listdir(str(build_dir))) == [kpush.FILE_MANIFEST, 'a.pc']
+
+
+def test_no_controller_leaves_no_ftp_script(build_dir, monkeypatch, capsys, ftp_template):
+    write_build(build_dir, {'a.pc': 'a'})
+    (build_dir / kpush.FTP_FILE_NAME).write_text('open 127.0.0.1\nquit\n')
+
+    code, _, _ = run_kpush(monkeypatch, capsys, unused_port(), '--retries', '0', native=False)
+    assert code
+    assert not (build_dir / kpush.FTP_FILE_NAME).exists()
+    assert not (build_dir / kpush.FILE_LEDGER_PENDING).exists()
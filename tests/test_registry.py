@@ -0,0 +1,59 @@
+#
+# Copyright (c) 2020, kobbled
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import collections
+
+import rossum
+
+FixtureManifest = collections.namedtuple('FixtureManifest', 'name')
+FixturePkg = collections.namedtuple('FixturePkg', 'manifest location manifest_path')
+
+
+def loader(manifests):
+    """Parse the (fake) manifests in 'manifests': path -> package name, or
+    None for a manifest that does not parse."""
+    def load(manifest_path):
+        name = manifests[manifest_path]
+        if name is None:
+            return None
+        return FixturePkg(FixtureManifest(name), manifest_path.rsplit('/', 1)[0], manifest_path)
+    return load
+
+
+def test_only_parsed_packages_count():
+    manifests = {
+        'lib/math/package.json': 'math',
+        'lib/broken/package.json': None,
+        'lib/strings/package.json': 'strings',
+        'other/strings/package.json': 'strings',
+        'lib/renamed/package.json': 'errors',
+    }
+    registry = rossum.PackageRegistry(loader=loader(manifests))
+    registry.index([
+        ('math', 'lib/math/package.json'),
+        ('broken', 'lib/broken/package.json'),
+        ('strings', 'lib/strings/package.json'),
+        ('strings', 'other/strings/package.json'),
+        ('renamed', 'lib/renamed/package.json'),
+    ])
+
+    assert 'broken' not in registry
+    assert 'math' in registry
+    # a duplicate name counts once, a manifest that declares another name not
+    assert len(registry) == 2
+    assert sorted(pkg.manifest.name for pkg in registry) == ['math', 'strings']
+    assert registry['strings'].location == 'lib/strings'
@@ -0,0 +1,180 @@
+#
+# Copyright (c) 2020, kobbled
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# The native renderer is a port of templates/build.ninja.em (and of
+# templates/package.ninja.em it includes). Both must produce the same build
+# files for every workspace and set of options.
+
+import io
+import os
+import argparse
+import itertools
+import collections
+
+import em
+import pytest
+
+import rossum
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+    '..', 'bin', 'templates')
+TEMPLATE_PATH = os.path.join(TEMPLATE_DIR, 'build.ninja.em')
+PACKAGE_TEMPLATE_PATH = os.path.join(TEMPLATE_DIR, 'package.ninja.em')
+
+# what the renderers use of a package
+FixtureManifest = collections.namedtuple('FixtureManifest', 'name')
+FixturePkg = collections.namedtuple('FixturePkg',
+    'manifest location dependencies include_dirs macros objects')
+
+# one source of every kind the build file has rules for
+SOURCE_EXTS = ['kl', 'KL', 'ls', 'tpp', 'yml', 'xml', 'csv', 'utx', 'ftx', 'txt', 'klt']
+
+
+def fixture_pkgs():
+    """A workspace of packages covering every source type, package names
+    that need escaping and packages with and without dependencies, include
+    dirs and macros.
+    """
+    pkgs = []
+    for i, ext in enumerate(SOURCE_EXTS):
+        objects = [('src\\{0}{1}.{2}'.format(ext, j, ext), '{0}{1}.pc'.format(ext, j),
+            'obj{0}'.format(j), 'dst{0}'.format(j)) for j in range(i % 3)]
+        pkgs.append(FixturePkg(
+            manifest=FixtureManifest('pkg {}'.format(i) if i % 4 == 0 else 'pkg{}'.format(i)),
+            location='C:\\ws\\src\\pkg{}'.format(i),
+            dependencies=pkgs[-2:],
+            include_dirs=['C:\\ws\\src\\pkg{}\\include'.format(i), 'C:\\ws\\lib'][:i % 3],
+            macros=['DEBUG=1', 'TRACE'][:i % 3],
+            objects=objects))
+    return pkgs
+
+
+def template_globals(pkgs, translate_only, keepgpp, compiletp, hastpp, makeenv,
+        env, sources, subninja, kcache):
+    ws = rossum.RossumWorkspace(
+        build=rossum.RossumSpaceInfo('C:\\ws\\build'),
+        sources=[rossum.RossumSpaceInfo(p) for p in sources],
+        robot_ini=rossum.KtransRobotIniInfo(path='C:\\ws\\robot.ini', ftp='127.0.0.1', env=env),
+        pkgs=pkgs)
+    tools = {t: {'path': 'C:\\tools\\{}.exe'.format(t)}
+        for t in ['ktrans', 'ktransw', 'maketp', 'yaml', 'xml', 'csv', 'kcdict', 'kcform', 'tpp']}
+    tools['tpp']['compile'] = 'C:\\tools\\maketp.exe'
+    regen = rossum.RossumRegenInfo('"rossum.exe" "--regenerate" "C:\\ws\\build"',
+        'C:\\ws\\src\\package.json C:\\ws\\robot.ini')
+    pools = collections.OrderedDict([('karel', 2), ('forms', 1)])
+    args = argparse.Namespace(translate_only=translate_only, keepgpp=keepgpp, kcache=kcache,
+        compiletp=compiletp, hastpp=hastpp)
+    return rossum.template_globals(ws, tools, rossum.KtransSupportDirInfo('C:\\support', 'V9.10-1'),
+        regen, makeenv, subninja, pools, PACKAGE_TEMPLATE_PATH, args)
+
+
+@pytest.fixture(autouse=True)
+def empy_stdout_proxy(monkeypatch):
+    # empy installs a sys.stdout proxy once and never removes it, pytest
+    # replaces sys.stdout for every test
+    monkeypatch.setattr(em.Interpreter, '_wasProxyInstalled', False)
+
+
+def render_empy(globls):
+    out = io.StringIO()
+    interp = em.Interpreter(output=out, globals=dict(globls),
+        options={em.RAW_OPT : True, em.BUFFERED_OPT : True})
+    with open(TEMPLATE_PATH) as f:
+        interp.string(f.read())
+    # shutdown flushes the buffered output, and closes it
+    content = []
+    out.close = lambda: content.append(out.getvalue())
+    interp.shutdown()
+    return content[0]
+
+
+def render_native(globls):
+    out = io.StringIO()
+    rossum.render_build_file(out, globls)
+    return out.getvalue()
+
+
+OPTIONS = list(itertools.product(
+    [False, True],                                        # translate_only
+    [False, True],                                        # keepgpp
+    [True, False],                                        # compiletp
+    [True, False],                                        # hastpp
+    [None, {'name': 'env.tpp', 'clear': 'clear.cmd', 'config': 'env.yml'}],  # makeenv
+    ['', 'robot.env'],                                    # env
+    [[], ['C:\\ws\\src', 'C:\\ws\\lib']],                 # sources
+))
+
+
+@pytest.mark.parametrize('npkgs', [0, 1, len(SOURCE_EXTS)])
+@pytest.mark.parametrize('kcache', [False, True])
+@pytest.mark.parametrize('subninja', [None, ['packages\\pkg1.ninja', 'packages\\pkg_4.ninja']])
+def test_renderers_identical(npkgs, kcache, subninja):
+    pkgs = fixture_pkgs()[:npkgs]
+    for options in OPTIONS:
+        globls = template_globals(pkgs, *options, subninja=subninja, kcache=kcache)
+        assert render_native(globls) == render_empy(globls), options
+
+
+@pytest.mark.parametrize('compiletp', [True, False])
+def test_package_files_identical(tmp_path, compiletp):
+    pkgs = fixture_pkgs()
+    for renderer in ('native', 'empy'):
+        os.mkdir(str(tmp_path / renderer))
+        rossum.write_package_build_files(str(tmp_path / renderer), pkgs, compiletp,
+            renderer, PACKAGE_TEMPLATE_PATH)
+
+    native_dir = tmp_path / 'native' / rossum.SUBNINJA_DIR
+    empy_dir = tmp_path / 'empy' / rossum.SUBNINJA_DIR
+    fnames = sorted(os.listdir(str(native_dir)))
+    assert fnames == sorted(os.listdir(str(empy_dir)))
+    assert len(fnames) == len([pkg for pkg in pkgs if pkg.objects])
+    for fname in fnames:
+        assert (native_dir / fname).read_text() == (empy_dir / fname).read_text(), fname
+
+
+def test_package_files_rendered_when_changed(tmp_path, monkeypatch):
+    rendered = []
+    render_package = rossum.render_package
+    def counting_render_package(fl, pkg, rules):
+        rendered.append(pkg.manifest.name)
+        render_package(fl, pkg, rules)
+    monkeypatch.setattr(rossum, 'render_package', counting_render_package)
+
+    def write(pkgs):
+        del rendered[:]
+        return rossum.write_package_build_files(str(tmp_path), pkgs, False,
+            'native', PACKAGE_TEMPLATE_PATH)
+
+    pkgs = [pkg for pkg in fixture_pkgs() if pkg.objects]
+    paths, changed = write(pkgs)
+    assert len(paths) == len(changed) == len(rendered) == len(pkgs)
+
+    # nothing changed, nothing is rendered
+    paths2, changed = write(pkgs)
+    assert paths2 == paths
+    assert changed == [] and rendered == []
+
+    # only the package that changed
+    pkgs[1] = pkgs[1]._replace(macros=['OTHER'])
+    _, changed = write(pkgs)
+    assert rendered == [pkgs[1].manifest.name]
+    assert len(changed) == 1
+
+    # a removed package only removes its file
+    paths3, changed = write(pkgs[1:])
+    assert paths3 == paths[1:]
+    assert changed == [] and rendered == []
+    assert len(os.listdir(str(tmp_path / rossum.SUBNINJA_DIR))) == len(pkgs) - 1